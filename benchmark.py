@@ -0,0 +1,211 @@
+# -*- encoding:utf-8 -*-
+"""
+模拟核心的性能基准。在不同的格点大小、拓扑、积分方法、后端、步长与采样间隔下测量：
+    build: Country 构造 (建图) 时间
+    rhs: 导数计算速度 (次/秒)，python (_derivative), vector 与 fft 后端
+    integrate: 每模拟一天的耗时，Euler/RK4/RK45
+    track: 演化轨迹的内存占用与积分过程中的内存峰值 (tracemalloc)
+    vision: plot_all 与 save_animation 的绘制时间
+
+结果以 JSON 保存，与基准文件比较，变差超过阈值的项标记为性能回退：
+
+    python benchmark.py --output bench.json                      # 运行并保存结果
+    python benchmark.py --quick --baseline bench.json            # 与基准比较，有回退时返回值为 1
+    python benchmark.py --baseline bench.json --save-baseline     # 运行后覆盖基准
+
+全连接格点图的边数为 (HW)^2，超过 50×50 时只测量截断 (cutoff) 图和无显式边的格点国家 (fft 后端)。
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from simulation import SimCountry
+from numerical import _derivative, _backend
+
+FULL_LIMIT = 50  # 全连接图的最大边长
+PYTHON_LIMIT = 10  # python 后端的最大边长
+VISION_LIMIT = 10  # 逐城市绘图的最大边长
+
+
+def _best(func, repeat: "int" = 3, min_time: "float" = 0.2) -> "float":
+    """
+    func 单次调用的最短耗时 (秒)，每轮至少运行 min_time 秒
+    """
+    best = np.inf
+    for _ in range(repeat):
+        n = 0
+        start = time.perf_counter()
+        while True:
+            func()
+            n += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        best = min(best, elapsed / n)
+    return best
+
+
+def _initials(shape: "tuple(int, int)") -> "np.ndarray":
+    initials = np.zeros((*shape, 4))
+    initials[..., 0] = 1000.
+    initials[shape[0] // 2, shape[1] // 2, 1] = 1e-4
+    return initials
+
+
+def _country(n: "int", topology: "str") -> "SimCountry":
+    if topology == 'full':
+        return SimCountry((n, n), 100.)
+    if topology == 'cutoff':
+        return SimCountry((n, n), 100., cutoff=500.)
+    return SimCountry((n, n), 100., edges=False)
+
+
+def _topologies(n: "int") -> "list(str)":
+    return (['full'] if n <= FULL_LIMIT else []) + ['cutoff', 'lattice']
+
+
+def _backends(n: "int", topology: "str") -> "list(str)":
+    if topology == 'lattice':
+        return ['fft']
+    return (['python'] if n <= PYTHON_LIMIT else []) + ['vector'] + (['fft'] if topology == 'full' else [])
+
+
+def _record(results, group, params, value, unit, better="lower"):
+    results.append({'group': group, 'params': params, 'value': float(value), 'unit': unit, 'better': better})
+    shown = ', '.join(f'{k}={v}' for k, v in params.items())
+    print(f"{group:<10} {shown:<70} {value:>12.4g} {unit}")
+
+
+def run(sizes: "list[int]", steps: "list[float]", samplings: "list[int]", days: "float" = 10.,
+        vision: "bool" = True) -> "list(dict)":
+    """
+    运行基准矩阵，返回结果列表，每项为 {group, params, value, unit, better}
+    """
+    results = []
+    for n in sizes:
+        for topology in _topologies(n):
+            params = {'grid': n, 'topology': topology}
+            start = time.perf_counter()
+            country = _country(n, topology)
+            _record(results, 'build', params, time.perf_counter() - start, 's')
+            initials = _initials(country.shape)
+
+            # 导数计算速度
+            for backend in _backends(n, topology):
+                if backend == 'python':
+                    seconds = _best(lambda: _derivative(country, initials, 0.), repeat=1, min_time=0.5)
+                else:
+                    derivative = _backend(country, backend)
+                    seconds = _best(lambda: derivative(initials, 0.))
+                _record(results, 'rhs', {**params, 'backend': backend}, 1. / seconds, 'eval/s', 'higher')
+
+            # 积分速度与轨迹内存
+            backend = 'vector' if topology != 'lattice' else 'fft'
+            for method in ['Euler', 'RK4', 'RK45']:
+                for step in steps:
+                    for sampling in samplings:
+                        run_params = {**params, 'method': method, 'step': step, 'sampling': sampling}
+                        start = time.perf_counter()
+                        country.evolute(initials, [0., days], step, sampling, method, backend)
+                        elapsed = time.perf_counter() - start
+                        tracemalloc.start()  # 内存峰值单独测量，tracemalloc 会拖慢计时
+                        country.evolute(initials, [0., days], step, sampling, method, backend)
+                        peak = tracemalloc.get_traced_memory()[1]
+                        tracemalloc.stop()
+                        _record(results, 'integrate', run_params, elapsed / days, 's/day')
+                        _record(results, 'track', run_params, country.track.nbytes / 2 ** 20, 'MiB')
+                        _record(results, 'peak', run_params, peak / 2 ** 20, 'MiB')
+
+        if vision:
+            _vision(results, n, days)
+    return results
+
+
+def _vision(results, n, days):
+    import vision
+    country = _country(n, 'lattice')
+    country.evolute(_initials(country.shape), [0., days], 0.1, 1, 'RK4', 'fft')
+    directory = tempfile.mkdtemp()
+    try:
+        if n <= VISION_LIMIT:
+            start = time.perf_counter()
+            vision.plot_all(country, directory, processes=1, cache=False)
+            _record(results, 'vision', {'grid': n, 'output': 'plot_all'}, time.perf_counter() - start, 's')
+        start = time.perf_counter()
+        vision.save_animation(country, os.path.join(directory, 'animation.gif'), cache=False)
+        _record(results, 'vision', {'grid': n, 'output': 'animation'}, time.perf_counter() - start, 's')
+    finally:
+        shutil.rmtree(directory)
+
+
+def _key(item: "dict") -> "str":
+    return item['group'] + json.dumps(item['params'], sort_keys=True)
+
+
+def compare(results: "list(dict)", baseline: "list(dict)", threshold: "float" = 0.2) -> "list(dict)":
+    """
+    与基准比较，变差超过 threshold (相对值) 的项为性能回退，返回回退项列表，每项增加 baseline 与 ratio
+    """
+    reference = {_key(item): item for item in baseline}
+    regressions = []
+    for item in results:
+        base = reference.get(_key(item))
+        if base is None or base['value'] <= 0:
+            continue
+        ratio = item['value'] / base['value']
+        worse = ratio < 1 - threshold if item['better'] == 'higher' else ratio > 1 + threshold
+        if worse:
+            regressions.append({**item, 'baseline': base['value'], 'ratio': ratio})
+    return regressions
+
+
+def _meta() -> "dict":
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+            'processor': platform.processor(), 'cpus': os.cpu_count(), 'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+def main(argv=None) -> "int":
+    parser = argparse.ArgumentParser(description="GraphSEIR benchmark suite")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[5, 10, 25, 50, 100])
+    parser.add_argument('--steps', type=float, nargs='+', default=[0.1, 0.5])
+    parser.add_argument('--samplings', type=int, nargs='+', default=[1, 10])
+    parser.add_argument('--days', type=float, default=10., help="simulated days per integration")
+    parser.add_argument('--quick', action='store_true', help="5x5 and 10x10 only, one step size and sampling")
+    parser.add_argument('--no-vision', action='store_true')
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--baseline', default=None, help="baseline JSON to compare against")
+    parser.add_argument('--threshold', type=float, default=0.2, help="relative slowdown flagged as regression")
+    parser.add_argument('--save-baseline', action='store_true', help="overwrite the baseline with this run")
+    args = parser.parse_args(argv)
+    if args.quick:
+        args.sizes, args.steps, args.samplings, args.days = [5, 10], [0.1], [1], 5.
+
+    results = run(args.sizes, args.steps, args.samplings, args.days, not args.no_vision)
+    with open(args.output, 'w') as f:
+        json.dump({'meta': _meta(), 'results': results}, f, indent=1)
+    print(f"results written to {args.output}")
+    if args.baseline is None:
+        return 0
+    if args.save_baseline or not os.path.exists(args.baseline):
+        shutil.copyfile(args.output, args.baseline)
+        print(f"baseline saved to {args.baseline}")
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)['results']
+    regressions = compare(results, baseline, args.threshold)
+    for item in regressions:
+        shown = ', '.join(f'{k}={v}' for k, v in item['params'].items())
+        print(f"REGRESSION {item['group']:<10} {shown:<70} {item['baseline']:.4g} -> {item['value']:.4g} "
+              f"{item['unit']} (x{item['ratio']:.2f})")
+    print(f"{len(regressions)} regression(s) against {args.baseline}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,283 @@
+# -*- encoding:utf-8 -*-
+"""
+按模型配置寻址的模拟结果缓存。SimCountry.evolute(..., cache=Cache('results/cache')) 先计算本次演化的指纹，
+命中时直接读取已保存的轨迹与在线统计量，否则演化后保存。指纹包括：
+    国家: 格点形状、minDistance、边数组 (起点、终点、距离、权重、转移函数编号)、转移函数表与各城市的参数函数
+    演化: initials, time_span, step, sampling, method, backend, rtol, atol, events, reducers
+声明式参数与转移函数 (schedules.py) 按取值哈希，每次重新构造的相同设定得到相同的指纹；
+普通的自定义函数按代码、常量、默认参数、闭包中的值与其读取的模块级全局变量哈希，全局变量为模块或类时按名称与
+函数读取的数据属性 (数值、字符串、数组等) 哈希，因而修改脚本中的封城时间等常量后不会命中旧的结果；
+统计量 (reducers.py)、事件 (events.py) 等对象按类名与构造参数同名的属性哈希，不包括演化过程中写入的状态。
+无法描述的对象 (如打开的文件) 使本次演化不使用缓存。
+
+缓存为目录中的 <指纹>.npz 文件，总大小超过 max_bytes 时按最近使用时间 (文件修改时间，命中时更新) 淘汰最久未用的结果。
+写入先写临时文件再以 os.replace 替换，淘汰在锁文件保护下进行，多个进程 (如进程池中的各个 worker) 可以同时使用同一缓存。
+---------------------------------------------------------------
+Example:
+
+    store = Cache('results/cache', max_bytes=2 ** 30)
+    china.evolute(initials, [0., 360.], cache=store)  # 第二次运行直接读取
+"""
+import hashlib
+import inspect
+import json
+import os
+import time
+import types
+import numpy as np
+
+_VERSION = 2  # 数值算法的结果改变时递增，使旧的缓存失效
+
+
+class _Uncacheable(Exception):
+    pass
+
+
+class _Fingerprint(object):
+    """
+    对象的哈希，同一对象 (如所有城市共用的参数) 只计算一次
+    """
+    def __init__(self):
+        self.memo = {}
+        self.active = set()
+
+    def digest(self, obj) -> "str":
+        key = id(obj)
+        if key not in self.memo:
+            if key in self.active:
+                raise _Uncacheable("reference cycle")
+            self.active.add(key)
+            h = hashlib.sha1()
+            self._feed(h, obj)
+            self.active.discard(key)
+            self.memo[key] = (h.hexdigest(), obj)  # 保留 obj 的引用，避免 id 被复用
+        return self.memo[key][0]
+
+    def _feed(self, h, obj):
+        if obj is None or obj is Ellipsis or isinstance(obj, (bool, int, float, complex, str, bytes)):
+            h.update(repr((type(obj).__name__, obj)).encode())
+        elif isinstance(obj, (np.ndarray, np.generic)):
+            a = np.ascontiguousarray(obj)
+            if a.dtype.hasobject:
+                raise _Uncacheable(f"object array {a.shape}")
+            h.update(f"ndarray {a.dtype.str} {a.shape}".encode())
+            h.update(a.tobytes())
+        elif isinstance(obj, (list, tuple)):
+            h.update(f"{type(obj).__name__} {len(obj)}".encode())
+            for item in obj:
+                h.update(self.digest(item).encode())
+        elif isinstance(obj, dict):
+            h.update(f"dict {len(obj)}".encode())
+            for k in sorted(obj, key=repr):
+                h.update(repr(k).encode())
+                h.update(self.digest(obj[k]).encode())
+        elif isinstance(obj, (set, frozenset)):
+            h.update(f"set {len(obj)}".encode())
+            for digest in sorted(self.digest(item) for item in obj):
+                h.update(digest.encode())
+        elif isinstance(obj, types.FunctionType):
+            self._function(h, obj)
+        elif isinstance(obj, types.MethodType):
+            # 所属对象由外层按其设定哈希，此处只哈希方法本身，避免循环引用
+            h.update(f"method {obj.__func__.__qualname__}".encode())
+            h.update(self.digest(obj.__func__.__code__).encode())
+            h.update(self.digest(_globals(obj.__func__)).encode())
+        elif isinstance(obj, types.CodeType):
+            h.update(obj.co_code)
+            h.update(repr(obj.co_names).encode())
+            for const in obj.co_consts:
+                h.update(self.digest(const).encode())
+        elif isinstance(obj, (types.BuiltinFunctionType, type)):
+            h.update(f"{obj.__module__}.{obj.__qualname__}".encode())
+        elif hasattr(obj, '__dict__'):
+            h.update(f"{type(obj).__module__}.{type(obj).__qualname__}".encode())
+            h.update(self.digest(_settings(obj)).encode())
+        else:
+            raise _Uncacheable(f"cannot fingerprint {type(obj).__name__}")
+
+    def _function(self, h, func):
+        h.update(f"{func.__module__}.{func.__qualname__}".encode())
+        h.update(self.digest(func.__code__).encode())
+        h.update(self.digest(func.__defaults__).encode())
+        cells = tuple(cell.cell_contents for cell in func.__closure__ or ())
+        h.update(self.digest(cells).encode())
+        h.update(self.digest({k: v for k, v in vars(func).items()}).encode())
+        h.update(self.digest(_globals(func)).encode())
+
+
+_DATA = (bool, int, float, complex, str, bytes, np.ndarray, np.generic, list, tuple, dict, set, frozenset)
+
+
+def _globals(func) -> "dict":
+    """
+    函数 (包括其中嵌套定义的函数) 读取的模块级全局变量。模块与类按名称及函数读取的数据属性描述，
+    函数引用自身 (递归) 时记为 'self'
+    """
+    names = set()
+    codes = [func.__code__]
+    while codes:
+        code = codes.pop()
+        names.update(code.co_names)
+        codes.extend(const for const in code.co_consts if isinstance(const, types.CodeType))
+    values = {}
+    for name in sorted(names):
+        if name not in func.__globals__:
+            continue  # 属性名或内置函数
+        value = func.__globals__[name]
+        if value is func:
+            value = 'self'
+        elif isinstance(value, (types.ModuleType, type)):
+            attrs = {attr: getattr(value, attr) for attr in sorted(names)
+                     if isinstance(getattr(value, attr, None), _DATA)}
+            value = (type(value).__name__, getattr(value, '__qualname__', value.__name__), attrs)
+        values[name] = value
+    return values
+
+
+def _settings(obj) -> "dict":
+    """
+    对象的设定：声明式参数与转移函数 (带有 kind) 为全部属性；其余对象为与构造参数同名的属性，
+    不包括 start, initialize 等方法在演化中写入的状态，没有同名属性时为全部属性
+    """
+    attrs = vars(obj)
+    if hasattr(obj, 'kind'):
+        return dict(attrs)
+    try:
+        params = inspect.signature(type(obj).__init__).parameters
+    except (TypeError, ValueError):
+        return dict(attrs)
+    settings = {name: attrs[name] for name in params if name in attrs}
+    return settings if settings else dict(attrs)
+
+
+def fingerprint(country: "Country", initials: "np.ndarray", time_span: "list[float, float]", **config) -> "str":
+    """
+    演化配置的指纹，无法描述时返回 None。config 为 evolute 的其余参数
+    """
+    cities = [(c.r, c.beta, c.h, c.theta, c.gamma, c.nu) for c in country.all_cities()]
+    if country.model is not None:
+        cities = country.model  # 仓室模型不使用城市的SEIR参数
+    graph = (tuple(country.shape), float(country.minDistance), bool(country.hasEdges), country.latticeOffsets)
+    if country.hasEdges:
+        graph += (country.edgeStart, country.edgeEnd, country.edgeDistance, country.edgeWeight, country.edgeTransfer)
+    try:
+        return _Fingerprint().digest((_VERSION, graph, list(country.transfers), cities, np.asarray(initials, float),
+                                      [float(t) for t in time_span], config))
+    except _Uncacheable:
+        return None
+
+
+class _Lock(object):
+    """
+    以 O_EXCL 创建的锁文件，超过 timeout 秒未释放的锁视为持有者已退出
+    """
+    def __init__(self, path: "str", timeout: "float" = 60.):
+        self.path = path
+        self.timeout = timeout
+
+    def __enter__(self):
+        while True:
+            try:
+                os.close(os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return self
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(self.path) > self.timeout:
+                        os.remove(self.path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                time.sleep(0.01)
+
+    def __exit__(self, *exc):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class Cache(object):
+    """
+    directory -> str, 缓存目录
+    max_bytes -> int, 缓存的最大总字节数，超过时淘汰最久未用的结果
+    """
+    def __init__(self, directory: "str", max_bytes: "int" = 2 ** 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.lock = _Lock(os.path.join(directory, '.lock'))
+
+    def key(self, country: "Country", initials: "np.ndarray", time_span: "list[float, float]", **config) -> "str":
+        return fingerprint(country, initials, time_span, **config)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def get(self, key: "str") -> "(time, track, summary, events) or None":
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                time_ = data['time']
+                track = data['track']
+                summary = {name[len('summary/'):]: data[name] for name in data.files if name.startswith('summary/')}
+                events = _load_events(str(data['events']))
+            os.utime(path)  # 最近使用
+        except (FileNotFoundError, OSError, KeyError, ValueError):
+            return None  # 不存在、正被淘汰或已损坏的结果视为未命中
+        return time_, track, summary, events
+
+    def put(self, key: "str", time_: "np.ndarray", track: "np.ndarray", summary: "dict", events: "dict"):
+        arrays = {'time': np.asarray(time_), 'track': np.asarray(track), 'events': np.array(_dump_events(events))}
+        arrays.update({'summary/' + name: np.asarray(value) for name, value in summary.items()})
+        if sum(a.nbytes for a in arrays.values()) > self.max_bytes:
+            return
+        tmp = os.path.join(self.directory, f"{key}.{os.getpid()}.tmp")
+        with open(tmp, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, self._path(key))
+        self.evict()
+
+    def evict(self):
+        """
+        淘汰最久未用的结果，直到总大小不超过 max_bytes
+        """
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                if name.endswith('.npz'):
+                    try:
+                        stat = os.stat(os.path.join(self.directory, name))
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, name))
+            total = sum(size for _, size, _ in entries)
+            for _, size, name in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def clear(self):
+        with self.lock:
+            for name in os.listdir(self.directory):
+                if name.endswith('.npz'):
+                    os.remove(os.path.join(self.directory, name))
+
+
+def _dump_events(events: "dict") -> "str":
+    def plain(v):
+        return [np.asarray(a).tolist() for a in v] if isinstance(v, list) else np.asarray(v).tolist()
+    return json.dumps({name: {'batched': isinstance(v, list), 'times': plain(v)} for name, v in events.items()})
+
+
+def _load_events(text: "str") -> "dict":
+    events = {}
+    for name, item in json.loads(text).items():
+        if item['batched']:
+            events[name] = [np.array(a, dtype=float) for a in item['times']]
+        else:
+            events[name] = np.array(item['times'], dtype=float)
+    return events
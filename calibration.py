@@ -0,0 +1,445 @@
+# -*- encoding:utf-8 -*-
+"""
+参数标定。由观测的病例时间序列拟合城市的SEIR参数与zipf迁移系数 (SEIRDefaultParameter 与 zipf_transfer 的默认值为估计值)：
+    Parameter(name, cities, initial, bounds): 待拟合的参数，name 为城市的SEIR参数 'r', 'beta', 'h', 'theta', 'gamma'
+        或zipf迁移系数 'K'；cities 为 None (全国一个取值)、'each' (每个城市一个取值) 或城市组的列表 (每组一个取值)
+    calibrate(country, initials, times, observed, parameters, ...) -> Calibration
+目标函数为残差平方和的一半，残差为绝对误差 (squares)、对数误差 (log，适用于跨越数个量级的流行曲线)
+或 Poisson 偏差残差 (poisson，即极大似然估计)，observed 中的 nan 不计入。
+
+优化使用 Levenberg-Marquardt 方法，Jacobian 由批量有限差分得到：参数以 shape=(B,) 的声明式参数 (见schedules.py) 给出，
+B = 1 + 参数个数的一次批量模拟同时得到当前点的残差与全部偏导数，所有场景共享同一个图，导数计算是一次向量化的数组运算，
+而不是 B 次独立的 evolute；每次迭代中几个阻尼系数的试探步同样合为一次批量模拟。
+逐城市的参数较多时以 batch 限制每次批量模拟的场景数。接收器只保存观测时刻的观测量，不保存轨迹。
+固定步长的积分 (Euler, RK4, ROS2) 是参数的光滑函数，差分步长可以很小；RK45 的步长随参数变化，应使用较大的 diff_step。
+只适用于扩展SEIR方程，不改变 country 的演化结果 (time, track 等)，参数在每次模拟后恢复。
+
+观测量 observable:
+    'S', 'E', 'I', 'R': 各人群的人数
+    'cases': 累计感染人数，即 E + I + R 相对初值的增量 (全国的总和不受迁移影响，各城市的值含迁入迁出)
+    'new_cases': 相邻观测时刻之间 cases 的增量，第一个为相对 t0 的增量
+observed 为 shape=(T,) 的全国序列或 shape=(T, H, W) (网络国家为 (T, n)) 的各城市序列，单位同 initials (万人)，
+观测时刻 times 须在采样网格 t0 + step * sampling * k 上。
+---------------------------------------------------------------
+Example:
+
+    fit = calibrate(china, initials, days, cases, [Parameter('r', initial=10.), Parameter('K', initial=0.01)],
+                    observable='new_cases', loss='poisson', step=0.2)
+    print(fit)
+    fit.apply(china)  # 将拟合值写入国家
+    fit = calibrate(china, initials, days2, cases2, fit.parameters, warm_start=fit)  # 追加数据后从上次的结果继续
+"""
+import time
+import numpy as np
+from schedules import Constant, Schedule, ZipfTransfer
+from sinks import Sink
+from profiling import Profile
+from numerical import Euler, RK4, RK45, ROS2
+
+_CITY_PARAMETERS = ('r', 'beta', 'h', 'theta', 'gamma')
+_OBSERVABLES = {'S': 0, 'E': 1, 'I': 2, 'R': 3, 'cases': None, 'new_cases': None}
+_METHODS = {'Euler': Euler, 'RK4': RK4, 'RK45': RK45, 'ROS2': ROS2}
+
+
+class Parameter(object):
+    """
+    name -> str, 'r', 'beta', 'h', 'theta', 'gamma' 或 'K'
+    cities -> None, 'each' 或 list(list(城市位置)), 见模块说明；'K' 只能为 None
+    initial -> float or np.ndarray, 初值 (每个城市或城市组一个值)，None 时取国家当前的值 (须为 Constant)
+    bounds -> (float, float), 取值范围
+    log -> bool, 是否在对数尺度上优化，默认 True (参数为正，各参数的相对变化尺度一致)
+    label -> str, 结果中的名称，默认为 name
+    """
+    def __init__(self, name: "str", cities=None, initial=None, bounds: "tuple" = (0., np.inf), log: "bool" = True,
+                 label: "str" = None):
+        if name not in _CITY_PARAMETERS and name != 'K':
+            raise ValueError(f"cannot fit parameter '{name}', use one of {', '.join(_CITY_PARAMETERS)} or 'K'")
+        if name == 'K' and cities is not None:
+            raise ValueError("'K' can only be fitted for the whole country")
+        self.name = name
+        self.cities = cities
+        self.initial = initial
+        self.bounds = tuple(bounds)
+        self.log = log
+        self.label = name if label is None else label
+
+    def groups(self, country: "Country") -> "list(np.ndarray)":
+        """
+        每个取值对应的城市 (展平编号)
+        """
+        if self.cities is None:
+            return [np.arange(country.size)]
+        if isinstance(self.cities, str) and self.cities == 'each':
+            return [np.array([k]) for k in range(country.size)]
+        return [np.array([country._index(np.atleast_1d(pos)) for pos in group]) for group in self.cities]
+
+    def current(self, country: "Country", groups: "list(np.ndarray)") -> "np.ndarray":
+        """
+        国家当前的取值，城市组内取平均
+        """
+        if self.name == 'K':
+            zipf = [tr for tr in country.transfers if getattr(tr, 'kind', None) == 'zipf']
+            if not zipf:
+                raise ValueError("fitting 'K' needs zipf transfers in the country")
+            return np.array([zipf[0].args[0]])
+        values = []
+        for group in groups:
+            funcs = [getattr(country.city(int(k)), self.name) for k in group]
+            if not all(getattr(f, 'kind', None) == 'const' and np.ndim(f.value) == 0 for f in funcs):
+                raise ValueError(f"initial value of '{self.label}' is needed, the cities do not use constants")
+            values.append(np.mean([f.value for f in funcs]))
+        return np.array(values, dtype=float)
+
+    def transform(self, value: "np.ndarray") -> "np.ndarray":
+        return np.log(value) if self.log else np.asarray(value, dtype=float)
+
+    def inverse(self, z: "np.ndarray") -> "np.ndarray":
+        return np.exp(z) if self.log else z
+
+
+class _Scaled(Schedule):
+    """
+    zipf迁移的倍率 scale * gate.at(t)，用于批量拟合 K：转移函数的 K 取 1，编译得到的权重矩阵与 K 无关，
+    各场景的 K 即倍率 scale
+    """
+    kind = 'scaled'
+
+    def __init__(self, scale: "np.ndarray, shape=(B,)", gate: "Schedule" = None):
+        self.scale = scale
+        self.gate = gate
+
+    def at(self, t):
+        return self.scale if self.gate is None else self.scale * self.gate.at(t)
+
+
+class _Assignment(object):
+    """
+    将参数值写入国家，restore 恢复原有的参数函数与转移函数
+    """
+    def __init__(self, country: "Country", parameters: "list(Parameter)", groups: "list"):
+        self.country = country
+        self.parameters = parameters
+        self.groups = groups
+        self.saved = {p.name: [getattr(c, p.name) for c in country.all_cities()]
+                      for p in parameters if p.name != 'K'}
+        self.transfers = list(country.transfers)
+
+    def assign(self, values: "list(np.ndarray)"):
+        """
+        values 为各参数的取值，shape=(size,) 或批量模拟的 (B, size)
+        """
+        country = self.country
+        for p, groups, value in zip(self.parameters, self.groups, values):
+            if p.name == 'K':
+                scaled = {}
+                for idx, tr in enumerate(self.transfers):
+                    if getattr(tr, 'kind', None) != 'zipf':
+                        continue
+                    if np.ndim(value) == 1:
+                        country.transfers[idx] = ZipfTransfer(float(value[0]), tr.args[1], tr.gate)
+                        continue
+                    key = id(tr.gate)  # 相同倍率的转移函数仍共享倍率，编译时合为一组
+                    if key not in scaled:
+                        scaled[key] = _Scaled(value[:, 0], tr.gate)
+                    country.transfers[idx] = ZipfTransfer(1., tr.args[1], scaled[key])
+                continue
+            for g, group in enumerate(groups):
+                parameter = Constant(value[..., g] if np.ndim(value) == 2 else float(value[g]))
+                for k in group:
+                    setattr(country.city(int(k)), p.name, parameter)
+
+    def restore(self):
+        for name, funcs in self.saved.items():
+            for c, func in zip(self.country.all_cities(), funcs):
+                setattr(c, name, func)
+        self.country.transfers[:] = self.transfers
+
+
+class _ObservationSink(Sink):
+    """
+    只保存观测时刻的观测量, shape=(B, T, m)
+    """
+    def __init__(self, rows: "np.ndarray", observe):
+        self.rows = {int(k): i for i, k in enumerate(rows)}
+        self.observe = observe
+
+    def open(self, time, shape, batched=False):
+        super().open(time, shape, batched)
+        self.values = None
+
+    def write(self, k, x):
+        i = self.rows.get(k)
+        if i is None:
+            return
+        value = self.observe(x)
+        if self.values is None:
+            self.values = np.full((value.shape[0], len(self.rows), value.shape[1]), np.nan)
+        self.values[:, i] = value
+
+
+class Calibration(object):
+    """
+    parameters -> list(Parameter), 拟合的参数，initial 为拟合值，可直接用于下一次 calibrate
+    values -> dict, label -> 拟合值 (全国为 float，逐城市或城市组为 np.ndarray)
+    stderr -> dict, label -> 标准误差，由拟合值处 Jacobian 的线性近似估计
+    cost -> float, 0.5 * 残差平方和
+    fitted -> np.ndarray, shape=observed.shape, 拟合值处的模型观测量
+    history -> list(float), 初值与每次接受的迭代后的 cost
+    iterations -> int, 迭代次数
+    simulations -> int, 批量模拟的次数
+    scenarios -> int, 模拟的场景总数，即等价的独立 evolute 次数
+    rhs -> int, 导数计算次数，批量模拟中一次计算包含所有场景
+    wall -> float, 耗时 (秒)
+    converged -> bool, 是否满足收敛条件；message -> str, 终止原因
+    damping -> float, 最后的阻尼系数，用于 warm_start
+    """
+    def __init__(self, parameters, values, stderr, cost, fitted, history, iterations, simulations, scenarios, rhs,
+                 wall, converged, message, damping):
+        self.parameters = parameters
+        self.values = values
+        self.stderr = stderr
+        self.cost = cost
+        self.fitted = fitted
+        self.history = history
+        self.iterations = iterations
+        self.simulations = simulations
+        self.scenarios = scenarios
+        self.rhs = rhs
+        self.wall = wall
+        self.converged = converged
+        self.message = message
+        self.damping = damping
+
+    def apply(self, country: "Country"):
+        """
+        将拟合值写入 country (城市参数为 Constant，K 替换zipf转移函数的系数，保留其倍率)
+        """
+        _Assignment(country, self.parameters, [p.groups(country) for p in self.parameters]).assign(
+            [np.atleast_1d(np.asarray(self.values[p.label], dtype=float)) for p in self.parameters])
+
+    def __str__(self):
+        lines = [f"{self.message}: cost {self.cost:.6g} after {self.iterations} iterations, {self.simulations} batched "
+                 f"simulations ({self.scenarios} scenarios), rhs {self.rhs}, wall {self.wall:.3f} s"]
+        for p in self.parameters:
+            value, err = np.atleast_1d(self.values[p.label]), np.atleast_1d(self.stderr[p.label])
+            if value.size == 1:
+                lines.append(f"    {p.label:<10} {value[0]:12.6g} ± {err[0]:.3g}")
+            else:
+                lines.append(f"    {p.label:<10} {value.size} values in [{value.min():.6g}, {value.max():.6g}]")
+        return '\n'.join(lines)
+
+
+def _residuals(model: "np.ndarray, shape=(B, T, m)", observed: "np.ndarray, shape=(T, m)", mask, loss: "str",
+               unit: "float", weights) -> "np.ndarray, shape=(B, R)":
+    if loss == 'squares':
+        r = model - observed
+    elif loss == 'log':
+        floor = 1. / unit  # 一个人
+        r = np.log(np.maximum(model, 0.) + floor) - np.log(np.maximum(observed, 0.) + floor)
+    elif loss == 'poisson':
+        mu = np.maximum(model * unit, 1e-12)
+        y = np.maximum(observed * unit, 0.)
+        y = np.broadcast_to(y, mu.shape)
+        deviance = 2 * (np.where(y > 0, y * np.log(np.where(y > 0, y, 1.) / mu), 0.) - (y - mu))
+        r = np.sign(y - mu) * np.sqrt(np.maximum(deviance, 0.))
+    else:
+        raise ValueError("loss must be one of 'squares', 'log' and 'poisson'")
+    if weights is not None:
+        r = r * weights
+    return r[:, mask]
+
+
+def calibrate(country: "Country", initials: "np.ndarray, shape=(H, W, 4)", times: "np.ndarray, shape=(T,)",
+              observed: "np.ndarray", parameters: "list(Parameter)", observable: "str" = 'cases',
+              loss: "'squares', 'log' or 'poisson'" = 'squares', unit: "float" = 1e4, weights: "np.ndarray" = None,
+              t0: "float" = 0., step: "float" = 0.1, sampling: "int" = 1,
+              method: "'RK4', 'RK45', 'ROS2' or 'Euler'" = 'RK4', backend: "'vector' or 'fft'" = 'vector',
+              rtol: "float" = 1e-6, atol: "float" = 1e-9, workers: "int" = 1, batch: "int" = None,
+              max_iter: "int" = 50, ftol: "float" = 1e-8, xtol: "float" = 1e-8, gtol: "float" = 1e-10,
+              diff_step: "float" = 1e-7, damping: "float" = 1e-3, max_step: "float" = 1.,
+              warm_start: "Calibration" = None) -> "Calibration":
+    """
+    拟合 parameters 使模型的观测量接近 observed (见模块说明)
+    country, initials: 国家与初始状态 (单个场景)
+    times, observed: 观测时刻与观测值，observed.shape=(T,) 为全国，(T, *country.shape) 为各城市
+    observable: 'S', 'E', 'I', 'R', 'cases' 或 'new_cases'
+    loss: 残差的形式；unit 为状态的单位对应的人数 (默认 1 万人)，用于 log 的下限与 poisson 的计数
+    weights: 能广播到 observed 的残差权重
+    t0, step, sampling, method, backend, rtol, atol, workers: 演化设定，演化区间为 [t0, max(times)]
+    batch: 每次批量模拟的最大场景数，默认不限制
+    max_iter: 最大迭代次数；ftol, xtol, gtol: cost 的相对下降量、参数的变化量与梯度的收敛阈值
+    diff_step: 有限差分的相对步长 (在变换后的参数上)
+    damping: 初始阻尼系数
+    max_step: 每次迭代中变换后的参数的最大变化量 (相对 max(1, |z|))，对数尺度上 1 即至多变化 e 倍，
+        避免远离数据的试探步使模拟溢出 (RK45 的步长随之趋于 0)
+    warm_start: 上一次的 Calibration，从其拟合值与阻尼系数开始 (按 label 对应)
+
+    Return:
+        Calibration
+    """
+    start_clock = time.perf_counter()
+    if getattr(country, 'model', None) is not None:
+        raise ValueError("calibration only supports the extended SEIR model")
+    if observable not in _OBSERVABLES:
+        raise ValueError(f"observable must be one of {', '.join(_OBSERVABLES)}")
+    if backend not in ('vector', 'fft'):
+        raise ValueError("calibration runs batched simulations and requires backend 'vector' or 'fft'")
+    labels = [p.label for p in parameters]
+    if len(set(labels)) != len(labels):
+        raise ValueError("parameter labels must be unique")
+    initials = np.asarray(initials, dtype=float)
+    if initials.shape != (*country.shape, 4):
+        raise ValueError("calibration fits a single scenario, initials must be (H, W, 4)")
+
+    # 观测
+    times = np.asarray(times, dtype=float)
+    observed = np.asarray(observed, dtype=float)
+    national = observed.ndim == 1
+    if not national and observed.shape[1:] != tuple(country.shape):
+        raise ValueError(f"observed must be (T,) or (T, {', '.join(map(str, country.shape))})")
+    observed = observed.reshape(len(times), -1)
+    interval = step * sampling
+    rows = np.round((times - t0) / interval).astype(int)
+    if np.any(rows < 0) or not np.allclose(t0 + rows * interval, times, atol=1e-9 * max(1., np.abs(times).max())):
+        raise ValueError("observation times must lie on the sampling grid t0 + step * sampling * k")
+    if np.any(np.diff(rows) <= 0):
+        raise ValueError("observation times must be increasing")
+    time_span = [t0, t0 + (rows[-1] + 0.5) * interval]
+    mask = np.isfinite(observed)
+    weights = None if weights is None else np.broadcast_to(np.asarray(weights, dtype=float),
+                                                           (len(times), *observed.shape[1:])).reshape(observed.shape)
+    column = _OBSERVABLES[observable]
+
+    def observe(x):
+        x = x.reshape(x.shape[0], -1, 4)
+        value = x[..., column] if column is not None else x[..., 1:].sum(axis=-1)
+        return value.sum(axis=-1, keepdims=True) if national else value
+
+    baseline = observe(initials[None])[0] if column is None else 0.
+
+    # 参数
+    groups = [p.groups(country) for p in parameters]
+    sizes = [len(g) for g in groups]
+    bounds = []
+    z = []
+    previous = {} if warm_start is None else {p.label: p for p in warm_start.parameters}
+    for p, g, size in zip(parameters, groups, sizes):
+        initial = previous[p.label].initial if p.label in previous else p.initial
+        value = p.current(country, g) if initial is None else np.broadcast_to(np.asarray(initial, float), (size,))
+        lo, hi = p.bounds
+        value = np.clip(value, lo, hi)
+        if p.log:
+            if np.any(value <= 0):  # 对数尺度上无法从 0 出发 (如 K = 0 的国家)，应给出正的 initial
+                raise ValueError(f"'{p.label}' must start from a positive value to be fitted on a log scale")
+            lo = np.log(lo) if lo > 0 else -np.inf
+            hi = np.log(hi)
+        z.append(p.transform(value))
+        bounds.append(np.broadcast_to(np.array([lo, hi]), (size, 2)))
+    z = np.concatenate(z)
+    bounds = np.concatenate(bounds)
+    offsets = np.cumsum([0] + sizes)
+    P = z.size
+    lam = damping if warm_start is None else warm_start.damping
+
+    assignment = _Assignment(country, parameters, groups)
+    profile = Profile()
+    integrate = _METHODS[method]
+    counters = {'simulations': 0, 'scenarios': 0}
+
+    def simulate(Z: "np.ndarray, shape=(B, P)") -> "np.ndarray, shape=(B, T, m)":
+        out = []
+        for lo in range(0, len(Z), batch or len(Z)):
+            chunk = Z[lo:lo + (batch or len(Z))]
+            values = [p.inverse(chunk[:, offsets[i]:offsets[i + 1]]) for i, p in enumerate(parameters)]
+            sink = _ObservationSink(rows, observe)
+            assignment.assign(values)
+            try:
+                x0 = np.repeat(initials[None], len(chunk), axis=0)
+                kwargs = dict(sink=sink, profile=profile, workers=workers)
+                if method == 'RK45':
+                    integrate(country, x0, time_span, step, sampling, backend, rtol, atol, **kwargs)
+                else:
+                    integrate(country, x0, time_span, step, sampling, backend, **kwargs)
+            finally:
+                assignment.restore()
+            counters['simulations'] += 1
+            counters['scenarios'] += len(chunk)
+            values = sink.values - baseline
+            if observable == 'new_cases':
+                values = np.diff(values, axis=1, prepend=0.)
+            out.append(values)
+        return np.concatenate(out)
+
+    def residuals(Z):
+        model = simulate(Z)
+        return model, _residuals(model, observed, mask, loss, unit, weights)
+
+    def linearize(z):
+        """
+        当前点与各方向的有限差分合为一次批量模拟，返回 (模型观测量, 残差, Jacobian shape=(R, P))
+        """
+        h = diff_step * np.maximum(1., np.abs(z))
+        h = np.where(z + h > bounds[:, 1], -h, h)  # 上界处向内差分
+        Z = np.vstack([z, z + np.diag(h)])
+        model, r = residuals(Z)
+        return model[0], r[0], ((r[1:] - r[0]) / h[:, None]).T
+
+    model, r, J = linearize(z)
+    cost = 0.5 * r @ r
+    history = [cost]
+    converged, message = False, "maximum number of iterations reached"
+    iterations = 0
+    for iterations in range(1, max_iter + 1):
+        g = J.T @ r
+        if np.max(np.abs(g), initial=0.) <= gtol:
+            converged, message = True, "gradient below gtol"
+            break
+        A = J.T @ J
+        scale = np.diag(A) + 1e-12 * max(np.diag(A).max(initial=0.), 1.)
+        trials = lam * np.array([0.1, 1., 10.])  # 几个阻尼系数的试探步合为一次批量模拟
+        Z = []
+        for l in trials:
+            dz = np.linalg.solve(A + l * np.diag(scale), -g)
+            dz *= min(1., max_step / np.max(np.abs(dz) / np.maximum(1., np.abs(z)), initial=1e-300))
+            Z.append(np.clip(z + dz, bounds[:, 0], bounds[:, 1]))
+        Z = np.array(Z)
+        trial_model, trial_r = residuals(Z)
+        costs = 0.5 * np.einsum('br,br->b', trial_r, trial_r)
+        costs = np.where(np.isfinite(costs), costs, np.inf)
+        best = int(np.argmin(costs))
+        if not costs[best] < cost:
+            lam = trials[-1] * 10
+            if lam > 1e16:
+                converged, message = True, "no further decrease of the cost"
+                break
+            continue
+        dz = Z[best] - z
+        decrease = (cost - costs[best]) / max(cost, 1e-300)
+        z, lam = Z[best], trials[best]
+        model, r, J = linearize(z)
+        cost = 0.5 * r @ r
+        history.append(cost)
+        if decrease < ftol:
+            converged, message = True, "relative decrease of the cost below ftol"
+            break
+        if np.linalg.norm(dz) <= xtol * (np.linalg.norm(z) + xtol):
+            converged, message = True, "parameter change below xtol"
+            break
+
+    # 拟合值与标准误差 (变换后的参数的协方差经 delta 方法换算)
+    dof = max(r.size - P, 1)
+    covariance = np.linalg.pinv(J.T @ J) * (2 * cost / dof)
+    sigma = np.sqrt(np.maximum(np.diag(covariance), 0.))
+    values, stderr, fitted = {}, {}, []
+    for i, p in enumerate(parameters):
+        zi = z[offsets[i]:offsets[i + 1]]
+        value = p.inverse(zi)
+        err = sigma[offsets[i]:offsets[i + 1]] * (value if p.log else 1.)
+        scalar = p.cities is None
+        values[p.label] = float(value[0]) if scalar else value
+        stderr[p.label] = float(err[0]) if scalar else err
+        fitted.append(Parameter(p.name, p.cities, values[p.label], p.bounds, p.log, p.label))
+    shape = (len(times),) if national else (len(times), *country.shape)
+    return Calibration(fitted, values, stderr, float(cost), model.reshape(shape), history, iterations,
+                       counters['simulations'], counters['scenarios'], profile.rhs, time.perf_counter() - start_clock,
+                       converged, message, float(lam))
@@ -0,0 +1,117 @@
+# -*- encoding:utf-8 -*-
+"""
+各求导后端、仓室模型与轨迹格式的等价性检查，运行 python check.py，结果不一致时抛出 AssertionError。
+    check_backends: vector 后端与逐边计算的 python 后端的轨迹一致，批量状态的导数与逐场景计算一致
+    check_tiles: 多线程分块求导 (workers > 1) 与单线程 vector 后端的导数和轨迹一致
+    check_compartments: 与默认引擎等价的 SEIR 仓室模型在各积分方法下的轨迹与报告统计量一致
+    check_compact: .trk 文件以 float64 保存时无损，按城市、人群的延迟读取与边演化边写入的结果一致，
+        量化存储的误差不超过 tolerance
+"""
+import os
+import numpy as np
+
+
+def _initials(shape):
+    initials = np.zeros(shape + (4,))
+    initials[..., 0] = 1000.  # 各城市初始人口为健康的1000万人
+    initials[(2,) * len(shape) + (1,)] += 1e-2  # 投放潜伏者
+    return initials
+
+
+def _close(a, b, rtol=1e-9) -> "float":
+    a, b = np.asarray(a), np.asarray(b)
+    err = np.abs(a - b).max() / max(np.abs(a).max(), 1e-300)
+    assert err <= rtol, f"relative difference {err:.3e} > {rtol:.0e}"
+    return err
+
+
+def check_backends():
+    from simulation import SimCountry
+    from schedules import Piecewise
+    from defaults import zipf_transfer, const_transfer
+    from numerical import VectorDerivative
+    china = SimCountry((5, 6), 100.)
+    china.set_transfer(zipf_transfer(0.05, 2., gate=Piecewise([10.], [1., 0.5])), china.out_edges(1, 1))
+    china.set_transfer(const_transfer(0.01, 0, 0, 0), china.out_edges(3, 4))
+    china.set_parameter('r', Piecewise([5.], [20., 5.]), [(2, 2)])
+    initials = _initials((5, 6))
+    for method in ('Euler', 'RK4'):
+        china.evolute(initials, [0., 30.], method=method, backend='python')
+        serial = np.array(china.track)
+        china.evolute(initials, [0., 30.], method=method)
+        print('vector vs python', method, _close(serial, china.track))
+    status = np.random.default_rng(0).uniform(1., 100., (3, 5, 6, 4))  # 批量状态与逐场景计算一致
+    derivative = VectorDerivative(china)
+    _close(derivative(status, 12.), np.stack([derivative(s, 12.) for s in status]))
+
+
+def check_tiles():
+    from simulation import SimCountry
+    from numerical import VectorDerivative, TiledDerivative
+    rng = np.random.default_rng(0)
+    for options in ({}, {'cutoff': 300.}, {'k_nearest': 5}):
+        china = SimCountry((12, 9), 100., **options)
+        vector = VectorDerivative(china)
+        for workers, tile in ((2, None), (3, 5), (4, 12)):
+            tiled = TiledDerivative(china, workers, tile)
+            for status in (rng.uniform(1., 100., (12, 9, 4)), rng.uniform(1., 100., (3, 12, 9, 4))):
+                _close(vector(status, 4.), tiled(status, 4.), 1e-12)
+    china = SimCountry((10, 10), 100., cutoff=400.)
+    initials = _initials((10, 10))
+    china.evolute(initials, [0., 30.])
+    serial = np.array(china.track)
+    china.evolute(initials, [0., 30.], workers=3)
+    print('tiled vs vector', _close(serial, china.track, 1e-12))
+
+
+def check_compartments():
+    from simulation import SimCountry
+    from defaults import SEIRDefaultParameter as P
+    from compartments import CompartmentModel, Transition, Infection
+    from reducers import report_reducers
+    seir = CompartmentModel(['S', 'E', 'I', 'R'], [Infection('S', 'E', P.r, {'I': P.beta, 'E': P.h}),
+                                                   Transition('E', 'I', P.theta), Transition('I', 'R', P.gamma)])
+    initials = _initials((5, 6))
+    for method, step in (('Euler', 0.1), ('RK4', 0.2), ('RK45', 0.5), ('ROS2', 0.1)):
+        china = SimCountry((5, 6), 100.)
+        china.evolute(initials, [0., 60.], step=step, method=method, reducers=report_reducers())
+        model = SimCountry((5, 6), 100.)
+        model.set_model(seir)
+        model.evolute(initials[..., None, :], [0., 60.], step=step, method=method, reducers=report_reducers())
+        print('compartments vs SEIR', method, _close(china.track, model.track[..., 0, :]))
+        for name in china.summary:
+            a, b = np.asarray(china.summary[name], float), np.asarray(model.summary[name], float)
+            assert np.array_equal(np.isnan(a), np.isnan(b)), name
+            _close(np.nan_to_num(a), np.nan_to_num(b), 1e-9)
+
+
+def check_compact():
+    from simulation import SimCountry
+    from sinks import CompactSink
+    if not os.path.exists("test"):
+        os.mkdir("test")
+    china = SimCountry((8, 7), 100., k_nearest=8)
+    initials = _initials((8, 7))
+    china.evolute(initials, [0., 60.])
+    track = np.array(china.track)
+    china.save('test/check.trk')  # 默认 float64 无损
+    china.load('test/check.trk')
+    assert np.array_equal(np.asarray(china.track), track)
+    assert np.array_equal(china.track[:, 3, 4, 2], track[:, 3, 4, 2])  # 只解压 City_34 的 I 所在的块
+    assert np.array_equal(china.track[5:300:7, [1, 6], :, -1], track[5:300:7][:, [1, 6]][..., -1])
+    batch = np.stack([initials, initials * 1.1])  # 边演化边写入，时间段与城市块不整除
+    china.evolute(batch, [0., 30.], sink=CompactSink('test/check_batch.trk', chunk_time=17, city_chunk=(3, 4),
+                                                     compartment_chunk=3))
+    streamed = np.asarray(china.track)
+    china.evolute(batch, [0., 30.])
+    assert np.array_equal(streamed, china.track)
+    china.save('test/check_lossy.trk', tolerance=1e-6)
+    china.load('test/check_lossy.trk')
+    assert np.abs(np.asarray(china.track) - streamed).max() <= 1e-6
+    print('compact track: lossless round trip')
+
+
+check_backends()
+check_tiles()
+check_compartments()
+check_compact()
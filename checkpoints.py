@@ -0,0 +1,155 @@
+# -*- encoding:utf-8 -*-
+"""
+积分状态的检查点，以及共享前缀的场景树。
+Checkpoint: 某一时刻积分器的全部状态 (时间、状态、RK45 的步长、在线统计量、事件)，可保存到文件，
+    由 SimCountry.evolute(..., resume=checkpoint) 从该时刻继续演化，用于长时间模拟的断点续算；
+    从同一检查点以不同的参数多次继续演化即为分叉。
+Branch, run_tree: 场景树，前缀相同的场景只演化一次，在分叉时刻由检查点分出各分支。
+
+继续演化得到的轨迹只包含检查点之后的采样 (第 checkpoint.sample 个采样起)，与检查点之前的轨迹拼接即为完整轨迹。
+"""
+import copy
+import os
+import pickle
+import numpy as np
+
+
+class Checkpoint(object):
+    """
+    origin, step, sampling -> 演化的起始时刻、步长与采样间隔，继续演化时须与之一致，以保证采样时刻相同
+    method -> str, 积分方法
+    t -> float, 检查点时刻
+    x -> np.ndarray, t 时刻的状态
+    h -> float, RK45 下一步的试探步长，Euler/RK4 为 step
+    index -> int, Euler/RK4 已完成的步数
+    sample -> int, 已写入的采样数，继续演化从第 sample 个采样开始写入
+    initials -> np.ndarray, 初始状态，用于重新初始化事件函数
+    reducers -> list(reducers.Reducer), t 时刻在线统计量的副本
+    hits -> list(dict), 各场景已发生的事件
+    done -> np.ndarray, 各场景终止事件发生的时刻
+    -----------------------------------------------
+    Example:
+
+        china.evolute(initials, [0., 360.], checkpoints=[60.], checkpoint_dir='ckpt')
+        # 中断后
+        china.evolute(initials, [0., 360.], resume='ckpt/checkpoint_60.pkl')
+    """
+    def __init__(self, origin, step, sampling, method, t, x, h, index, sample, initials, reducers=(),
+                 hits=None, done=None):
+        self.origin = origin
+        self.step = step
+        self.sampling = sampling
+        self.method = method
+        self.t = t
+        self.x = x.copy()
+        self.h = h
+        self.index = index
+        self.sample = sample
+        self.initials = initials.copy()
+        self.reducers = copy.deepcopy(list(reducers))
+        self.hits = copy.deepcopy(hits)
+        self.done = None if done is None else done.copy()
+
+    def check(self, time_span: "list[float, float]", step: "float", sampling: "int", method: "str"):
+        """
+        检查继续演化的设定与检查点一致
+        """
+        if method != self.method:
+            raise ValueError(f"checkpoint was taken by {self.method}, cannot resume with {method}")
+        if not (np.isclose(time_span[0], self.origin) and np.isclose(step, self.step) and sampling == self.sampling):
+            raise ValueError("resume needs the time_span[0], step and sampling of the checkpointed run")
+        if time_span[1] < self.t:
+            raise ValueError("time_span ends before the checkpoint")
+
+    def restore_reducers(self) -> "list(reducers.Reducer)":
+        """
+        在线统计量的独立副本，同一检查点的各分支互不影响
+        """
+        return copy.deepcopy(self.reducers)
+
+    def save(self, filename: "str"):
+        """
+        先写入临时文件再替换，写入过程中断不会损坏已有的检查点
+        """
+        tmp = filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(self, f)
+        os.replace(tmp, filename)
+
+    @staticmethod
+    def load(filename: "str") -> "Checkpoint":
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+
+
+class Branch(object):
+    """
+    场景树的节点
+    setup -> callable(country), 设置该分支的参数与转移函数 (如 country.set_parameter)，该分支开始演化前调用
+    until -> float, 该分支演化到 until 时刻后分叉为 children；叶子节点为 None，演化到 time_span[1]
+    children -> list(Branch)
+    name -> 叶子节点的名字，作为 run_tree 结果的键
+
+    各分支从 time_span[0] 起使用同一时间轴，setup 中的 Piecewise 等参数按绝对时间取值，
+    因此叶子节点可以直接使用完整场景的参数，其祖先节点只需在 [time_span[0], until) 内与之一致。
+    分叉发生在父分支所有求导时刻都早于 until 的最后时刻 (Euler/RK4 为 until 之前的步，RK45 为 until 之前极近处)，
+    因而在 until 时刻突变的参数 (如 Piecewise([until], ...)) 只作用于子分支，Euler/RK4 的结果与单独演化完全一致。
+    """
+    def __init__(self, setup, until: "float" = None, children: "list(Branch)" = (), name=None):
+        if (until is None) != (len(children) == 0):
+            raise ValueError("a branch splits at 'until' if and only if it has children")
+        self.setup = setup
+        self.until = until
+        self.children = list(children)
+        self.name = name
+
+
+def run_tree(country: "SimCountry", initials: "np.ndarray", time_span: "list[float, float]", root: "Branch",
+             reducers: "list(reducers.Reducer)" = (), **kwargs) -> "dict":
+    """
+    演化场景树，每段共享的前缀只演化一次。kwargs 为 SimCountry.evolute 的其余参数 (step, sampling, method, backend 等)，
+    轨迹保存在内存中 (sink 为默认值)。
+    Return:
+        dict, 叶子名 -> (time, track, summary)，time 与 track 为完整轨迹，summary 为该场景的在线统计量
+    ---------------------------------------------------------------
+    Example:
+
+        never = Branch(lambda c: c.set_parameter('r', Piecewise([10000.], [20., 3.])), name='never')
+        lock = Branch(lambda c: c.set_parameter('r', Piecewise([10.], [20., 3.])), name='lock_10')
+        root = Branch(never.setup, until=10., children=[lock, never])
+        results = run_tree(china, initials, [0., 360.], root)
+    """
+    results = {}
+    segments = [(root, None, [], [])]  # (节点, 检查点, 之前的时间段, 之前的轨迹段)
+    while segments:
+        node, checkpoint, times, tracks = segments.pop()
+        node.setup(country)
+        end = time_span[1] if node.until is None else node.until
+        fork = () if node.until is None else [_fork_time(node.until, time_span[0], **kwargs)]
+        country.evolute(initials, [time_span[0], end], resume=checkpoint, checkpoints=fork, reducers=reducers,
+                        **kwargs)
+        if node.until is None:
+            results[node.name] = (np.concatenate(times + [country.time]),
+                                  np.concatenate(tracks + [country.track], axis=_time_axis(country, initials)),
+                                  country.summary)
+            continue
+        child = country.checkpoints[-1]
+        n = child.sample - (0 if checkpoint is None else checkpoint.sample)  # 不含分叉时刻之后的采样
+        track = country.track[:, :n] if _time_axis(country, initials) else country.track[:n]
+        for branch in reversed(node.children):
+            segments.append((branch, child, times + [country.time[:n]], tracks + [track]))
+    return results
+
+
+def _fork_time(until: "float", origin: "float", step: "float" = 0.1, method: "str" = "RK4", **kwargs) -> "float":
+    """
+    父分支的所有求导时刻都严格早于 until 的最后时刻
+    """
+    if method == "RK45":
+        return until - 1e-9 * max(1., abs(until))
+    n = np.ceil((until - origin) / step - 1e-9) - 1  # 最后一步 [n - 1, n] 的终点早于 until
+    return origin + step * max(n, 0)
+
+
+def _time_axis(country, initials):
+    return 1 if initials.ndim == len(country.shape) + len(country.stateShape) + 1 else 0
@@ -0,0 +1,333 @@
+# -*- encoding:utf-8 -*-
+"""
+一般的仓室模型。扩展SEIR方程固定为 S, E, I, R 4 个仓室，此处以声明的方式给出任意的仓室、仓室间的转移、分层 (如年龄组)
+之间的接触矩阵与各仓室的迁移倍率，编译为对状态 shape=(H, W, A, C) (A 个分层、C 个仓室；网络国家为 (n, A, C)，
+批量模拟时前面另有 B) 的向量化导数，每次导数计算只有固定几次数组运算，没有逐仓室、逐分层的 Python 代码：
+    Transition(source, target, rate): 一阶转移，各分层的流量为 rate * X_source
+    Infection(source, target, rate, infectivity): 接触传染，分层 a 的流量为
+        rate[a] * X_source[a] * sum_b(contacts[a, b] * Y[b] / N[b]),  Y = sum_c(infectivity[c] * X_c)
+        contacts 为 None 时各分层均匀混合，即 rate[a] * X_source[a] * sum_b(Y[b]) / sum_b(N[b])
+    N 为计入人口的仓室 (population，默认为全部仓室) 之和
+速率可以是数、各分层的数组 shape=(A,)、各城市各分层的数组 shape=(n, A)，或声明式参数 (schedules.Constant/Piecewise，
+批量模拟时可以是 shape=(B,) 的数组，见schedules.py)。
+城市间迁移沿用国家的 zipf 与线性转移函数 (见defaults.py)，仓室 c 的迁移量乘以 mobility[c] (如住院与死亡为 0)，
+zipf 迁移中的人口为 N。恒定迁移、自定义的转移函数与扰动项只适用于SEIR模型，City 的SEIR参数不再使用。
+
+仓室按 groups 归入 S/E/I/R (未给出时按名称首字母，其余仓室归入 R)，在线统计量 (reducers.py)、事件 (events.py)、
+vision 的动画与报告使用对分层求和的 SEIR 视图 (seir)，感染速率为所有 Infection 的流量之和；国家与各城市的曲线按仓室绘制。
+Euler, RK4, RK45 与 ROS2 均可使用，导数后端只能为 vector (workers=1)；ROS2 的 Jacobian 中每个城市为 (A*C, A*C) 的分块。
+---------------------------------------------------------------
+Example:
+
+    seird = CompartmentModel(['S', 'E', 'I', 'R', 'D'], [
+        Infection('S', 'E', 20., {'I': 0.048, 'E': 0.048}),
+        Transition('E', 'I', 0.1),
+        Transition('I', 'R', 0.099),
+        Transition('I', 'D', 0.001)], mobility={'D': 0.}, population=['S', 'E', 'I', 'R'])
+    china.set_model(seird)
+    initials = seird.initials(china, 1000., {(2, 2): {'E': 1e-4}})
+    china.evolute(initials, [0., 360.])
+
+    # 5 个年龄组、接种与住院
+    model = CompartmentModel(['S', 'V', 'E', 'I', 'H', 'R', 'D'], [
+        Infection('S', 'E', 0.5, {'I': 1.}), Infection('V', 'E', 0.1, {'I': 1.}),
+        Transition('S', 'V', Piecewise([30.], [0., 0.01])),
+        Transition('E', 'I', 0.2), Transition('I', 'H', [0.001, 0.002, 0.005, 0.02, 0.05]),
+        Transition('I', 'R', 0.1), Transition('H', 'R', 0.05), Transition('H', 'D', [0., 0., 0.001, 0.005, 0.02])],
+        strata=['0-17', '18-39', '40-59', '60-79', '80+'], contacts=contact_matrix,
+        mobility={'H': 0., 'D': 0.}, population=['S', 'V', 'E', 'I', 'H', 'R'], groups={'S': ['S', 'V']})
+"""
+import numpy as np
+from numerical import VectorDerivative, _Jacobian, _multiplier
+from profiling import DISABLED
+
+
+class Transition(object):
+    """
+    source -> target 的一阶转移，各分层的流量为 rate * X_source
+    """
+    kind = 'transition'
+
+    def __init__(self, source: "str", target: "str", rate):
+        self.source = source
+        self.target = target
+        self.rate = rate
+
+
+class Infection(object):
+    """
+    source -> target 的接触传染 (见模块说明)
+    infectivity -> dict, 传染源仓室 -> 相对传染性，如 {'I': 1., 'E': 0.5}
+    """
+    kind = 'infection'
+
+    def __init__(self, source: "str", target: "str", rate, infectivity: "dict"):
+        self.source = source
+        self.target = target
+        self.rate = rate
+        self.infectivity = dict(infectivity)
+
+
+class CompartmentModel(object):
+    """
+    compartments -> list(str), 仓室名称，第 0 个为易感仓室 (initials 中初始人口所在的仓室)
+    transitions -> list(Transition or Infection), 仓室间的转移
+    strata -> list(str) or int, 分层名称或分层数，默认不分层
+    contacts -> np.ndarray, shape=(A, A), 分层间的接触矩阵，contacts[a, b] 为分层 a 与分层 b 的接触率，None 为均匀混合
+    mobility -> dict, 仓室 -> 迁移倍率，未给出的仓室为 1
+    population -> list(str), 计入人口 N 的仓室，默认为全部仓室
+    groups -> dict, 'S'/'E'/'I'/'R' -> 归入该组的仓室列表，未给出的仓室按名称首字母归组，其余归入 R
+    shape -> (A, C), 每个城市的状态形状
+    """
+    def __init__(self, compartments: "list(str)", transitions: "list", strata=1, contacts: "np.ndarray" = None,
+                 mobility: "dict" = None, population: "list(str)" = None, groups: "dict" = None):
+        self.compartments = list(compartments)
+        self.transitions = list(transitions)
+        self.strata = [f"group{k}" for k in range(strata)] if isinstance(strata, int) else list(strata)
+        self.contacts = None if contacts is None else np.asarray(contacts, dtype=float)
+        self.mobility = dict(mobility or {})
+        self.population = list(self.compartments if population is None else population)
+        self.groups = dict(groups or {})
+        self.shape = (len(self.strata), len(self.compartments))
+        if len(set(self.compartments)) != len(self.compartments):
+            raise ValueError("compartment names must be unique")
+        if self.contacts is not None and self.contacts.shape != (self.shape[0],) * 2:
+            raise ValueError(f"contacts must be a {self.shape[0]}x{self.shape[0]} matrix")
+        self.seir_matrix()
+
+    def _index(self, names) -> "list(int)":
+        unknown = [name for name in names if name not in self.compartments]
+        if unknown:
+            raise ValueError(f"unknown compartments: {', '.join(map(str, unknown))}")
+        return [self.compartments.index(name) for name in names]
+
+    def seir_matrix(self) -> "np.ndarray, shape=(C, 4)":
+        """
+        各仓室所属的 S/E/I/R 组
+        """
+        assigned = {}
+        for group, names in self.groups.items():
+            if group not in 'SEIR' or len(group) != 1:
+                raise ValueError("groups must be keyed by 'S', 'E', 'I' or 'R'")
+            for c in self._index(names):
+                assigned[c] = 'SEIR'.index(group)
+        matrix = np.zeros((self.shape[1], 4))
+        for c, name in enumerate(self.compartments):
+            first = name[0].upper()
+            matrix[c, assigned.get(c, 'SEIR'.index(first) if first in 'SEI' else 3)] = 1.
+        return matrix
+
+    def vector(self, values: "dict", default: "float") -> "np.ndarray, shape=(C,)":
+        """
+        仓室 -> 数值 的字典转换为各仓室的数组，未给出的仓室为 default
+        """
+        vector = np.full(self.shape[1], default)
+        vector[self._index(values)] = list(values.values())
+        return vector
+
+    def seir(self, x: "np.ndarray, shape=(..., A, C)") -> "np.ndarray, shape=(..., 4)":
+        """
+        对分层与各组仓室求和的 S, E, I, R
+        """
+        return (x @ self.seir_matrix()).sum(axis=-2)
+
+    def derivative(self, country: "Country") -> "ModelDerivative":
+        return ModelDerivative(country, self)
+
+    def initials(self, country: "Country", population, seeds: "dict" = None) -> "np.ndarray, shape=(H, W, A, C)":
+        """
+        初始状态：各城市各分层的人口 population (万人，能广播到 shape=(H, W, A) 的数组，如各年龄组的人口)
+        全部位于第 0 个仓室；seeds 为 城市位置 (i, j) 或网络国家的编号 -> {仓室: 人数}，人数能广播到 shape=(A,)，
+        加到该城市的对应仓室上
+        """
+        initials = np.zeros((*country.shape, *self.shape))
+        initials[..., 0] = population
+        for pos, amounts in (seeds or {}).items():
+            pos = tuple(np.atleast_1d(pos))
+            for name, amount in amounts.items():
+                initials[pos + (slice(None), self._index([name])[0])] += amount
+        return initials
+
+
+class _Rates(object):
+    """
+    一组转移的速率，求值结果 shape=(..., n or 1, A, T)，声明式参数每次只求值一次
+    """
+    def __init__(self, rates: "list", n: "int", A: "int"):
+        rows = n if any(not hasattr(r, 'at') and np.ndim(r) == 2 for r in rates) else 1
+        self.static = np.zeros((rows, A, len(rates)))
+        self.dynamic = []
+        for k, rate in enumerate(rates):
+            if hasattr(rate, 'at'):
+                self.dynamic.append((k, rate))
+                continue
+            value = np.asarray(rate, dtype=float)
+            if value.ndim > 2 or (value.ndim >= 1 and value.shape[-1] != A) or (value.ndim == 2 and len(value) != n):
+                raise ValueError(f"rates must be scalars, shape=({A},) or shape=({n}, {A}) arrays or schedules")
+            self.static[..., k] = value
+        if not self.dynamic:
+            self.values = self.static
+
+    def __call__(self, t: "float") -> "np.ndarray":
+        if not self.dynamic:
+            return self.values
+        values = [np.asarray(rate.at(t), dtype=float) for _, rate in self.dynamic]
+        lead = np.broadcast_shapes(*[v.shape for v in values])
+        rates = np.array(np.broadcast_to(self.static, lead + self.static.shape))
+        for (k, _), value in zip(self.dynamic, values):
+            rates[..., k] = np.reshape(value, value.shape + (1, 1))
+        return rates
+
+
+class ModelDerivative(VectorDerivative):
+    """
+    仓室模型的向量化导数，status.shape=(H, W, A, C) 或 (B, H, W, A, C)。
+    转移编译为源仓室下标与关联矩阵 (T, C)，流量 shape=(..., n, A, T) 乘以关联矩阵即为导数；
+    Infection 的传染源为状态与传染性矩阵 (C, I) 的乘积，分层间的作用为接触矩阵的乘法。
+    迁移与 VectorDerivative 相同 (zipf 与线性迁移的权重矩阵)，各仓室乘以迁移倍率。
+    编译后修改 model 或 country 不会生效，需要重新构造
+    """
+    def __init__(self, country: "Country", model: "CompartmentModel"):
+        self.shape = tuple(country.shape)
+        self.model = model
+        self.parameters = {}
+        self.disturbances = []
+        if any(getattr(c.nu, 'kind', None) != 'zero' for c in country.all_cities()):
+            raise ValueError("compartment models do not support disturbances")
+        self._compile_traffic(country)
+        if self.const or self.callTraffic:
+            raise ValueError("compartment models only support zipf and linear transfers")
+        A, C = model.shape
+        n = country.size
+        self.mobility = np.tile(model.vector(model.mobility, 1.), A)  # shape=(A*C,)
+        self.mobile = np.flatnonzero(self.mobility)  # 迁移只计算会迁移的变量
+        self.counted = model.vector(dict.fromkeys(model.population, 1.), 0.)
+        self.countedFlat = np.tile(self.counted, A)
+        self.contacts = model.contacts
+
+        first = [tr for tr in model.transitions if tr.kind == 'transition']
+        infections = [tr for tr in model.transitions if tr.kind == 'infection']
+        self.firstSource, self.firstIncidence = self._incidence(first)
+        self.firstRates = _Rates([tr.rate for tr in first], n, A)
+        self.infSource, self.infIncidence = self._incidence(infections)
+        self.infRates = _Rates([tr.rate for tr in infections], n, A)
+        self.infectivity = np.zeros((C, len(infections)))  # 传染性矩阵
+        for i, tr in enumerate(infections):
+            self.infectivity[model._index(tr.infectivity), i] = list(tr.infectivity.values())
+        # Jacobian 用: D[t, r, c] = incidence[t, r] * (c == source_t)
+        self.firstDelta = self.firstIncidence[:, :, None] * np.eye(C)[self.firstSource][:, None, :]
+        self.infDelta = self.infIncidence[:, :, None] * np.eye(C)[self.infSource][:, None, :]
+
+    def _incidence(self, transitions: "list") -> "(source, incidence)":
+        index = self.model._index
+        source = np.array(index([tr.source for tr in transitions]), dtype=np.intp)
+        incidence = np.zeros((len(transitions), self.model.shape[1]))
+        incidence[np.arange(len(transitions)), source] -= 1.
+        incidence[np.arange(len(transitions)), index([tr.target for tr in transitions])] += 1.
+        return source, incidence
+
+    def _state(self, status: "np.ndarray") -> "np.ndarray, shape=(..., n, A, C)":
+        return status.reshape(*status.shape[:status.ndim - len(self.shape) - 2], -1, *self.model.shape)
+
+    def _force(self, x: "np.ndarray, shape=(..., n, A, C)") -> "(Y, N, ratio, force)":
+        """
+        传染源 Y, shape=(..., n, A, I)、人口 N, shape=(..., n, A) 与各分层的感染力 force, shape=(..., n, A, I)
+        """
+        Y = x @ self.infectivity
+        N = x @ self.counted
+        if self.contacts is None:
+            total = N.sum(axis=-1)[..., None, None]
+            ratio = np.divide(Y.sum(axis=-2, keepdims=True), total, out=np.zeros(Y.shape[:-2] + (1, Y.shape[-1])),
+                              where=total > 0)
+            return Y, N, ratio, np.broadcast_to(ratio, Y.shape)
+        ratio = np.divide(Y, N[..., None], out=np.zeros_like(Y), where=N[..., None] > 0)
+        return Y, N, ratio, self.contacts @ ratio
+
+    def _infections(self, x: "np.ndarray, shape=(..., n, A, C)", t: "float") -> "np.ndarray, shape=(..., n, A, I)":
+        return self.infRates(t) * x[..., self.infSource] * self._force(x)[3]
+
+    def __call__(self, status: "np.ndarray, shape=(H, W, A, C) or (B, H, W, A, C)", t: "float") -> "np.ndarray":
+        clock = self._clock
+        timed = clock is not DISABLED
+        x = self._state(status)
+        rates = self.firstRates(t)
+        if timed:
+            clock.lap('parameters')
+
+        # 1. 仓室间的转移
+        der = (rates * x[..., self.firstSource]) @ self.firstIncidence
+        if self.infSource.size:
+            der += self._infections(x, t) @ self.infIncidence
+        if timed:
+            clock.lap('seir')
+
+        # 2. 城市间迁移
+        flat = x.reshape(*x.shape[:-2], -1)  # shape=(..., n, A*C)
+        out = der.reshape(flat.shape)
+        N = flat @ self.countedFlat
+        mobile, mobility = self.mobile, self.mobility[self.mobile]
+        moving = flat[..., mobile]
+        for transfer, weight in self.zipf:
+            g = _multiplier(transfer, t)
+            if np.any(g != 0):
+                out[..., mobile] += g * mobility * weight.migration(moving, N)
+        for transfer, weight, rate in self.linear:
+            g = _multiplier(transfer, t)
+            if np.any(g != 0):
+                out[..., mobile] += g * mobility * (weight.inflow(moving) - moving * rate[:, None])
+        if timed:
+            clock.lap('migration')
+        return der.reshape(status.shape)
+
+    def infection(self, status: "np.ndarray, shape=(H, W, A, C) or (B, H, W, A, C)", t: "float") -> "np.ndarray":
+        """
+        各城市所有 Infection 的流量之和, shape=status.shape[:-2]，用于累计感染人数 (见reducers.py)
+        """
+        x = self._state(status)
+        if not self.infSource.size:
+            return np.zeros(status.shape[:-2])
+        return self._infections(x, t).sum(axis=(-2, -1)).reshape(status.shape[:-2])
+
+    def jacobian(self, status: "np.ndarray, shape=(H, W, A, C) or (B, H, W, A, C)", t: "float") -> "_Jacobian":
+        """
+        t 时刻在 status 处的稀疏 Jacobian (见numerical._Jacobian)，每个城市的分块为 (A*C, A*C)。
+        感染只保留易感仓室减少的一侧，对目标仓室的增益由 ROS2 显式处理
+        """
+        x = self._state(status)
+        A, C = self.model.shape
+        # 各分层内：一阶转移与感染流量对易感仓室的偏导数
+        blocks = np.einsum('...at,trc->...arc', self.firstRates(t), self.firstDelta)
+        if self.infSource.size:
+            Y, N, ratio, force = self._force(x)
+            beta = self.infRates(t)
+            blocks = blocks + np.einsum('...ai,irc->...arc', beta * force, np.minimum(self.infDelta, 0.))
+        blocks = np.broadcast_to(blocks, x.shape[:-2] + (A, C, C))
+        local = np.einsum('...arc,ab->...arbc', blocks, np.eye(A))
+        if self.infSource.size:
+            # 感染力对传染源与人口的偏导数，在分层间耦合
+            amp = beta * x[..., self.infSource]
+            loss = np.minimum(self.infIncidence, 0.)
+            if self.contacts is None:
+                total = N.sum(axis=-1)[..., None, None]
+                inner = np.divide(self.infectivity.T - ratio[..., 0, :, None] * self.counted, total,
+                                  out=np.zeros(x.shape[:-2] + (len(self.infSource), C)), where=total > 0)
+                local += np.einsum('...ai,...ic,ir->...arc', amp, inner, loss)[..., None, :]
+            else:
+                inner = np.divide(self.infectivity.T - ratio[..., None] * self.counted, N[..., None, None],
+                                  out=np.zeros(N.shape + self.infectivity.T.shape), where=N[..., None, None] > 0)
+                local += np.einsum('...ai,ab,...bic,ir->...arbc', amp, self.contacts, inner, loss,
+                                   optimize=True)
+        K = A * C
+        flat = x.reshape(*x.shape[:-2], K)
+        migration = []
+        for transfer, weight in self.zipf:
+            g = _multiplier(transfer, t)
+            if np.any(g != 0):
+                migration.append((g, weight))
+        linear = []
+        for transfer, weight, out in self.linear:
+            g = _multiplier(transfer, t)
+            if np.any(g != 0):
+                linear.append((g, weight, out))
+        return _Jacobian(local.reshape(*x.shape[:-2], K, K), flat, flat @ self.countedFlat, migration, linear,
+                         self.mobility, self.countedFlat)
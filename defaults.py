@@ -3,11 +3,13 @@
 默认参数和参数函数设定，包含：
 SEIR参数：r, beta, h, theta, gamma
 用于初始化kernel.City对象的常函数：const_parameter(), zero_disturbance
-用于初始化kernel.Traffic对象的常函数和zipf函数：const_transfer(), zipf_transfer()
+用于初始化kernel.Traffic对象的常函数、zipf函数与线性函数：const_transfer(), zipf_transfer(), linear_transfer()
 
-用户可依据这些模板自定义参数函数
+用户可依据这些模板自定义参数函数。模板返回 schedules.py 中的声明式对象，numerical.VectorDerivative 据此将其向量化计算，
+随时间变化的参数可使用 schedules.Piecewise；普通的自定义函数仍可使用，但只能逐城市/逐条边调用。
 """
 import numpy as np
+from schedules import Constant, ConstTransfer, ZipfTransfer, LinearTransfer
 
 MIN_DISTANCE = 100  # 最小城市间距，单位:km
 
@@ -20,31 +22,29 @@ class SEIRDefaultParameter(object):
     gamma = 0.1
 
 
-def const_transfer(S=0., E=0., I=0., R=0.):
+def const_transfer(S=0., E=0., I=0., R=0., gate=None):
     """
     用于初始化 Traffic().transfer
-    常函数，返回从start城市到end城市SEIR迁移人口
+    常函数，返回从start城市到end城市SEIR迁移人口，gate 为可选的随时间变化的倍率 (见schedules.py)
     """
-    def transfer(start_status: "np.ndarray, shape=(4,)", end_status: "np.ndarray, shape=(4,)",
-                 t: "float", distance: "float") -> "np.ndarray, shape=(4,)":
-        return np.array([S, E, I, R])
+    return ConstTransfer(S, E, I, R, gate)
 
-    return transfer
 
-
-def zipf_transfer(K=0.04, alpha=2.):
+def zipf_transfer(K=0.04, alpha=2., gate=None):
     """
     用于初始化 Traffic().transfer
-    zipf人口迁移函数，返回从start城市到end城市SEIR迁移人口
+    zipf人口迁移函数，返回从start城市到end城市SEIR迁移人口，gate 为可选的随时间变化的倍率 (见schedules.py)
     """
-    def transfer(start_status: "np.ndarray, shape=(4,)", end_status: "np.ndarray, shape=(4,)",
-                 t: "float", distance: "float") -> "np.ndarray, shape=(4,)":
-        Ns = start_status.sum()
-        Ne = end_status.sum()
-        Nt = K * Ns * Ne / distance ** alpha
-        return Nt / Ns * start_status
+    return ZipfTransfer(K, alpha, gate)
+
 
-    return transfer
+def linear_transfer(rate=1., gate=None):
+    """
+    用于初始化 Traffic().transfer
+    线性迁移函数，从start城市到end城市的SEIR迁移人口为 rate * 边的权重 * start城市的SEIR人口 (见schedules.LinearTransfer)，
+    gate 为可选的随时间变化的倍率
+    """
+    return LinearTransfer(rate, gate)
 
 
 def const_parameter(p):
@@ -52,10 +52,7 @@ def const_parameter(p):
     用于初始化 City().r/beta/h/theta/gamma
     返回某时刻某SEIR状态下的参数值，此处为常数
     """
-    def parameter(status: "np.ndarray, shape=(4,)", t: "float") -> "float":
-        return p
-
-    return parameter
+    return Constant(p)
 
 
 def zero_disturbance(t: "float") -> "np.ndarray, shape=(4,)":
@@ -64,3 +61,7 @@ def zero_disturbance(t: "float") -> "np.ndarray, shape=(4,)":
     返回某时刻下对SEIR的外部扰动
     """
     return np.zeros(4, dtype=float)
+
+
+zero_disturbance.kind = 'zero'
+zero_disturbance.args = ()
@@ -0,0 +1,75 @@
+# -*- encoding:utf-8 -*-
+"""
+自适应步长积分 (numerical.RK45) 的事件函数。
+事件函数 g(t, x, dxdt) 中 x 与 dxdt 的形状为 (B, H*W, 4)，B 为批量模拟的场景数 (非批量模拟时为 1)，
+返回 shape=(B,) 的数组。积分过程中 g 变号的时刻即为事件发生时刻，由稠密输出插值精确定位。
+peak_event: 全国某一人群 (默认 I) 达到峰值
+fraction_event: 全国某一人群 (默认 S) 降至初值的一定比例
+extinction_event: 全国 E + I 降至阈值以下，默认终止积分
+"""
+import numpy as np
+
+
+class Event(object):
+    """
+    func -> functional, g(t, x, dxdt) -> np.ndarray, shape=(B,), x 与 dxdt 的形状为 (B, H*W, 4)
+    terminal -> bool, 事件发生后是否终止积分
+    direction -> int, 0 表示任意方向的变号均触发，1 表示仅由负变正时触发，-1 表示仅由正变负时触发
+    name -> str, 事件名，作为 SimCountry.events 的键
+    -----------------------------------------------
+    Example:
+
+        event = Event(lambda t, x, dxdt: x[..., 3].sum(axis=1) - 5000., name='R_5000')
+        china.evolute(initials, [0., 360.], method='RK45', events=[event])
+        print(china.events['R_5000'])
+    """
+    def __init__(self, func, terminal: "bool" = False, direction: "int" = 0, name: "str" = None):
+        self.func = func
+        self.terminal = terminal
+        self.direction = direction
+        self.name = name if name is not None else getattr(func, '__name__', 'event')
+
+    def initialize(self, initials: "np.ndarray, shape=(B, H*W, 4)"):
+        """
+        积分开始前调用，可用于记录初值
+        """
+        pass
+
+    def __call__(self, t: "float", x: "np.ndarray", dxdt: "np.ndarray") -> "np.ndarray, shape=(B,)":
+        return self.func(t, x, dxdt)
+
+
+class _FractionEvent(Event):
+    def __init__(self, compartment, fraction, terminal, name):
+        super().__init__(self._fraction, terminal, -1, name)
+        self.compartment = compartment
+        self.fraction = fraction
+        self.initial = None
+
+    def initialize(self, initials):
+        self.initial = initials[..., self.compartment].sum(axis=1)
+
+    def _fraction(self, t, x, dxdt):
+        return x[..., self.compartment].sum(axis=1) - self.fraction * self.initial
+
+
+def peak_event(compartment: "int" = 2, terminal: "bool" = False, name: "str" = "I_max") -> "Event":
+    """
+    全国 compartment 人群的峰值，即其导数由正变负的时刻
+    """
+    return Event(lambda t, x, dxdt: dxdt[..., compartment].sum(axis=1), terminal, -1, name)
+
+
+def fraction_event(compartment: "int" = 0, fraction: "float" = 0.5, terminal: "bool" = False,
+                   name: "str" = "S_50") -> "Event":
+    """
+    全国 compartment 人群降至初值的 fraction 倍的时刻
+    """
+    return _FractionEvent(compartment, fraction, terminal, name)
+
+
+def extinction_event(threshold: "float" = 1e-4, terminal: "bool" = True, name: "str" = "extinction") -> "Event":
+    """
+    全国 E + I 降至 threshold 以下的时刻，默认终止积分。单位同 initials (万人)
+    """
+    return Event(lambda t, x, dxdt: x[..., 1:3].sum(axis=(1, 2)) - threshold, terminal, -1, name)
@@ -4,6 +4,9 @@
 City: Node, 包含人口、SEIR函数参数、入城和出城交通信息
 Traffic: directed Edge, 连接两个City对象，包含距离和转移函数信息
 Country: directed Graph, City 和 Traffic 对象的集合，以格点地图的方式将 City 对象组织起来
+
+Country 内部以连续数组存储图结构 (起点、终点、距离、转移函数编号以及CSR格式的入城/出城邻接表)，
+country.traffic 与 city.inPaths/outPaths 中的 Traffic 对象只是这些数组的视图，按需生成。
 """
 import numpy as np
 from defaults import SEIRDefaultParameter, const_transfer, zipf_transfer, const_parameter, zero_disturbance
@@ -40,8 +43,26 @@ class City(object):
         self.gamma = gamma
         self.nu = nu
         self.pos = pos
-        self.inPaths = []
-        self.outPaths = []
+        self.country = None  # 所属的 Country，由 Country 初始化时设置
+        self.index = None  # 城市在 Country 中的展平编号
+        self._inPaths = []
+        self._outPaths = []
+
+    @property
+    def inPaths(self) -> "list(Traffic)":
+        if self.country is None:
+            return self._inPaths
+        country = self.country
+        edges = country.inEdges[country.inPtr[self.index]:country.inPtr[self.index + 1]]
+        return [country.traffic[e] for e in edges]
+
+    @property
+    def outPaths(self) -> "list(Traffic)":
+        if self.country is None:
+            return self._outPaths
+        country = self.country
+        edges = country.outEdges[country.outPtr[self.index]:country.outPtr[self.index + 1]]
+        return [country.traffic[e] for e in edges]
 
 
 class Traffic(object):
@@ -66,24 +87,170 @@ class Traffic(object):
         self.flux = np.zeros(4, dtype=float)
 
 
+class TrafficView(Traffic):
+    """
+    Country 中第 index 条边的视图，属性读写直接作用于 Country 的边数组
+    """
+    def __init__(self, country: "Country", index: "int"):
+        self.country = country
+        self.index = index
+
+    @property
+    def start(self) -> "City":
+        return self.country.city(self.country.edgeStart[self.index])
+
+    @property
+    def end(self) -> "City":
+        return self.country.city(self.country.edgeEnd[self.index])
+
+    @property
+    def distance(self) -> "float":
+        return self.country.edgeDistance[self.index]
+
+    @property
+    def weight(self) -> "float":
+        return self.country.edgeWeight[self.index]
+
+    @property
+    def transfer(self):
+        return self.country.transfers[self.country.edgeTransfer[self.index]]
+
+    @transfer.setter
+    def transfer(self, transfer):
+        self.country.set_transfer(transfer, [self.index])
+
+    @property
+    def flux(self) -> "np.ndarray, shape=(4,)":
+        return self.country.flux[self.index]
+
+    @flux.setter
+    def flux(self, flux):
+        self.country.flux[self.index] = flux
+
+
+class TrafficList(object):
+    """
+    country.traffic，按需生成 TrafficView 的只读序列
+    """
+    def __init__(self, country: "Country"):
+        self.country = country
+
+    def __len__(self):
+        return self.country.edgeStart.size
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [TrafficView(self.country, e) for e in range(len(self))[item]]
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError("traffic index out of range")
+        return TrafficView(self.country, int(item))
+
+    def __iter__(self):
+        for e in range(len(self)):
+            yield TrafficView(self.country, e)
+
+
+def _all_pairs(n: "int") -> "(start, end)":
+    """
+    全连接图的所有有序城市对，按出发城市、到达城市的顺序排列，直接构造 int32 数组，不经过 n x n 的掩码
+    """
+    start = np.repeat(np.arange(n, dtype=np.int32), n - 1)
+    end = np.tile(np.arange(n - 1, dtype=np.int32), n)
+    end += end >= start  # 跳过自环
+    return start, end
+
+
+def _all_pairs_in_edges(n: "int") -> "np.ndarray(int32)":
+    """
+    全连接图的入城邻接表：到达城市 b 的边按出发城市 a 排列，边 (a, b) 的编号为 a * (n - 1) + b - (a < b)
+    """
+    b = np.repeat(np.arange(n, dtype=np.int64), n - 1)
+    a = np.tile(np.arange(n - 1, dtype=np.int64), n)
+    a += a >= b
+    return (a * (n - 1) + b - (a < b)).astype(np.int32)
+
+
+GRAPH_ARRAYS = ('edgeStart', 'edgeEnd', 'edgeDistance', 'edgeWeight', 'outEdges', 'outPtr', 'inEdges', 'inPtr')
+
+
 class Country(object):
     """
     Graph
     minDistance -> float, 格点间最小距离，晶胞单位(km)
     shape -> tuple(int, int), 城市矩阵的维度
+    cutoff -> float, 可选，仅连接距离不超过 cutoff (km) 的城市
+    k_nearest -> int, 可选，每个城市仅向距离最近的 k_nearest 个城市连出边 (距离相同时按坐标顺序取舍)
+    tolerance -> float, 可选，仅保留zipf权重 K / distance ** alpha 不小于 tolerance 的边 (K, alpha 取默认值)
+    edges -> bool, 是否构造边数组。超大格点图可设为 False，此时图仅由坐标差 latticeOffsets 和统一的转移函数描述，
+        只能使用 fft 后端计算 (见numerical.FFTDerivative)，不能逐条边修改转移函数
+    discardedFlux -> float, 截断丢弃的zipf迁移量占全连接图总迁移量的比例 (各城市人口相同时)，不截断时为 0
+    latticeOffsets -> tuple(np.ndarray, np.ndarray), 图中边的坐标差 (di, dj)，k近邻图不具有平移不变性，此时为 None
+    -------------------------------------------------
+    图结构以数组存储，城市按行优先展平编号 index = i * W + j:
+    edgeStart, edgeEnd -> np.ndarray(int32), shape=(E,), 各条边的出发与到达城市编号
+    edgeDistance -> np.ndarray(float), shape=(E,), 各条边的距离
+    edgeWeight -> np.ndarray(float), shape=(E,), 各条边的权重，线性迁移 (schedules.LinearTransfer) 的人均出行率，默认为 1
+    edgeTransfer -> np.ndarray(int32), shape=(E,), 各条边转移函数在 transfers 中的编号，
+        转移函数的种类与参数由其 kind 和 args 属性给出 (见defaults.py)
+    transfers -> list(functional), 转移函数表
+    outPtr, outEdges -> CSR格式出城邻接表，城市 k 的出城边为 outEdges[outPtr[k]:outPtr[k + 1]]
+    inPtr, inEdges -> CSR格式入城邻接表
+    flux -> np.ndarray, shape=(E, 4), 各条边当前的SEIR流量
+    -------------------------------------------------
+    由任意坐标的城市与边表构造的网络国家 (from_network，见network.py) 为一维的 shape=(n,)，状态为 (n, 4)，
+    cities 为城市的列表 (格点国家为各行的列表)，城市位置以编号 (k,) 表示，另有：
+    coordinates -> np.ndarray, shape=(n, 2), 城市坐标 (km)
+    names -> np.ndarray(str), shape=(n,), 城市名称
+    population -> np.ndarray, shape=(n,), 城市人口 (万人)，用于构造初始状态
+    -------------------------------------------------
+    model -> compartments.CompartmentModel, 一般的仓室模型 (见compartments.py)，None 为扩展SEIR方程 (默认)
+    stateShape -> tuple, 每个城市的状态形状，SEIR方程为 (4,)，仓室模型为 (A, C)
     -------------------------------------------------
     Example:
 
         country = Country((3, 4), 1000.)
         country.cities[2][2].r = const_parameter(1.)  # 修改特定城市SEIR参数
-        for traffic in country.citie[2][2].outPaths:
+        country.set_parameter('r', Piecewise([10.], [20., 3.]))  # 第10天起所有城市的 r 降至 3 (见schedules.py)
+        for traffic in country.cities[2][2].outPaths:
             traffic.transfer = const_transfer(0., 0., 0., 0.)  # 封禁出城道路
+        country.set_transfer(const_transfer(0., 0., 0., 0.), country.out_edges(2, 2))  # 同上，批量修改
+
+        sparse = Country((100, 100), 100., cutoff=500.)  # 稀疏图，仅连接 500 km 以内的城市
+        print(sparse.discardedFlux)
+        huge = Country((300, 300), 100., edges=False)  # 不构造边数组的全连接图
     """
-    def __init__(self, shape: "tuple(int, int)", min_distance: "float"):
+    model = None
+
+    def __init__(self, shape: "tuple(int, int)", min_distance: "float", cutoff: "float" = None,
+                 k_nearest: "int" = None, tolerance: "float" = None, edges: "bool" = True):
         self.minDistance = min_distance
         self.shape = shape
+        self.size = shape[0] * shape[1]
+        transfer = self._init_cities()
+
+        # 构造边：按出发城市、到达城市的顺序排列
+        di, dj = self._lattice_offsets(transfer, cutoff, tolerance)
+        self.latticeOffsets = (di, dj) if k_nearest is None else None
+        in_edges = None
+        if not edges:
+            if k_nearest is not None:
+                raise ValueError("k_nearest requires explicit edges")
+            start = end = np.zeros(0, dtype=np.int32)
+        elif cutoff is None and k_nearest is None and tolerance is None:
+            start, end = _all_pairs(self.size)  # 所有有序城市对
+            in_edges = _all_pairs_in_edges(self.size)
+        else:
+            start, end = self._truncated_edges(transfer, di, dj, k_nearest)
+        self.hasEdges = edges
+        self._set_edges(start, end, transfer, in_edges)
 
-        # 节点初始化
+    def _init_cities(self):
+        """
+        以默认参数初始化所有城市，返回默认的转移函数。网络国家 (一维 shape) 的 cities 为城市的列表
+        """
+        shape = self.shape
         r = const_parameter(SEIRDefaultParameter.r)
         beta = const_parameter(SEIRDefaultParameter.beta)
         h = const_parameter(SEIRDefaultParameter.h)
@@ -92,19 +259,257 @@ class Country(object):
         nu = zero_disturbance
         # transfer = const_transfer()
         transfer = zipf_transfer()
-        self.cities = [[City(r, beta, h, theta, gamma, nu, (i, j)) for j in range(shape[1])] for i in range(shape[0])]
-
-        # 构造边
-        self.traffic = []
-        for i in range(shape[0]):
-            for j in range(shape[1]):
-                city = self.cities[i][j]
-                for I in range(shape[0]):
-                    for J in range(shape[1]):
-                        if i == I and j == J:
-                            continue
-                        d = min_distance * ((i - I) ** 2 + (j - J) ** 2) ** 0.5
-                        t = Traffic(city, self.cities[I][J], d, transfer)
-                        self.traffic.append(t)
-                        city.outPaths.append(t)
-                        self.cities[I][J].inPaths.append(t)
+        if len(shape) == 1:
+            self.cities = [City(r, beta, h, theta, gamma, nu, (k,)) for k in range(shape[0])]
+        else:
+            self.cities = [[City(r, beta, h, theta, gamma, nu, (i, j)) for j in range(shape[1])]
+                           for i in range(shape[0])]
+        for k, city in enumerate(self.all_cities()):
+            city.country = self
+            city.index = k
+        return transfer
+
+    def all_cities(self) -> "list(City)":
+        """
+        按展平编号排列的所有城市
+        """
+        if len(self.shape) == 1:
+            return list(self.cities)
+        return [c for row in self.cities for c in row]
+
+    def graph(self) -> "dict":
+        """
+        图结构的数组：边数组、CSR邻接表与格点坐标差 (latticeOffsets 为 None 时不包括)，
+        与 from_graph 配合，使多个进程共享同一份图 (见sweep.py)。edgeTransfer 随 set_transfer 改变，不包括在内
+        """
+        graph = {name: getattr(self, name) for name in GRAPH_ARRAYS}
+        if self.latticeOffsets is not None:
+            graph['latticeDi'], graph['latticeDj'] = self.latticeOffsets
+        return graph
+
+    @classmethod
+    def from_graph(cls, shape: "tuple(int, int)", min_distance: "float", graph: "dict", has_edges: "bool" = True,
+                   discarded_flux: "float" = 0.) -> "Country":
+        """
+        由 graph() 给出的数组构造国家，不复制数组，也不重新建图。城市参数与转移函数为默认值，
+        graph 中的数组只读 (如共享内存)，各国家的 edgeTransfer 各自独立
+        """
+        country = cls.__new__(cls)
+        country.minDistance = min_distance
+        country.shape = tuple(shape)
+        country.size = int(np.prod(shape))
+        transfer = country._init_cities()
+        country.hasEdges = has_edges
+        country.discardedFlux = discarded_flux
+        country.latticeOffsets = (graph['latticeDi'], graph['latticeDj']) if 'latticeDi' in graph else None
+        for name in GRAPH_ARRAYS:
+            setattr(country, name, graph[name])
+        country.transfers = [transfer]
+        country._transferIndex = {id(transfer): 0}
+        country.edgeTransfer = np.zeros(country.edgeStart.size, dtype=np.int32)
+        country.traffic = TrafficList(country)
+        country._flux = None
+        return country
+
+    @classmethod
+    def from_network(cls, coordinates: "np.ndarray, shape=(n, 2)", start: "np.ndarray", end: "np.ndarray",
+                     distance: "np.ndarray" = None, weight: "np.ndarray" = None, transfer=None,
+                     names: "np.ndarray" = None, population: "np.ndarray" = None) -> "Country":
+        """
+        由任意坐标的城市与边数组构造网络国家，shape=(n,)，所有数组运算向量化，不为边创建 Python 对象。
+        coordinates: 城市坐标 (km)
+        start, end: 各条边的出发与到达城市编号，自环被丢弃，重复的边保留
+        distance: 各条边的距离 (km)，默认为坐标间的直线距离
+        weight: 各条边的权重 (见edgeWeight)，默认为 1
+        transfer: 所有边的转移函数，默认为 zipf_transfer()
+        names, population: 城市名称与人口 (万人)
+        """
+        coordinates = np.asarray(coordinates, dtype=float)
+        n = coordinates.shape[0]
+        start = np.asarray(start, dtype=np.int64)
+        end = np.asarray(end, dtype=np.int64)
+        if start.size and (min(start.min(), end.min()) < 0 or max(start.max(), end.max()) >= n):
+            raise ValueError("edge endpoints must be city indices in [0, n)")
+        if distance is None:
+            distance = np.hypot(*(coordinates[start] - coordinates[end]).T)
+        distance = np.broadcast_to(np.asarray(distance, dtype=float), start.shape)
+        weight = np.broadcast_to(np.asarray(1. if weight is None else weight, dtype=float), start.shape)
+        keep = start != end
+        order = np.lexsort((end[keep], start[keep]))
+        start, end = start[keep][order], end[keep][order]
+        distance, weight = distance[keep][order], weight[keep][order]
+        if np.any(distance <= 0):
+            raise ValueError("edges between distinct cities need a positive distance")
+
+        graph = {'edgeStart': start.astype(np.int32), 'edgeEnd': end.astype(np.int32), 'edgeDistance': distance,
+                 'edgeWeight': weight, 'outEdges': np.arange(start.size, dtype=np.int32),
+                 'outPtr': np.concatenate([[0], np.cumsum(np.bincount(start, minlength=n))]),
+                 'inEdges': np.argsort(end, kind='stable').astype(np.int32),
+                 'inPtr': np.concatenate([[0], np.cumsum(np.bincount(end, minlength=n))])}
+        country = cls.from_graph((n,), float(distance.min()) if distance.size else 0., graph)
+        if transfer is not None:
+            country.set_transfer(transfer)
+        country.coordinates = coordinates
+        country.names = np.array([f"city{k}" for k in range(n)] if names is None else names, dtype=str)
+        country.population = None if population is None else np.asarray(population, dtype=float)
+        return country
+
+    def _lattice_offsets(self, transfer, cutoff, tolerance) -> "(di, dj)":
+        """
+        按截断条件筛选坐标差，并计算 discardedFlux (k近邻截断的 discardedFlux 由 _truncated_edges 更新)。
+        格点图中边的距离只取决于坐标差 (di, dj)，因此对坐标差而非城市对进行筛选，
+        坐标差为 (di, dj) 的城市对共有 (H - |di|) * (W - |dj|) 个。
+        返回按 (距离, di, dj) 排序的坐标差
+        """
+        H, W = self.shape
+        K, alpha = transfer.args
+        di, dj = np.mgrid[1 - H:H, 1 - W:W]
+        di, dj = di.ravel(), dj.ravel()
+        distance = self.minDistance * np.sqrt(di ** 2 + dj ** 2)
+        keep = distance > 0
+        weight = np.zeros(distance.shape)
+        weight[keep] = K / distance[keep] ** alpha * ((H - abs(di)) * (W - abs(dj)))[keep]
+        self._totalFlux = weight.sum()
+        if cutoff is not None:
+            keep &= distance <= cutoff
+        if tolerance is not None:
+            keep &= K / np.where(keep, distance, 1.) ** alpha >= tolerance
+        self.discardedFlux = 1. - weight[keep].sum() / self._totalFlux if self._totalFlux > 0 else 0.
+
+        order = np.lexsort((dj[keep], di[keep], distance[keep]))
+        return di[keep][order], dj[keep][order]
+
+    def _truncated_edges(self, transfer, di, dj, k_nearest) -> "(start, end)":
+        """
+        由坐标差构造边，k近邻即每个城市前 k_nearest 个有效坐标差
+        """
+        H, W = self.shape
+        ci, cj = np.divmod(np.arange(self.size), W)
+        m = di.size if k_nearest is None else min(di.size, 4 * k_nearest + 4)
+        while True:
+            I = ci[:, None] + di[None, :m]
+            J = cj[:, None] + dj[None, :m]
+            valid = (I >= 0) & (I < H) & (J >= 0) & (J < W)
+            if k_nearest is None:
+                break
+            count = valid.sum(axis=1)
+            if m == di.size or count.min() >= k_nearest:
+                valid &= np.cumsum(valid, axis=1) <= k_nearest
+                break
+            m = min(di.size, 2 * m)
+
+        start, col = np.nonzero(valid)
+        end = I[start, col] * W + J[start, col]
+        if k_nearest is not None:
+            K, alpha = transfer.args
+            kept = (K / (self.minDistance * np.sqrt(di[col] ** 2 + dj[col] ** 2)) ** alpha).sum()
+            self.discardedFlux = 1. - kept / self._totalFlux if self._totalFlux > 0 else 0.
+        order = np.lexsort((end, start))
+        return start[order], end[order]
+
+    def _set_edges(self, start: "np.ndarray", end: "np.ndarray", transfer, in_edges: "np.ndarray" = None):
+        """
+        设置边数组，start 须按升序排列。距离由格点坐标计算，所有边使用同一转移函数 transfer
+        in_edges: 已知的入城邻接表顺序 (如全连接图)，默认由 edgeEnd 排序得到
+        """
+        self.edgeStart = start.astype(np.int32, copy=False)
+        self.edgeEnd = end.astype(np.int32, copy=False)
+        di = self.edgeStart // self.shape[1] - self.edgeEnd // self.shape[1]
+        dj = self.edgeStart % self.shape[1] - self.edgeEnd % self.shape[1]
+        self.edgeDistance = self.minDistance * np.sqrt(di ** 2 + dj ** 2)
+        self.edgeWeight = np.ones(self.edgeStart.size, dtype=float)
+        self.transfers = [transfer]
+        self._transferIndex = {id(transfer): 0}
+        self.edgeTransfer = np.zeros(self.edgeStart.size, dtype=np.int32)
+
+        # CSR邻接表
+        self.outEdges = np.arange(self.edgeStart.size, dtype=np.int32)
+        self.outPtr = np.concatenate([[0], np.cumsum(np.bincount(self.edgeStart, minlength=self.size))])
+        if in_edges is None:
+            in_edges = np.argsort(self.edgeEnd, kind='stable')
+        self.inEdges = in_edges.astype(np.int32, copy=False)
+        self.inPtr = np.concatenate([[0], np.cumsum(np.bincount(self.edgeEnd, minlength=self.size))])
+
+        self.traffic = TrafficList(self)
+        self._flux = None
+
+    @property
+    def stateShape(self) -> "tuple":
+        return (4,) if self.model is None else tuple(self.model.shape)
+
+    @property
+    def flux(self) -> "np.ndarray, shape=(E, 4)":
+        if self._flux is None:
+            self._flux = np.zeros((self.edgeStart.size, 4), dtype=float)
+        return self._flux
+
+    def city(self, index: "int") -> "City":
+        """
+        按展平编号返回城市
+        """
+        if len(self.shape) == 1:
+            return self.cities[index]
+        return self.cities[index // self.shape[1]][index % self.shape[1]]
+
+    def _index(self, pos: "tuple") -> "int":
+        """
+        城市位置 (i, j) 或网络国家的 (k,) 对应的展平编号
+        """
+        return int(np.ravel_multi_index(tuple(pos), self.shape))
+
+    def out_edges(self, *pos: "int") -> "np.ndarray":
+        """
+        City_ij (网络国家为 City_k) 出城边的编号
+        """
+        k = self._index(pos)
+        return self.outEdges[self.outPtr[k]:self.outPtr[k + 1]]
+
+    def in_edges(self, *pos: "int") -> "np.ndarray":
+        """
+        City_ij (网络国家为 City_k) 入城边的编号
+        """
+        k = self._index(pos)
+        return self.inEdges[self.inPtr[k]:self.inPtr[k + 1]]
+
+    def set_parameter(self, name: "'r', 'beta', 'h', 'theta', 'gamma' or 'nu'", parameter, cities=None):
+        """
+        批量设置城市参数
+        name: 参数名
+        parameter: functional, 参数函数，所有被设置的城市共享同一个对象，向量化计算时只求值一次
+        cities: None 表示所有城市，也可以是坐标列表 [(i, j), ...] (网络国家为编号列表 [k, ...])
+            或 shape=country.shape 的布尔掩码
+        """
+        if cities is None:
+            cities = np.ones(self.shape, dtype=bool)
+        if isinstance(cities, np.ndarray) and cities.dtype == bool:
+            indices = np.flatnonzero(cities)
+        else:
+            indices = [self._index(np.atleast_1d(pos)) for pos in cities]
+        for k in indices:
+            setattr(self.city(int(k)), name, parameter)
+
+    def set_model(self, model: "compartments.CompartmentModel"):
+        """
+        使用仓室模型 (见compartments.py) 代替扩展SEIR方程，None 恢复SEIR方程
+        """
+        self.model = model
+
+    def set_transfer(self, transfer, edges=None):
+        """
+        批量设置转移函数
+        transfer: functional, 转移函数
+        edges: 边编号数组或布尔掩码，None 表示所有边
+        """
+        if edges is not None and not self.hasEdges:
+            raise ValueError("country without explicit edges only supports setting the transfer of all edges")
+        if edges is None:
+            self.transfers = [transfer]
+            self._transferIndex = {id(transfer): 0}
+            self.edgeTransfer[:] = 0
+            return
+        idx = self._transferIndex.get(id(transfer))
+        if idx is None:
+            idx = len(self.transfers)
+            self.transfers.append(transfer)
+            self._transferIndex[id(transfer)] = idx
+        self.edgeTransfer[edges] = idx
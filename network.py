@@ -0,0 +1,138 @@
+# -*- encoding:utf-8 -*-
+"""
+真实城市网络的批量导入。城市表与边表 (OD表) 按列给出，可以是 CSV 文件 (pandas 读取)、.npz 文件 (每列一个数组)、
+DataFrame 或 列名 -> 数组 的字典：
+    城市表: name (可选，默认 city{k})；x, y (km) 或 lon, lat (度)；population (万人，可选)
+    边表: origin, destination (城市名称或编号)；flow (可选，每天由 origin 前往 destination 的人口，万人/天)
+以经纬度给出时，城市坐标为以平均纬度为基准的等距圆柱投影 (km)，边的距离为大圆距离。
+
+有 flow 列时，同一城市对的多条记录合并，边 (a, b) 的权重为 flow / population[a]，即每天离开 a 前往 b 的人口比例，
+迁移为 linear_transfer (S, E, I, R 按该比例迁移)；没有 flow 列时各条边使用 zipf_transfer。
+构造过程全部为数组运算，不为城市对或边创建 Python 对象，10000 个城市、数十万条边的网络只需数秒。
+得到的国家为一维的 shape=(n,)，状态为 shape=(n, 4) (批量模拟为 (B, n, 4))，积分方法、save/load 与 vision 均可直接使用；
+边很多时可使用 workers 多线程计算导数 (见numerical.TiledDerivative)。
+---------------------------------------------------------------
+Example:
+
+    china = load_network('data/cities.csv', 'data/od.csv')
+    initials = seed_initials(china, {'Wuhan': 1e-4})
+    china.evolute(initials, [0., 360.], method='ROS2', workers=8)
+"""
+import numpy as np
+import pandas as pd
+from simulation import SimCountry
+from defaults import linear_transfer, zipf_transfer
+
+EARTH_RADIUS = 6371.  # 单位:km
+
+
+def read_table(source) -> "dict":
+    """
+    读取列式的表，返回 列名 -> np.ndarray
+    source: .csv/.npz 文件名、DataFrame 或 列名 -> 数组 的字典
+    """
+    if isinstance(source, str):
+        if source.endswith('.npz'):
+            with np.load(source) as data:
+                return {name: data[name] for name in data.files}
+        source = pd.read_csv(source)
+    if isinstance(source, pd.DataFrame):
+        return {name: source[name].to_numpy() for name in source.columns}
+    return {name: np.asarray(values) for name, values in source.items()}
+
+
+def _coordinates(nodes: "dict") -> "(np.ndarray, shape=(n, 2), geographic: bool)":
+    if 'x' in nodes and 'y' in nodes:
+        return np.column_stack([nodes['x'], nodes['y']]).astype(float), False
+    if 'lon' in nodes and 'lat' in nodes:
+        lon, lat = np.radians(np.asarray(nodes['lon'], dtype=float)), np.radians(np.asarray(nodes['lat'], dtype=float))
+        x = EARTH_RADIUS * lon * np.cos(lat.mean())
+        return np.column_stack([x, EARTH_RADIUS * lat]), True
+    raise ValueError("city table needs columns 'x', 'y' (km) or 'lon', 'lat' (degrees)")
+
+
+def haversine(lon1, lat1, lon2, lat2) -> "np.ndarray":
+    """
+    大圆距离 (km)，经纬度单位为度
+    """
+    lon1, lat1, lon2, lat2 = (np.radians(np.asarray(a, dtype=float)) for a in (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.)))
+
+
+def _city_index(column: "np.ndarray", names: "np.ndarray", label: "str") -> "np.ndarray":
+    """
+    边表中的城市列 (名称或编号) 转换为城市编号
+    """
+    column = np.asarray(column)
+    if np.issubdtype(column.dtype, np.integer):
+        return column.astype(np.int64)
+    index = pd.Index(names).get_indexer(column.astype(str))
+    if np.any(index < 0):
+        unknown = np.unique(column[index < 0].astype(str))
+        raise ValueError(f"unknown cities in column '{label}': {', '.join(unknown[:5])}"
+                         + (f" and {unknown.size - 5} more" if unknown.size > 5 else ""))
+    return index.astype(np.int64)
+
+
+def load_network(nodes, edges, K: "float" = 0.04, alpha: "float" = 2., rate: "float" = 1.) -> "SimCountry":
+    """
+    由城市表与边表构造网络国家 (见模块说明)
+    nodes, edges: 城市表与边表，见 read_table
+    K, alpha: 没有 flow 列时的 zipf 迁移参数
+    rate: 有 flow 列时 linear_transfer 的倍率
+
+    Return:
+        SimCountry, shape=(n,)，另有 coordinates, names, population (见kernel.Country)
+    """
+    nodes, edges = read_table(nodes), read_table(edges)
+    coordinates, geographic = _coordinates(nodes)
+    n = coordinates.shape[0]
+    names = np.asarray(nodes['name'], dtype=str) if 'name' in nodes else np.array([f"city{k}" for k in range(n)])
+    if np.unique(names).size != n:
+        raise ValueError("city names must be unique")
+    population = np.asarray(nodes['population'], dtype=float) if 'population' in nodes else None
+
+    start = _city_index(edges['origin'], names, 'origin')
+    end = _city_index(edges['destination'], names, 'destination')
+    if start.size and (min(start.min(), end.min()) < 0 or max(start.max(), end.max()) >= n):
+        raise ValueError("edge endpoints must be city indices in [0, n)")
+    keep = start != end
+    start, end = start[keep], end[keep]
+
+    weight = None
+    if 'flow' in edges:
+        if population is None:
+            raise ValueError("OD flows need the 'population' column of the city table")
+        flow = np.asarray(edges['flow'], dtype=float)[keep]
+        if np.any(flow < 0):
+            raise ValueError("OD flows must be non-negative")
+        pairs, inverse = np.unique(start * n + end, return_inverse=True)  # 合并同一城市对的多条记录
+        flow = np.bincount(inverse, flow, minlength=pairs.size)
+        start, end = pairs // n, pairs % n
+        nonzero = flow > 0
+        start, end, flow = start[nonzero], end[nonzero], flow[nonzero]
+        if np.any(population[start] <= 0):
+            raise ValueError("cities with outgoing flows need a positive population")
+        weight = flow / population[start]
+        transfer = linear_transfer(rate)
+    else:
+        transfer = zipf_transfer(K, alpha)
+
+    distance = None
+    if geographic:
+        distance = haversine(nodes['lon'][start], nodes['lat'][start], nodes['lon'][end], nodes['lat'][end])
+    return SimCountry.from_network(coordinates, start, end, distance, weight, transfer, names, population)
+
+
+def seed_initials(country: "SimCountry", seeds: "dict", population: "float" = 1000.) -> "np.ndarray, shape=(n, 4)":
+    """
+    网络国家的初始状态：各城市的人口全部为健康人，seeds 中的城市 (名称或编号) 另有给定数量的潜伏者 (万人)
+    population: country.population 为 None 时各城市的人口 (万人)
+    """
+    initials = np.zeros((country.size, 4))
+    initials[:, 0] = population if country.population is None else country.population
+    index = {name: k for k, name in enumerate(country.names)}
+    for city, exposed in seeds.items():
+        initials[index[city] if isinstance(city, str) else int(city), 1] += exposed
+    return initials
@@ -2,121 +2,1379 @@
 """
 国家疫情演化的数值算法。扩展的SEIR模型核心为4变量一阶微分方程组，求解微分方程的常用算法包括Euler方法和RK方法。
 此处给出了Euler方法和RK4方法的实现，Euler方法可用于非连续情况下的模拟(以天为单位进行演化)，RK4方法则提供了连续情况下
-精确且计算开销较小的解决方案。
+精确且计算开销较小的解决方案。RK45为自适应步长的Dormand-Prince方法，在系统变化缓慢的时段自动增大步长，
+并支持事件检测 (见events.py)。ROS2为线性隐式的Rosenbrock方法，以按交通图稀疏存储的Jacobian求解刚性问题。
+
+导数计算有两种后端：
+python: _derivative，逐城市、逐条边调用参数函数与转移函数，适用于任意自定义函数；
+vector: VectorDerivative，预先将 defaults 中的常函数与zipf函数编译为数组和权重矩阵，一次导数计算只需少量数组运算，
+    无法识别的自定义函数仍逐个调用，结果与python后端一致；
+fft: FFTDerivative，格点国家的城市间迁移以FFT卷积计算，适用于超大格点国家。
+vector 后端可以按城市块多线程计算 (TiledDerivative，积分方法的 workers 参数)，适用于城市数很多的显式边国家。
 """
+import copy
+import os
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from kernel import Country
+from kernel import Country, City
+from sinks import Sink, ArraySink
+from reducers import StepOutput
+from checkpoints import Checkpoint
+from profiling import DISABLED
 
 
-def _derivative(country: "Country", status: "np.ndarray, shape=(H, W, 4)", t: "float"):
+def _derivative(country: "Country", status: "np.ndarray, shape=(H, W, 4)", t: "float", clock=DISABLED):
     der = np.zeros_like(status)
     """
     扩展SEIR方程，计算某时刻下SEIR四个变量对时间的导数。
     status: 前两个维度为城市矩阵的形状，即 country.shape == status.shape[:2]，第三个维度为4，
-        即 status[a][b] = [S, E, I, R] 为 City_ab 的SEIR状态
+        即 status[a][b] = [S, E, I, R] 为 City_ab 的SEIR状态；网络国家为 shape=(n, 4)
     t: 时间
+    clock: 性能统计 (见profiling.py)
 
     Return:
         np.ndarray, shape=(4,), 分别为SEIR在t时刻下对时间的导数。
     """
+    if not country.hasEdges:
+        raise ValueError("country without explicit edges requires backend 'fft'")
+    timed = clock is not DISABLED  # 关闭统计时逐城市的循环中不调用 clock
     # 外部输入输出准备
-    for tfc in country.traffic:
-        i, j = tfc.start.pos
-        I, J = tfc.end.pos
-        tfc.flux = tfc.transfer(status[i, j, :], status[I, J, :], t, tfc.distance)
-
-    for i in range(status.shape[0]):
-        for j in range(status.shape[1]):
-            c = country.cities[i][j]
-
-            # 1. SEIR方程本项
-            cstatus = status[i, j, :]
-            r = c.r(cstatus, t)
-            beta = c.beta(cstatus, t)
-            h = c.h(cstatus, t)
-            theta = c.theta(cstatus, t)
-            gamma = c.gamma(cstatus, t)
-            N = status[i, j, :].sum()
-            se = r * (beta * cstatus[2] + h * cstatus[1]) * cstatus[0] / N
-            ei = theta * cstatus[1]
-            ir = gamma * cstatus[2]
-            der[i, j, :] = [-se, se - ei, ei - ir, ir]
-
-            # 2. 外部输入输出项
-            der[i, j, :] += np.array([tfc.flux for tfc in c.inPaths]).sum(axis=0)
-            der[i, j, :] -= np.array([tfc.flux for tfc in c.outPaths]).sum(axis=0)
-
-            # 3. 扰动项
-            der[i, j, :] += c.nu(t)
+    x = status.reshape(-1, 4)
+    flux = country.flux
+    transfers = country.transfers
+    weights = country.edgeWeight.tolist()
+    edges = zip(country.edgeStart.tolist(), country.edgeEnd.tolist(),
+                country.edgeTransfer.tolist(), country.edgeDistance.tolist())
+    for e, (a, b, k, d) in enumerate(edges):
+        if getattr(transfers[k], 'kind', None) == 'linear':
+            flux[e] = transfers[k](x[a], x[b], t, d, weights[e])
+        else:
+            flux[e] = transfers[k](x[a], x[b], t, d)
+    if timed:
+        clock.lap('transfer callables')
+
+    out = der.reshape(-1, 4)
+    for k in range(country.size):
+        c = country.city(k)
+
+        # 1. SEIR方程本项
+        cstatus = x[k]
+        theta = c.theta(cstatus, t)
+        gamma = c.gamma(cstatus, t)
+        se = _city_infection(c, cstatus, t)
+        if timed:
+            clock.lap('parameter callables')
+        ei = theta * cstatus[1]
+        ir = gamma * cstatus[2]
+        out[k] = [-se, se - ei, ei - ir, ir]
+        if timed:
+            clock.lap('seir')
+
+        # 2. 外部输入输出项
+        out[k] += flux[country.inEdges[country.inPtr[k]:country.inPtr[k + 1]]].sum(axis=0)
+        out[k] -= flux[country.outEdges[country.outPtr[k]:country.outPtr[k + 1]]].sum(axis=0)
+        if timed:
+            clock.lap('aggregation')
+
+        # 3. 扰动项
+        out[k] += c.nu(t)
+        if timed:
+            clock.lap('disturbance callables')
 
     return der
 
 
+def _city_infection(c: "City", cstatus: "np.ndarray, shape=(4,)", t: "float") -> "float":
+    """
+    City c 中 S -> E 的感染速率
+    """
+    r = c.r(cstatus, t)
+    beta = c.beta(cstatus, t)
+    h = c.h(cstatus, t)
+    return r * (beta * cstatus[2] + h * cstatus[1]) * cstatus[0] / cstatus.sum()
+
+
+def _infection(country: "Country", status: "np.ndarray, shape=(H, W, 4)", t: "float") -> "np.ndarray, shape=(H, W)":
+    """
+    各城市 S -> E 的感染速率，与 VectorDerivative.infection 一致
+    """
+    x = status.reshape(-1, 4)
+    se = np.zeros(country.size)
+    for k in range(country.size):
+        se[k] = _city_infection(country.city(k), x[k], t)
+    return se.reshape(status.shape[:-1])
+
+
+_PARAMETERS = ('r', 'beta', 'h', 'theta', 'gamma')
+
+
+class _ParameterTable(object):
+    """
+    所有城市的某一参数。声明式参数 (带有 at 方法，见schedules.py) 按对象分组，每次计算每个对象只求值一次，
+    全部为常数时只求值一次；其余自定义函数逐城市调用
+    """
+    clock = DISABLED
+
+    def __init__(self, funcs: "list(functional)"):
+        self.size = len(funcs)
+        self.table = []
+        self.ids = np.zeros(self.size, dtype=np.intp)
+        self.calls = []
+        index = {}
+        for idx, func in enumerate(funcs):
+            if hasattr(func, 'at'):
+                if id(func) not in index:
+                    index[id(func)] = len(self.table)
+                    self.table.append(func)
+                self.ids[idx] = index[id(func)]
+            else:
+                self.calls.append((idx, func))
+        self.static = None
+        if all(getattr(p, 'kind', None) == 'const' for p in self.table):
+            self.static = self._values(0.)
+
+    def _values(self, t):
+        if not self.table:
+            return np.zeros(self.size, dtype=float)
+        # 批量模拟时参数可以是 shape=(B,) 的数组，此时返回 shape=(B, n)
+        values = np.broadcast_arrays(*[np.asarray(p.at(t), dtype=float) for p in self.table])
+        return np.stack(values, axis=-1)[..., self.ids]
+
+    def __call__(self, x: "np.ndarray, shape=(..., n, 4)", t: "float") -> "np.ndarray, shape=(..., n)":
+        timed = self.clock is not DISABLED
+        values = self._values(t) if self.static is None else self.static
+        if timed:
+            self.clock.lap('parameters')
+        if self.calls:
+            values = np.array(np.broadcast_to(values, x.shape[:-1]))
+            for idx, func in self.calls:
+                values[..., idx] = _each(lambda xb: func(xb[idx], t), x)
+            if timed:
+                self.clock.lap('parameter callables')
+        return values
+
+
+class _EdgeWeight(object):
+    """
+    一组zipf边的权重 weight_e = K / distance_e ** alpha，start 须按升序排列。
+    边数超过 n * n / 8 时使用稠密矩阵，否则使用按边分段的稀疏格式
+    """
+    def __init__(self, n, start, end, weight):
+        self.dense = start.size > n * n / 8
+        if self.dense:
+            self.weight = np.zeros((n, n), dtype=float)
+            np.add.at(self.weight, (start, end), weight)
+            return
+        # 出城：按出发城市分段
+        self.outEnd = end
+        self.outWeight = weight
+        self.outCities, self.outIdx = np.unique(start, return_index=True)
+        # 入城：按到达城市分段
+        order = np.argsort(end, kind='stable')
+        self.inStart = start[order]
+        self.inWeight = weight[order]
+        self.inCities, self.inIdx = np.unique(end[order], return_index=True)
+
+    def migration(self, x: "np.ndarray, shape=(..., n, 4)", N: "np.ndarray, shape=(..., n)"):
+        """
+        zipf迁移的净输入
+        """
+        return N[..., None] * self.inflow(x) - x * self.rate(N)[..., None]
+
+    def inflow(self, x: "np.ndarray, shape=(..., n, 4)") -> "np.ndarray, shape=(..., n, 4)":
+        """
+        各城市的加权输入 sum_a(weight[a, b] * x_a)
+        """
+        if self.dense:
+            return self.weight.T @ x
+        inflow = np.zeros_like(x)
+        inflow[..., self.inCities, :] = np.add.reduceat(
+            x[..., self.inStart, :] * self.inWeight[:, None], self.inIdx, axis=-2)
+        return inflow
+
+    def rate(self, N: "np.ndarray, shape=(..., n)") -> "np.ndarray, shape=(..., n)":
+        """
+        各城市的出城率 sum_b(weight[a, b] * N_b)
+        """
+        if self.dense:
+            return N @ self.weight.T
+        rate = np.zeros_like(N)
+        rate[..., self.outCities] = np.add.reduceat(N[..., self.outEnd] * self.outWeight, self.outIdx, axis=-1)
+        return rate
+
+
+def _multiplier(transfer, t):
+    """
+    转移函数 t 时刻的倍率 (见schedules.ZipfTransfer)，无倍率时为 1，批量模拟时可以是 shape=(B, 1, 1) 的数组
+    """
+    g = transfer.multiplier(t) if hasattr(transfer, 'multiplier') else 1.
+    return np.reshape(g, np.shape(g) + (1, 1)) if np.ndim(g) else g
+
+
+def _each(func, x: "np.ndarray, shape=(..., n, 4)"):
+    """
+    对批量状态中的每个场景分别调用只接受单个场景的自定义函数 func(x_b), x_b.shape=(n, 4)
+    """
+    if x.ndim == 2:
+        return func(x)
+    return np.array([func(xb) for xb in x])
+
+
+class VectorDerivative(object):
+    """
+    向量化的扩展SEIR方程，与 _derivative 计算结果一致。
+    初始化时根据 country 中城市的参数函数和边数组，将声明式的参数与转移函数 (见defaults.py和schedules.py) 编译为数组：
+        Constant, Piecewise 等参数 -> 参数数组, shape=(H*W,)，相同的对象每次只求值一次
+        ZipfTransfer -> 权重矩阵 weight[a, b] = K / distance_ab ** alpha，则
+            city_b 的输入为 N_b * sum_a(weight[a, b] * X_a)，city_a 的输出为 X_a * sum_b(weight[a, b] * N_b)
+            边数较多时以稠密矩阵乘法计算，稀疏图 (见 kernel.Country 的截断选项) 则按边分段求和，计算量与边数成正比
+        ConstTransfer -> 各城市恒定的净输入, shape=(H*W, 4)
+        LinearTransfer -> 权重 weight_e = rate * edgeWeight_e，city_b 的输入为 sum_a(weight[a, b] * X_a)，
+            city_a 的输出为 X_a * sum_b(weight[a, b])，存储方式同 zipf
+            三者都按倍率 gate 分组，每组乘以 gate.at(t)，倍率为 0 的组不再计算
+        zero_disturbance -> 忽略
+    其余自定义函数保留原样，每次计算时逐个调用。
+    编译后修改 country 中的函数不会生效，需要重新构造 VectorDerivative。
+    status 可以带有批量维度 shape=(B, H, W, 4)，此时声明式参数与倍率可以是 shape=(B,) 的数组，即每个场景一个取值，
+    所有场景共享同一个图，一次数组运算同时计算 (见schedules.py)。
+    clock 为性能统计 (见profiling.py)，记录各阶段的时间，默认为空操作。
+    ---------------------------------------------------------------
+    Example:
+
+        derivative = VectorDerivative(country)
+        der = derivative(status, t)  # 等价于 _derivative(country, status, t)
+    """
+    _clock = DISABLED
+
+    def __init__(self, country: "Country"):
+        self.shape = tuple(country.shape)
+        self._compile_cities(country)
+        self._compile_traffic(country)
+
+    @property
+    def clock(self):
+        return self._clock
+
+    @clock.setter
+    def clock(self, clock):
+        self._clock = clock
+        for table in self.parameters.values():
+            table.clock = clock
+
+    def _compile_cities(self, country: "Country"):
+        cities = country.all_cities()
+        self.parameters = {name: _ParameterTable([getattr(c, name) for c in cities]) for name in _PARAMETERS}
+        self.disturbances = [(idx, c.nu) for idx, c in enumerate(cities) if getattr(c.nu, 'kind', None) != 'zero']
+
+    def _compile_traffic(self, country: "Country"):
+        if not country.hasEdges:
+            raise ValueError("country without explicit edges requires backend 'fft'")
+        n = country.size
+        start, end, distance = country.edgeStart, country.edgeEnd, country.edgeDistance
+
+        # 转移函数表中的每一项按种类和倍率分组：zipf函数合并为权重矩阵，常函数合并为恒定输入输出，其余函数逐条边调用
+        codes = {'zipf': 1, 'const': 2, 'linear': 3}
+        kinds = np.array([codes.get(getattr(tr, 'kind', None), 0) for tr in country.transfers], dtype=np.int8)
+        groups = []  # 每组的代表转移函数，用于求倍率
+        index = {}
+        entryGroup = np.zeros(len(country.transfers), dtype=np.intp)
+        for k, tr in enumerate(country.transfers):
+            key = (kinds[k], id(getattr(tr, 'gate', None)))
+            if key not in index:
+                index[key] = len(groups)
+                groups.append(tr)
+            entryGroup[k] = index[key]
+        edgeKind = kinds[country.edgeTransfer]
+        edgeGroup = entryGroup[country.edgeTransfer]
+
+        self.zipf = []
+        self.zipfEdges = []  # 各组的 (start, end, weight)，用于 TiledDerivative 分块
+        zipf = np.nonzero(edgeKind == 1)[0]
+        if zipf.size:
+            args = np.array([tr.args if kinds[k] == 1 else (0., 0.) for k, tr in enumerate(country.transfers)],
+                            dtype=float)[country.edgeTransfer[zipf]]
+            weight = args[:, 0] / distance[zipf] ** args[:, 1]
+            for g in np.unique(edgeGroup[zipf]):
+                sel = edgeGroup[zipf] == g
+                e = zipf[sel]
+                self.zipf.append((groups[g], _EdgeWeight(n, start[e], end[e], weight[sel])))
+                self.zipfEdges.append((start[e], end[e], weight[sel]))
+
+        self.const = []
+        const = np.nonzero(edgeKind == 2)[0]
+        if const.size:
+            args = np.array([tr.args if kinds[k] == 2 else (0., 0., 0., 0.) for k, tr in enumerate(country.transfers)],
+                            dtype=float)[country.edgeTransfer[const]]
+            for g in np.unique(edgeGroup[const]):
+                sel = edgeGroup[const] == g
+                net = np.zeros((n, 4), dtype=float)
+                np.add.at(net, end[const[sel]], args[sel])
+                np.subtract.at(net, start[const[sel]], args[sel])
+                self.const.append((groups[g], net))
+
+        self.linear = []
+        self.linearEdges = []
+        linear = np.nonzero(edgeKind == 3)[0]
+        if linear.size:
+            rate = np.array([tr.args[0] if kinds[k] == 3 else 0. for k, tr in enumerate(country.transfers)],
+                            dtype=float)[country.edgeTransfer[linear]]
+            weight = rate * country.edgeWeight[linear]
+            for g in np.unique(edgeGroup[linear]):
+                sel = edgeGroup[linear] == g
+                e = linear[sel]
+                matrix = _EdgeWeight(n, start[e], end[e], weight[sel])
+                self.linear.append((groups[g], matrix, matrix.rate(np.ones(n))))
+                self.linearEdges.append((start[e], end[e], weight[sel]))
+
+        self.callTraffic = [(start[e], end[e], country.transfers[country.edgeTransfer[e]], distance[e])
+                            for e in np.nonzero(edgeKind == 0)[0]]
+
+    def __call__(self, status: "np.ndarray, shape=(H, W, 4) or (B, H, W, 4)", t: "float") -> "np.ndarray":
+        clock = self._clock
+        timed = clock is not DISABLED
+        x = status.reshape(*status.shape[:status.ndim - len(self.shape) - 1], -1, 4)  # shape=(n, 4) or (B, n, 4)
+        E, I = x[..., 1], x[..., 2]
+        N = x.sum(axis=-1)
+
+        # 1. SEIR方程本项
+        theta = self.parameters['theta'](x, t)
+        gamma = self.parameters['gamma'](x, t)
+        se = self._infection(x, N, t)
+        ei = theta * E
+        ir = gamma * I
+        der = np.stack([-se, se - ei, ei - ir, ir], axis=-1)
+        if timed:
+            clock.lap('seir')
+
+        # 2. 外部输入输出项
+        for transfer, weight in self.zipf:
+            g = _multiplier(transfer, t)
+            if np.any(g != 0):
+                der += g * weight.migration(x, N)
+        for transfer, weight, out in self.linear:
+            g = _multiplier(transfer, t)
+            if np.any(g != 0):
+                der += g * (weight.inflow(x) - x * out[:, None])
+        if timed:
+            clock.lap('migration')
+        for transfer, net in self.const:
+            g = _multiplier(transfer, t)
+            if np.any(g != 0):
+                der += g * net
+        if timed:
+            clock.lap('const transfer')
+        if self.callTraffic:
+            for a, b, transfer, distance in self.callTraffic:
+                flux = _each(lambda xb: transfer(xb[a], xb[b], t, distance), x)
+                der[..., b, :] += flux
+                der[..., a, :] -= flux
+            if timed:
+                clock.lap('transfer callables')
+
+        # 3. 扰动项
+        if self.disturbances:
+            for idx, nu in self.disturbances:
+                der[..., idx, :] += nu(t)
+            if timed:
+                clock.lap('disturbance callables')
+
+        return der.reshape(status.shape)
+
+    def _infection(self, x: "np.ndarray, shape=(..., n, 4)", N: "np.ndarray, shape=(..., n)", t: "float"):
+        r = self.parameters['r'](x, t)
+        beta = self.parameters['beta'](x, t)
+        h = self.parameters['h'](x, t)
+        return r * (beta * x[..., 2] + h * x[..., 1]) * x[..., 0] / N
+
+    def infection(self, status: "np.ndarray, shape=(H, W, 4) or (B, H, W, 4)", t: "float") -> "np.ndarray":
+        """
+        各城市 S -> E 的感染速率, shape=status.shape[:-1]，用于累计感染人数 (见reducers.py)
+        """
+        x = status.reshape(*status.shape[:status.ndim - len(self.shape) - 1], -1, 4)
+        return self._infection(x, x.sum(axis=-1), t).reshape(status.shape[:-1])
+
+    def jacobian(self, status: "np.ndarray, shape=(H, W, 4) or (B, H, W, 4)", t: "float") -> "_Jacobian":
+        """
+        t 时刻在 status 处的稀疏 Jacobian (见_Jacobian)，用于隐式方法 ROS2。
+        感染对 E 的增益 (E 行中 se 的偏导数) 不计入，由 ROS2 显式处理，见_Jacobian
+        """
+        x = status.reshape(*status.shape[:status.ndim - len(self.shape) - 1], -1, 4)
+        S, E, I = x[..., 0], x[..., 1], x[..., 2]
+        N = x.sum(axis=-1)
+        r = self.parameters['r'](x, t)
+        beta = self.parameters['beta'](x, t)
+        h = self.parameters['h'](x, t)
+        theta = self.parameters['theta'](x, t)
+        gamma = self.parameters['gamma'](x, t)
+
+        # se = r * (beta * I + h * E) * S / N 对 [S, E, I, R] 的偏导数
+        force = r * (beta * I + h * E)
+        ratio = force * S / N ** 2
+        grad = np.stack([force / N - ratio, r * h * S / N - ratio, r * beta * S / N - ratio, -ratio], axis=-1)
+        local = np.zeros(x.shape + (4,))
+        local[..., 0, :] = -grad
+        local[..., 1, 1] -= theta
+        local[..., 2, 1] += theta
+        local[..., 2, 2] -= gamma
+        local[..., 3, 2] += gamma
+        migration = []
+        for transfer, weight in self.zipf:
+            g = _multiplier(transfer, t)
+            if np.any(g != 0):
+                migration.append((g, weight))
+        linear = []
+        for transfer, weight, out in self.linear:
+            g = _multiplier(transfer, t)
+            if np.any(g != 0):
+                linear.append((g, weight, out))
+        return _Jacobian(local, x, N, migration, linear)
+
+
+def _fft_size(n: "int") -> "int":
+    """
+    不小于 n 的最小 2^a 3^b 5^c，FFT在这些长度上最快
+    """
+    best = 2 ** int(np.ceil(np.log2(n)))
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            p = p35
+            while p < n:
+                p *= 2
+            best = min(best, p)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+
+class _LatticeWeight(object):
+    """
+    格点国家zipf权重的FFT卷积核，kernel 中心 (H - 1, W - 1) 对应坐标差 (0, 0)
+    """
+    def __init__(self, shape, kernel):
+        H, W = self.shape = shape
+        self.fftShape = (_fft_size(3 * H - 2), _fft_size(3 * W - 2))  # 不小于线性卷积的完整尺寸，避免循环卷积的边界混叠
+        self.kernel = np.fft.rfft2(kernel, s=self.fftShape)
+
+    def migration(self, x: "np.ndarray, shape=(..., n, 4)", N: "np.ndarray, shape=(..., n)"):
+        """
+        N 须为 x.sum(axis=-1)，此时出城率即各人群卷积之和，只需对 x 做一次FFT卷积
+        """
+        conv = self.inflow(x)
+        return N[..., None] * conv - x * conv.sum(axis=-1)[..., None]
+
+    def inflow(self, x: "np.ndarray, shape=(..., n, 4)") -> "np.ndarray, shape=(..., n, 4)":
+        H, W = self.shape
+        fields = np.moveaxis(x.reshape(*x.shape[:-2], H, W, 4), -1, -3)
+        conv = np.fft.irfft2(np.fft.rfft2(fields, s=self.fftShape) * self.kernel, s=self.fftShape)
+        return np.moveaxis(conv[..., H - 1:2 * H - 1, W - 1:2 * W - 1], -3, -1).reshape(x.shape)
+
+    def rate(self, N: "np.ndarray, shape=(..., n)") -> "np.ndarray, shape=(..., n)":
+        """
+        权重对称，出城率即 N 的卷积
+        """
+        H, W = self.shape
+        field = N.reshape(*N.shape[:-1], H, W)
+        conv = np.fft.irfft2(np.fft.rfft2(field, s=self.fftShape) * self.kernel, s=self.fftShape)
+        return conv[..., H - 1:2 * H - 1, W - 1:2 * W - 1].reshape(N.shape)
+
+
+class FFTDerivative(VectorDerivative):
+    """
+    格点国家的卷积形式扩展SEIR方程，城市参数的处理同 VectorDerivative。
+    格点图中边的距离只取决于坐标差，若所有边使用同一个zipf转移函数且边集具有平移不变性 (全连接或按距离截断，
+    即 country.latticeOffsets 不为 None)，则 zipf 权重是坐标差的函数 G(di, dj) = K / distance ** alpha，
+        city_b 的输入为 N_b * (X * G)_b，city_a 的输出为 X_a * (N * G)_a
+    其中 * 为二维卷积。对零填充后的城市矩阵做FFT卷积，一次导数计算的开销为 O(HW log HW)，
+    适用于 Country(..., edges=False) 构造的超大格点国家。
+    """
+    def _compile_traffic(self, country: "Country"):
+        if country.latticeOffsets is None:
+            raise ValueError("backend 'fft' requires a translation invariant lattice country")
+        H, W = self.shape
+        used = np.unique(country.edgeTransfer) if country.hasEdges else np.zeros(1, dtype=int)
+        if used.size > 1:
+            raise ValueError("backend 'fft' requires one transfer function for all edges")
+        self.zipf = []
+        self.const = []
+        self.linear = []
+        self.callTraffic = []
+        if used.size == 0 or country.latticeOffsets[0].size == 0:
+            return
+        transfer = country.transfers[used[0]]
+        if getattr(transfer, 'kind', None) != 'zipf':
+            raise ValueError("backend 'fft' requires zipf_transfer")
+
+        K, alpha = transfer.args
+        di, dj = country.latticeOffsets
+        kernel = np.zeros((2 * H - 1, 2 * W - 1), dtype=float)
+        kernel[di + H - 1, dj + W - 1] = K / (country.minDistance * np.sqrt(di ** 2 + dj ** 2)) ** alpha
+        self.zipf.append((transfer, _LatticeWeight(self.shape, kernel)))
+
+
+class _TileWeight(object):
+    """
+    一组zipf边或线性迁移边中与城市块 [lo, hi) 有关的部分：终点在块内的入城边与起点在块内的出城边。
+    稠密权重矩阵直接取其列与行的视图，块外的所有城市都是 halo；
+    稀疏格式只保留这些边，端点按块内的局部编号存储，块外的端点 halo 排在块内城市之后，
+    计算前由 exchange 从全局状态中取出 (halo 交换)，之后只访问局部数组
+    """
+    def __init__(self, weight: "_EdgeWeight", n: "int", lo: "int", hi: "int", start, end, w):
+        self.lo, self.hi = lo, hi
+        self.dense = weight.dense
+        if self.dense:
+            self.inWeight = weight.weight[:, lo:hi]
+            self.outWeight = weight.weight[lo:hi, :]
+            return
+        own = lambda c: (c >= lo) & (c < hi)
+        into, out = own(end), own(start)
+        halo = np.union1d(start[into], end[out])
+        self.halo = halo[~own(halo)]
+        local = np.full(n, -1, dtype=np.intp)
+        local[lo:hi] = np.arange(hi - lo)
+        local[self.halo] = hi - lo + np.arange(self.halo.size)
+        # 入城：按块内的到达城市分段，与 _EdgeWeight 的求和顺序相同
+        order = np.argsort(end[into], kind='stable')
+        self.inStart = local[start[into][order]]
+        self.inWeight = w[into][order]
+        self.inCities, self.inIdx = np.unique(local[end[into][order]], return_index=True)
+        # 出城：按块内的出发城市分段
+        self.outEnd = local[end[out]]
+        self.outWeight = w[out]
+        self.outCities, self.outIdx = np.unique(local[start[out]], return_index=True)
+
+    def exchange(self, x: "np.ndarray, shape=(..., n, 4)", N: "np.ndarray, shape=(..., n)") -> "(xl, Nl)":
+        """
+        块内城市与 halo 的状态，局部编号
+        """
+        xl = np.concatenate([x[..., self.lo:self.hi, :], x[..., self.halo, :]], axis=-2)
+        Nl = np.concatenate([N[..., self.lo:self.hi], N[..., self.halo]], axis=-1)
+        return xl, Nl
+
+    def _inflow(self, xl: "np.ndarray") -> "np.ndarray, shape=(..., hi - lo, 4)":
+        if self.dense:
+            return self.inWeight.T @ xl
+        inflow = np.zeros((*xl.shape[:-2], self.hi - self.lo, 4))
+        if self.inIdx.size:
+            inflow[..., self.inCities, :] = np.add.reduceat(
+                xl[..., self.inStart, :] * self.inWeight[:, None], self.inIdx, axis=-2)
+        return inflow
+
+    def migration(self, x: "np.ndarray, shape=(..., n, 4)", N: "np.ndarray, shape=(..., n)"):
+        """
+        块内各城市zipf迁移的净输入, shape=(..., hi - lo, 4)
+        """
+        xo, No = x[..., self.lo:self.hi, :], N[..., self.lo:self.hi]
+        if self.dense:
+            inflow = self._inflow(x)
+            rate = N @ self.outWeight.T
+        else:
+            xl, Nl = self.exchange(x, N)
+            inflow = self._inflow(xl)
+            rate = np.zeros_like(No)
+            if self.outIdx.size:
+                rate[..., self.outCities] = np.add.reduceat(Nl[..., self.outEnd] * self.outWeight, self.outIdx, axis=-1)
+        return No[..., None] * inflow - xo * rate[..., None]
+
+    def linear(self, x: "np.ndarray, shape=(..., n, 4)", out: "np.ndarray, shape=(n,)"):
+        """
+        块内各城市线性迁移的净输入, shape=(..., hi - lo, 4)，out 为各城市的出城率
+        """
+        xl = x if self.dense else np.concatenate([x[..., self.lo:self.hi, :], x[..., self.halo, :]], axis=-2)
+        return self._inflow(xl) - x[..., self.lo:self.hi, :] * out[self.lo:self.hi, None]
+
+
+class TiledDerivative(VectorDerivative):
+    """
+    按城市块并行计算的 VectorDerivative，用于城市数很多的国家。城市按行优先编号划分为 tiles 个连续的块 (整行的条带)，
+    网络国家 (一维 shape) 按编号划分为连续的块。
+    每块的SEIR方程本项、zipf迁移、线性迁移与恒定输入输出由 workers 个线程分别计算，写入导数中互不重叠的部分。
+    块的迁移只需要与之相连的块外城市 (halo) 的状态，稀疏图每次计算前显式取出 halo (见_TileWeight)；
+    全连接图的稠密权重矩阵按块取行与列，halo 为所有城市。
+    线程中只有 NumPy 的数组运算 (释放 GIL)，参数表的求值与自定义函数 (转移函数、扰动) 仍在调用线程中逐个计算。
+    结果与 VectorDerivative 一致：稀疏图逐位相同，稠密矩阵乘法只有舍入误差的差别。
+    infection 与 jacobian 不分块，与 VectorDerivative 相同。
+    """
+    def __init__(self, country: "Country", workers: "int" = None, tiles: "int" = None):
+        super().__init__(country)
+        self.workers = workers or os.cpu_count()
+        H, W = self.shape if len(self.shape) == 2 else (self.shape[0], 1)
+        rows = np.unique(np.linspace(0, H, min(tiles or self.workers, H) + 1).round().astype(int))
+        self.tiles = [(lo * W, hi * W) for lo, hi in zip(rows[:-1], rows[1:])]
+        n = H * W
+        self.tileZipf = [[_TileWeight(weight, n, lo, hi, *edges)
+                          for (_, weight), edges in zip(self.zipf, self.zipfEdges)] for lo, hi in self.tiles]
+        self.tileLinear = [[_TileWeight(weight, n, lo, hi, *edges)
+                            for (_, weight, _), edges in zip(self.linear, self.linearEdges)] for lo, hi in self.tiles]
+        self.pool = ThreadPoolExecutor(self.workers)
+
+    def __call__(self, status: "np.ndarray, shape=(H, W, 4) or (B, H, W, 4)", t: "float") -> "np.ndarray":
+        clock = self._clock
+        timed = clock is not DISABLED
+        x = status.reshape(*status.shape[:status.ndim - len(self.shape) - 1], -1, 4)  # shape=(n, 4) or (B, n, 4)
+        N = x.sum(axis=-1)
+        p = {name: self.parameters[name](x, t) for name in ('r', 'beta', 'h', 'theta', 'gamma')}
+        gates = [_multiplier(transfer, t) for transfer, _ in self.zipf]
+        linear = [(_multiplier(transfer, t), out) for transfer, _, out in self.linear]
+        consts = [(_multiplier(transfer, t), net) for transfer, net in self.const]
+        der = np.empty_like(x)
+
+        def tile(k):
+            lo, hi = self.tiles[k]
+            xo, No = x[..., lo:hi, :], N[..., lo:hi]
+            S, E, I = xo[..., 0], xo[..., 1], xo[..., 2]
+            q = {name: value[..., lo:hi] if np.ndim(value) else value for name, value in p.items()}
+            se = q['r'] * (q['beta'] * I + q['h'] * E) * S / No
+            ei = q['theta'] * E
+            ir = q['gamma'] * I
+            out = np.stack([-se, se - ei, ei - ir, ir], axis=-1)
+            for g, weight in zip(gates, self.tileZipf[k]):
+                if np.any(g != 0):
+                    out += g * weight.migration(x, N)
+            for (g, rate), weight in zip(linear, self.tileLinear[k]):
+                if np.any(g != 0):
+                    out += g * weight.linear(x, rate)
+            for g, net in consts:
+                if np.any(g != 0):
+                    out += g * net[lo:hi]
+            der[..., lo:hi, :] = out
+
+        list(self.pool.map(tile, range(len(self.tiles))))
+        if timed:
+            clock.lap('tiles')
+        if self.callTraffic:
+            for a, b, transfer, distance in self.callTraffic:
+                flux = _each(lambda xb: transfer(xb[a], xb[b], t, distance), x)
+                der[..., b, :] += flux
+                der[..., a, :] -= flux
+            if timed:
+                clock.lap('transfer callables')
+        if self.disturbances:
+            for idx, nu in self.disturbances:
+                der[..., idx, :] += nu(t)
+            if timed:
+                clock.lap('disturbance callables')
+        return der.reshape(status.shape)
+
+
+def _backend(country: "Country", backend: "'vector', 'fft' or 'python'", workers: "int" = 1):
+    """
+    返回导数函数 derivative(status, t)，derivative.infection(status, t) 为各城市 S -> E 的感染速率，
+    derivative.clock 为性能统计 (见profiling.py)。workers > 1 时 vector 后端按城市块多线程计算 (见TiledDerivative)。
+    设置了仓室模型 (见compartments.py) 的国家使用模型编译的导数，只能为 vector 后端且 workers=1
+    """
+    if country.model is not None:
+        if backend != "vector" or workers != 1:
+            raise ValueError("compartment models require backend 'vector' with workers=1")
+        return country.model.derivative(country)
+    if workers != 1 and backend != "vector":
+        raise ValueError("multi-threaded derivative (workers > 1) requires backend 'vector'")
+    if backend == "vector":
+        return VectorDerivative(country) if workers == 1 else TiledDerivative(country, workers)
+    elif backend == "fft":
+        return FFTDerivative(country)
+    elif backend == "python":
+        def derivative(status, t):
+            if status.ndim == len(country.shape) + 1:
+                return _derivative(country, status, t, derivative.clock)
+            return np.array([_derivative(country, s, t, derivative.clock) for s in status])  # 批量状态逐个场景计算
+
+        def infection(status, t):
+            if status.ndim == len(country.shape) + 1:
+                return _infection(country, status, t)
+            return np.array([_infection(country, s, t) for s in status])
+        derivative.infection = infection
+        derivative.clock = DISABLED
+        return derivative
+    else:
+        raise KeyError("backend must be one of 'vector', 'fft' and 'python'")
+
+
+def _batched(country: "Country", initials: "np.ndarray") -> "bool":
+    """
+    initials 是否带有批量维度 shape=(B, H, W, 4) (仓室模型为 (B, H, W, A, C))
+    """
+    return initials.ndim == len(country.shape) + len(country.stateShape) + 1
+
+
+def _seir_view(country: "Country"):
+    """
+    状态的 SEIR 视图 x -> shape=(..., n, 4)，用于在线统计量与事件：SEIR模型只展平城市维，
+    仓室模型 (见compartments.py) 为对分层与各组仓室求和
+    """
+    cities = len(country.shape)
+    model = country.model
+    if model is None:
+        return lambda x: x.reshape(*x.shape[:x.ndim - cities - 1], -1, 4)
+    return lambda x: model.seir(x).reshape(*x.shape[:x.ndim - cities - 2], -1, 4)
+
+
+class _Reducers(object):
+    """
+    积分过程中的在线统计量 (见reducers.py)，以 shape=(..., n, 4) 的状态更新各统计量。
+    仓室模型 (见compartments.py) 使用 SEIR 视图 (见_seir_view)，感染速率由视图对应的完整状态计算，
+    视图按对象本身 (id) 记录其完整状态，只对交给统计量的状态有效
+    """
+    def __init__(self, country: "Country", derivative, initials: "np.ndarray", reducers: "list(reducers.Reducer)",
+                 profile=DISABLED):
+        self.reducers = list(reducers)
+        self.derivative = derivative
+        self.profile = profile
+        self.shape = initials.shape
+        self.view = _seir_view(country)
+        self.model = country.model
+        self.full = {}  # 仓室模型本步中 SEIR 视图的 id -> (视图, 完整状态)
+
+    def _view(self, x: "np.ndarray") -> "np.ndarray, shape=(..., n, 4)":
+        v = self.view(x)
+        if self.model is not None:
+            self.full[id(v)] = (v, x)
+        return v
+
+    def _full(self, v: "np.ndarray, shape=(..., n, 4)") -> "np.ndarray":
+        """
+        仓室模型中交给统计量的 SEIR 视图 v 对应的完整状态。v 须为本步交给统计量的状态本身 (start/update 的 x 或
+        interp(t) 的返回值)，其余数组 (切片、复制或计算得到的状态) 没有对应的完整状态
+        """
+        entry = self.full.get(id(v))
+        if entry is None or entry[0] is not v:
+            raise ValueError("infection rates of compartment models are only available for the states given to "
+                             "reducers (x of start/update or interp(t))")
+        return entry[1]
+
+    def infection(self, x: "np.ndarray, shape=(..., n, 4)", t: "float") -> "np.ndarray, shape=(..., n)":
+        shape = x.shape[:-1]
+        if self.model is not None:
+            x = self._full(x)
+        return self.derivative.infection(x.reshape(self.shape), t).reshape(shape)
+
+    def start(self, t: "float", x: "np.ndarray"):
+        for reducer in self.reducers:
+            reducer.start(t, self._view(x), self.infection)
+        self.full.clear()
+
+    def step(self, t0: "float", x0: "np.ndarray", t1: "float", x1: "np.ndarray", f0: "np.ndarray" = None,
+             dense: "_DenseOutput" = None):
+        """
+        完成一步 [t0, t1]，f0 为 t0 时刻的导数，dense 为 RK45 的稠密输出，两者都没有时线性插值
+        """
+        if not self.reducers:
+            return
+        self.profile.mark()
+        v1 = self._view(x1)
+        if dense is not None:
+            interp = dense.project(self.view)
+        else:
+            interp = StepOutput(t0, self.view(x0), t1, v1, None if f0 is None else self.view(f0))
+        if self.model is not None:
+            full = dense if dense is not None else StepOutput(t0, x0, t1, x1, f0)
+            interp = _ViewOutput(full, interp, self._view)
+        for reducer in self.reducers:
+            reducer.update(t1, v1, interp)
+        self.full.clear()
+        self.profile.lap('reducers')
+
+    def bind(self):
+        """
+        从检查点继续演化时，将恢复的统计量绑定到当前的导数后端
+        """
+        for reducer in self.reducers:
+            reducer.bind(self.infection)
+
+
+class _ViewOutput(object):
+    """
+    仓室模型的步内插值：component 为 SEIR 视图的插值，interp(t) 记录视图对应的完整状态，以便计算感染速率
+    """
+    def __init__(self, full, projected, view):
+        self.full = full
+        self.projected = projected
+        self.view = view
+        self.t0, self.t1 = projected.t0, projected.t1
+
+    def __call__(self, t: "float") -> "np.ndarray":
+        return self.view(self.full(t))
+
+    def component(self, t: "np.ndarray", k: "int") -> "np.ndarray":
+        return self.projected.component(t, k)
+
+
+class _Checkpoints(object):
+    """
+    积分过程中在给定时刻生成检查点 (见checkpoints.py)，交给 callback
+    """
+    def __init__(self, times: "list[float]", callback, method: "str", time_span: "list[float, float]", step: "float",
+                 sampling: "int", initials: "np.ndarray", reduce: "_Reducers", resume: "Checkpoint" = None):
+        first = time_span[0] if resume is None else resume.t
+        self.pending = sorted(t for t in times if first <= t <= time_span[1] and (resume is None or t > resume.t))
+        if self.pending and callback is None:
+            raise ValueError("checkpoints need an on_checkpoint callback")
+        self.indices = {int(round((t - time_span[0]) / step)) for t in self.pending}  # Euler/RK4 的步序号
+        self.callback = callback
+        self.method = method
+        self.origin = time_span[0]
+        self.step = step
+        self.sampling = sampling
+        self.initials = initials
+        self.reduce = reduce
+
+    def next(self) -> "float":
+        return self.pending[0] if self.pending else np.inf
+
+    def emit(self, t, x, h, index, sample, hits=None, done=None):
+        self.pending.pop(0)
+        self.callback(Checkpoint(self.origin, self.step, self.sampling, self.method, t, x, h, index, sample,
+                                 self.initials, self.reduce.reducers, hits, done))
+
+
+def _start(country: "Country", initials: "np.ndarray", time_span: "list[float, float]", step: "float",
+           sampling: "int", method: "str", derivative, reducers: "list", resume: "Checkpoint",
+           profile=DISABLED) -> "(x, reduce)":
+    """
+    初始状态与在线统计量，resume 不为 None 时从检查点恢复
+    """
+    reduce = _Reducers(country, derivative, initials, reducers, profile)
+    if resume is None:
+        x = initials.astype(float)
+        reduce.start(time_span[0], x)
+    else:
+        resume.check(time_span, step, sampling, method)
+        x = resume.x.copy()
+        reduce.bind()
+    return x, reduce
+
+
 def Euler(country: "Country", initials: "np.ndarray, shape=(H, W, 4)", time_span: "list[float, float]",
-          step: "float" = 0.1, sampling: "int" = 1) -> "(time, track)":
+          step: "float" = 0.1, sampling: "int" = 1,
+          backend: "'vector', 'fft' or 'python'" = "vector", sink: "Sink" = None,
+          reducers: "list(reducers.Reducer)" = (), checkpoints: "list[float]" = (), on_checkpoint=None,
+          resume: "Checkpoint" = None, profile: "profiling.Profile" = None, workers: "int" = 1) -> "(time, track)":
     """
     Euler方法。
     initials: 初始状态。前两个维度为城市矩阵的形状，即 country.shape == initials.shape[:2]，第三个维度为4，
-        即 initials[a][b] = [S, E, I, R] 为 City_ab 的初始SEIR状态
+        即 initials[a][b] = [S, E, I, R] 为 City_ab 的初始SEIR状态。
+        批量模拟时 initials.shape=(B, H, W, 4)，B 个场景同时演化，各场景的参数见schedules.py
     time_span: 演化时间范围
     step: 演化时间步长
     sampling: 采样间隔，即每sampling个step记录一次系统状态。
+    backend: 导数计算后端，vector (VectorDerivative), fft (FFTDerivative) 或 python (_derivative)
+    sink: 轨迹接收器 (见sinks.py)，默认为内存中的数组 ArraySink
+    reducers: 在线统计量 (见reducers.py)，每个时间步更新一次，积分结束后由 reducers.summarize 得到结果
+    checkpoints: 生成检查点的时刻 (见checkpoints.py)，取最近的步，检查点 Checkpoint 交给 on_checkpoint(checkpoint)
+    resume: 从检查点继续演化，time_span[0], step, sampling 须与生成检查点时一致；
+        reducers 须为 resume.restore_reducers() 恢复的统计量，返回的轨迹只包含第 resume.sample 个采样起的部分
+    profile: 性能统计 (见profiling.py)，记录导数计算次数、步数、各阶段的时间与写入的字节数，None 时不统计
+    workers: 导数计算的线程数，大于 1 时 vector 后端按城市块多线程计算 (见TiledDerivative)
 
     Return:
         time: np.ndarray, shape=(N,), 时间序列
-        track: np.ndarray, shape=(N, H, W, 4), 演化轨迹
+        track: np.ndarray, shape=(N, H, W, 4), 演化轨迹，批量模拟时 shape=(B, N, H, W, 4)；类型由 sink 决定
     """
     steps = int((time_span[1] - time_span[0]) / step) + 1
     n_sample = (steps - 1) // sampling + 1
     ts = time_span[0] + step * np.arange(steps)  # 计算时间序列
-    time = time_span[0] + step * np.arange(n_sample)  # 采样时间序列
-    track = np.zeros((n_sample, *initials.shape))
+    time = time_span[0] + step * sampling * np.arange(n_sample)  # 采样时间序列
+    profile = DISABLED if profile is None else profile
+    derivative = profile.derivative(_backend(country, backend, workers))
+    x, reduce = _start(country, initials, time_span, step, sampling, 'Euler', derivative, reducers, resume, profile)
+    ckpt = _Checkpoints(checkpoints, on_checkpoint, 'Euler', time_span, step, sampling, initials, reduce, resume)
+    start = 0 if resume is None else resume.index
+    k0 = 0 if resume is None else resume.sample  # 已写入的采样数
+    sink = profile.sink(ArraySink() if sink is None else sink)
+    sink.open(time[k0:], initials.shape, _batched(country, initials))
 
-    x = initials.copy()
-    for idx in range(steps):
+    for idx in range(start, steps):
+        if idx in ckpt.indices:
+            ckpt.emit(ts[idx], x, step, idx, -(-idx // sampling))
         if idx % sampling == 0:
-            track[idx // sampling] = x
+            sink.write(idx // sampling - k0, x)
 
-        x += _derivative(country, x, ts[idx]) * step
+        x_old = x
+        x = x + derivative(x, ts[idx]) * step
+        profile.step(ts[idx] + step)
+        if idx + 1 < steps:
+            reduce.step(ts[idx], x_old, ts[idx + 1], x)
 
-    return time, track
+    return time[k0:], sink.close(n_sample - k0)
 
 
 def RK4(country: "Country", initials: "np.ndarray, shape=(H, W, 4)", time_span: "list[float, float]",
-        step: "float" = 0.1, sampling: "int" = 1) -> "(time, track)":
+        step: "float" = 0.1, sampling: "int" = 1,
+        backend: "'vector', 'fft' or 'python'" = "vector", sink: "Sink" = None,
+        reducers: "list(reducers.Reducer)" = (), checkpoints: "list[float]" = (), on_checkpoint=None,
+        resume: "Checkpoint" = None, profile: "profiling.Profile" = None, workers: "int" = 1) -> "(time, track)":
     """
     RK4方法。
     initials: 初始状态。前两个维度为城市矩阵的形状，即 country.shape == initials.shape[:2]，第三个维度为4，
-        即 initials[a][b] = [S, E, I, R] 为 City_ab 的初始SEIR状态
+        即 initials[a][b] = [S, E, I, R] 为 City_ab 的初始SEIR状态。
+        批量模拟时 initials.shape=(B, H, W, 4)，B 个场景同时演化，各场景的参数见schedules.py
     time_span: 演化时间范围
     step: 演化时间步长
     sampling: 采样间隔，即每sampling个step记录一次系统状态。
+    backend: 导数计算后端，vector (VectorDerivative), fft (FFTDerivative) 或 python (_derivative)
+    sink: 轨迹接收器 (见sinks.py)，默认为内存中的数组 ArraySink
+    reducers: 在线统计量 (见reducers.py)，每个时间步更新一次，积分结束后由 reducers.summarize 得到结果
+    checkpoints: 生成检查点的时刻 (见checkpoints.py)，取最近的步，检查点 Checkpoint 交给 on_checkpoint(checkpoint)
+    resume: 从检查点继续演化，time_span[0], step, sampling 须与生成检查点时一致；
+        reducers 须为 resume.restore_reducers() 恢复的统计量，返回的轨迹只包含第 resume.sample 个采样起的部分
+    profile: 性能统计 (见profiling.py)，记录导数计算次数、步数、各阶段的时间与写入的字节数，None 时不统计
+    workers: 导数计算的线程数，大于 1 时 vector 后端按城市块多线程计算 (见TiledDerivative)
 
     Return:
         time: np.ndarray, shape=(N,), 时间序列
-        track: np.ndarray, shape=(N, H, W, 4), 演化轨迹
+        track: np.ndarray, shape=(N, H, W, 4), 演化轨迹，批量模拟时 shape=(B, N, H, W, 4)；类型由 sink 决定
     """
     steps = int((time_span[1] - time_span[0]) / step) + 1
     n_sample = (steps - 1) // sampling + 1
     ts = time_span[0] + step * np.arange(steps)  # 计算时间序列
-    time = time_span[0] + step * np.arange(n_sample)  # 采样时间序列
-    track = np.zeros((n_sample, *initials.shape))
+    time = time_span[0] + step * sampling * np.arange(n_sample)  # 采样时间序列
+    profile = DISABLED if profile is None else profile
+    derivative = profile.derivative(_backend(country, backend, workers))
+    x, reduce = _start(country, initials, time_span, step, sampling, 'RK4', derivative, reducers, resume, profile)
+    ckpt = _Checkpoints(checkpoints, on_checkpoint, 'RK4', time_span, step, sampling, initials, reduce, resume)
+    start = 0 if resume is None else resume.index
+    k0 = 0 if resume is None else resume.sample  # 已写入的采样数
+    sink = profile.sink(ArraySink() if sink is None else sink)
+    sink.open(time[k0:], initials.shape, _batched(country, initials))
 
-    x = initials.copy()
-    for idx in range(steps):
+    for idx in range(start, steps):
+        if idx in ckpt.indices:
+            ckpt.emit(ts[idx], x, step, idx, -(-idx // sampling))
         if idx % sampling == 0:
-            track[idx // sampling] = x
+            sink.write(idx // sampling - k0, x)
             # print(f"city22 = {x[2,2,:]}, day = {idx * step:.2f}")
 
         t = ts[idx]
-        k1 = _derivative(country, x, t)
+        k1 = derivative(x, t)
+        f0 = k1.copy() if reduce.reducers else None
         k = k1
-        k1 = _derivative(country, x + k1 * step / 2, t + step / 2)
+        k1 = derivative(x + k1 * step / 2, t + step / 2)
         k += k1 * 2
-        k1 = _derivative(country, x + k1 * step / 2, t + step / 2)
+        k1 = derivative(x + k1 * step / 2, t + step / 2)
         k += k1 * 2
-        k1 = _derivative(country, x + k1 * step, t + step)
+        k1 = derivative(x + k1 * step, t + step)
         k += k1
-        x += k * step / 6.
+        x_old = x
+        x = x + k * step / 6.
+        profile.step(t + step)
+        if idx + 1 < steps:
+            reduce.step(t, x_old, ts[idx + 1], x, f0)
+
+    return time[k0:], sink.close(n_sample - k0)
+
+
+# Dormand-Prince 5(4) 系数
+_DP_C = np.array([0., 1 / 5, 3 / 10, 4 / 5, 8 / 9, 1.])
+_DP_A = [np.array([]),
+         np.array([1 / 5]),
+         np.array([3 / 40, 9 / 40]),
+         np.array([44 / 45, -56 / 15, 32 / 9]),
+         np.array([19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729]),
+         np.array([9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656])]
+_DP_B = np.array([35 / 384, 0., 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84])
+_DP_E = np.array([-71 / 57600, 0., 71 / 16695, -71 / 1920, 17253 / 339200, -22 / 525, 1 / 40])  # 5阶与4阶解之差
+# 稠密输出: y(t + s * h) = y + h * sum_k K_k * (P[k] @ [s, s^2, s^3, s^4])
+_DP_P = np.array([
+    [1., -8048581381 / 2820520608, 8663915743 / 2820520608, -12715105075 / 11282082432],
+    [0., 0., 0., 0.],
+    [0., 131558114200 / 32700410799, -68118460800 / 10900136933, 87487479700 / 32700410799],
+    [0., -1754552775 / 470086768, 14199869525 / 1410260304, -10690763975 / 1880347072],
+    [0., 127303824393 / 49829197408, -318862633887 / 49829197408, 701980252875 / 199316789632],
+    [0., -282668133 / 205662961, 2019193451 / 616988883, -1453857185 / 822651844],
+    [0., 40617522 / 29380423, -110615467 / 29380423, 69997945 / 29380423]])
+
+
+class _DenseOutput(object):
+    """
+    一个 RK45 步 [t, t + h] 内的四阶插值
+    """
+    def __init__(self, t, h, x, K):
+        self.t = self.t0 = t
+        self.t1 = t + h
+        self.h = h
+        self.x = x
+        self.Q = np.tensordot(_DP_P.T, K, axes=1) if K is not None else None  # shape=(4, *x.shape)
+
+    def __call__(self, t: "float") -> "np.ndarray":
+        s = (t - self.t) / self.h
+        return self.x + self.h * np.tensordot([s, s ** 2, s ** 3, s ** 4], self.Q, axes=1)
+
+    def derivative(self, t: "float") -> "np.ndarray":
+        s = (t - self.t) / self.h
+        return np.tensordot([1., 2 * s, 3 * s ** 2, 4 * s ** 3], self.Q, axes=1)
+
+    def component(self, t: "np.ndarray", k: "int") -> "np.ndarray":
+        """
+        第 k 个变量，t 可以是能广播到 x[..., k] 的数组
+        """
+        s = (t - self.t) / self.h
+        Q = self.Q[..., k]
+        return self.x[..., k] + self.h * s * (Q[0] + s * (Q[1] + s * (Q[2] + s * Q[3])))
+
+    def reshape(self, shape: "tuple") -> "_DenseOutput":
+        dense = _DenseOutput(self.t, self.h, self.x.reshape(shape), None)
+        dense.Q = self.Q.reshape(4, *dense.x.shape)
+        dense.t1 = self.t1
+        return dense
+
+    def truncate(self, t1: "float") -> "_DenseOutput":
+        """
+        只用于 [t0, t1] 的同一插值，如终止事件所在的步
+        """
+        dense = copy.copy(self)
+        dense.t1 = t1
+        return dense
+
+    def project(self, view) -> "_DenseOutput":
+        """
+        线性映射 view (如 SEIR 视图，见_seir_view) 作用后的插值
+        """
+        dense = _DenseOutput(self.t, self.h, view(self.x), None)
+        dense.Q = view(self.Q)
+        dense.t1 = self.t1
+        return dense
+
+
+def _locate(g, t0, t1, g0, g1, tol):
+    """
+    在 [t0, t1] 内以二分法结合割线法定位 g(t) 的零点
+    """
+    for _ in range(100):
+        if t1 - t0 <= tol:
+            break
+        t = t0 - g0 * (t1 - t0) / (g1 - g0) if g1 != g0 else (t0 + t1) / 2
+        if not t0 + (t1 - t0) * 0.1 < t < t1 - (t1 - t0) * 0.1:
+            t = (t0 + t1) / 2
+        gt = g(t)
+        if np.sign(gt) == np.sign(g0):
+            t0, g0 = t, gt
+        else:
+            t1, g1 = t, gt
+    return t1
+
+
+def RK45(country: "Country", initials: "np.ndarray, shape=(H, W, 4)", time_span: "list[float, float]",
+         step: "float" = 0.1, sampling: "int" = 1, backend: "'vector', 'fft' or 'python'" = "vector",
+         rtol: "float" = 1e-6, atol: "float" = 1e-9, events: "list(events.Event)" = (),
+         sink: "Sink" = None, reducers: "list(reducers.Reducer)" = (), checkpoints: "list[float]" = (),
+         on_checkpoint=None, resume: "Checkpoint" = None, profile: "profiling.Profile" = None,
+         workers: "int" = 1) -> "(time, track, hits)":
+    """
+    自适应步长的 Dormand-Prince 5(4) 方法。步长由误差估计控制，采样时刻的状态由稠密输出插值得到。
+    initials, time_span, backend, sink, reducers, resume, profile, workers: 同 RK4，reducers 在步内使用稠密输出插值，
+        终止事件发生时只更新到该时刻 (批量模拟时为最后一个场景终止的时刻)
+    checkpoints, on_checkpoint: 同 RK4，步长会被截断以恰好落在检查点时刻上，检查点保存下一步的试探步长
+    step, sampling: 采样时刻为 time_span[0] + k * step * sampling，与 RK4 的采样时刻一致；step 同时作为初始步长
+    rtol, atol: 相对误差与绝对误差容限，绝对误差单位同 initials (万人)
+    events: 事件函数列表 (见events.py)，终止事件发生后停止积分，轨迹截止到该时刻之前的采样。
+        批量模拟时所有场景共用一个步长，各场景分别检测事件，终止事件发生后该场景之后的采样为 nan，
+        所有场景都终止后停止积分
+
+    Return:
+        time: np.ndarray, shape=(N,), 时间序列
+        track: np.ndarray, shape=(N, H, W, 4) or (B, N, H, W, 4), 演化轨迹
+        hits: dict, 事件名 -> np.ndarray, 该事件发生的时刻；批量模拟时为每个场景一个数组的列表
+    """
+    steps = int((time_span[1] - time_span[0]) / step) + 1
+    n_sample = (steps - 1) // sampling + 1
+    time = time_span[0] + step * sampling * np.arange(n_sample)  # 采样时间序列
+    batched = _batched(country, initials)
+
+    profile = DISABLED if profile is None else profile
+    derivative = profile.derivative(_backend(country, backend, workers))
+    x, reduce = _start(country, initials, time_span, step, sampling, 'RK45', derivative, reducers, resume, profile)
+    ckpt = _Checkpoints(checkpoints, on_checkpoint, 'RK45', time_span, step, sampling, initials, reduce, resume)
+    t_end = max([time[-1]] + ckpt.pending)
+    t = time[0] if resume is None else resume.t
+    h = step if resume is None else resume.h
+    k_sample = k0 = 0 if resume is None else resume.sample  # 已写入的采样数
+    sink = profile.sink(ArraySink() if sink is None else sink)
+    sink.open(time[k0:], initials.shape, batched)
+    f = derivative(x, t)
+    if resume is None:
+        sink.write(0, x)
+        k_sample = 1
+
+    # 事件函数的输入为 shape=(B, H*W, 4) 的状态 (仓室模型为 SEIR 视图)，返回 shape=(B,) 的值
+    B = initials.shape[0] if batched else 1
+    view = _seir_view(country)
+    for event in events:
+        event.initialize(view(initials.astype(float)).reshape(B, -1, 4))
+    if resume is None:
+        hits = [{event.name: [] for event in events} for _ in range(B)]
+        done = np.full(B, np.inf)  # 各场景终止事件发生的时刻
+    else:
+        hits = copy.deepcopy(resume.hits)
+        done = resume.done.copy()
+    g_old = [np.reshape(event(t, view(x).reshape(B, -1, 4), view(f).reshape(B, -1, 4)), B) for event in events]
+    K = np.empty((7, *x.shape))
+    if ckpt.next() <= t:
+        ckpt.emit(t, x, h, None, k_sample, hits, done)
+
+    while k_sample < n_sample or ckpt.pending:
+        t_stop = min(t_end, ckpt.next())
+        h = min(h, t_stop - t)
+        # 试探步
+        K[0] = f
+        for s in range(1, 6):
+            K[s] = derivative(x + h * np.tensordot(_DP_A[s], K[:s], axes=1), t + _DP_C[s] * h)
+        x_new = x + h * np.tensordot(_DP_B, K[:6], axes=1)
+        t_new = t + h if t_stop - (t + h) > 1e-12 * max(1., abs(t_stop)) else t_stop
+        f_new = derivative(x_new, t_new)
+        K[6] = f_new
+        scale = atol + rtol * np.maximum(np.abs(x), np.abs(x_new))
+        err = np.sqrt(np.mean((h * np.tensordot(_DP_E, K, axes=1) / scale) ** 2))
+        if not err <= 1.:
+            h *= max(0.2, 0.9 * err ** -0.2) if np.isfinite(err) else 0.2
+            profile.step(t, accepted=False)
+            continue
+
+        # 接受该步：检测事件，稠密输出插值采样
+        dense = _DenseOutput(t, h, x, K)
+        profile.step(t_new)
+        profile.mark()
+        for idx, event in enumerate(events):
+            g_new = np.reshape(event(t_new, view(x_new).reshape(B, -1, 4), view(f_new).reshape(B, -1, 4)), B)
+            g0 = g_old[idx]
+            if event.direction > 0:
+                crossed = (g0 < 0) & (g_new >= 0)
+            elif event.direction < 0:
+                crossed = (g0 > 0) & (g_new <= 0)
+            else:
+                crossed = np.sign(g0) != np.sign(g_new)
+            for b in np.nonzero(crossed & (done > t))[0]:
+                def g(tt, b=b, event=event):
+                    xt, ft = view(dense(tt)).reshape(B, -1, 4), view(dense.derivative(tt)).reshape(B, -1, 4)
+                    return event(tt, xt, ft)[b]
+                t_hit = _locate(g, t, t_new, g0[b], g_new[b], 1e-10 * max(1., abs(t_new)))
+                hits[b][event.name].append(t_hit)
+                if event.terminal:
+                    done[b] = min(done[b], t_hit)
+            g_old[idx] = g_new
+        if events:
+            profile.lap('event callables')
+        t_cut = min(t_new, done.max())  # 终止事件所在的步，统计量只更新到终止时刻
+        if t_cut < t_new:
+            reduce.step(t, x, t_cut, dense(t_cut), dense=dense.truncate(t_cut))
+        else:
+            reduce.step(t, x, t_new, x_new, dense=dense)
+        while k_sample < n_sample and time[k_sample] <= t_new:
+            x_sample = dense(time[k_sample])
+            if batched:
+                x_sample[done < time[k_sample]] = np.nan
+            sink.write(k_sample - k0, x_sample)
+            k_sample += 1
+        if done.max() <= t_new:
+            n_sample = int((time <= done.max()).sum())
+            time = time[:n_sample]
+            break
+
+        t, x, f = t_new, x_new, f_new
+        h *= min(10., 0.9 * err ** -0.2) if err > 0 else 10.
+        if ckpt.next() <= t:
+            ckpt.emit(t, x, h, None, k_sample, hits, done)
+
+    track = sink.close(n_sample - k0)
+    hits = {name: [np.array(hb[name]) for hb in hits] for name in hits[0]}
+    return time[k0:], track, hits if batched else {name: v[0] for name, v in hits.items()}
+
+
+class _Jacobian(object):
+    """
+    扩展SEIR方程的 Jacobian，按交通图的结构稀疏存储，不构造 (4n, 4n) 矩阵：
+        local -> np.ndarray, shape=(..., n, 4, 4), 各城市SEIR方程本项的 4x4 Jacobian 分块
+        migration -> list((g, weight)), zipf迁移 N_b * inflow(x)_b - x_b * rate(N)_b，其中
+            inflow(x)_b = sum_a(weight[a, b] * x_a), rate(N)_b = sum_c(weight[b, c] * N_c)，N = sum(x)，因此
+            J_M v = N * inflow(v) - v * rate(N) + sum(v) * inflow(x) - x * rate(sum(v))，非零元沿交通图的边分布
+        linear -> list((g, weight, out)), 线性迁移 inflow(x) - x * out，Jacobian 即其本身
+        mobility, counted -> np.ndarray, shape=(K,), 仓室模型 (见compartments.py) 各变量的迁移倍率与是否计入 N，
+            此时分块为 (K, K)，N = x @ counted，迁移项乘以 mobility；默认为SEIR模型 (K = 4，全部为 1)
+    恒定的输入输出与 x 无关；自定义函数被忽略，ROS2 是 W 方法，Jacobian 近似不降低其阶数，只影响稳定性。
+    local 不含感染对潜伏等仓室的增益 (易感者减少的一侧保留)：流行增长对应正的特征值，隐式处理时 I - g h J
+    在 g h λ = 1 附近奇异、大步长的结果远离真解，因此与迁移、恢复等耗散项分开，显式处理 (IMEX)
+    """
+    def __init__(self, local: "np.ndarray", x: "np.ndarray", N: "np.ndarray", migration: "list", linear: "list" = (),
+                 mobility: "np.ndarray" = None, counted: "np.ndarray" = None):
+        self.local = local
+        self.x = x
+        self.N = N
+        self.migration = migration
+        self.linear = linear
+        self.mobility = 1. if mobility is None else mobility
+        self.counted = counted
+        eye = np.eye(x.shape[-1])
+        # 预条件用的分块对角部分 (没有自环，weight[b, b] = 0)：本项、-rate(N) 与 sum(v) * inflow(x) 中 v_b 的作用
+        self.rates = [weight.rate(N) for g, weight in migration]
+        self.inflows = [weight.inflow(x) for g, weight in migration]
+        self.block = local.copy()
+        for (g, weight), rate, inflow in zip(migration, self.rates, self.inflows):
+            self.block -= (g * rate[..., None] * self.mobility)[..., None] * eye
+            column = (g * self.mobility * inflow)[..., None]
+            self.block += column if counted is None else column * counted
+        for g, weight, out in linear:
+            self.block -= (g * np.broadcast_to(out, N.shape)[..., None] * self.mobility)[..., None] * eye
+
+    def __call__(self, v: "np.ndarray, shape=(..., n, 4)") -> "np.ndarray, shape=(..., n, 4)":
+        out = np.einsum('...ij,...j->...i', self.local, v)
+        Nv = v.sum(axis=-1) if self.counted is None else v @ self.counted
+        for (g, weight), rate, inflow in zip(self.migration, self.rates, self.inflows):
+            out += g * self.mobility * (self.N[..., None] * weight.inflow(v) - v * rate[..., None]
+                                        + Nv[..., None] * inflow - self.x * weight.rate(Nv)[..., None])
+        for g, weight, rate in self.linear:
+            out += g * self.mobility * (weight.inflow(v) - v * rate[:, None])
+        return out
+
+    def solve(self, b: "np.ndarray, shape=(..., n, 4)", gh: "float", tol: "float" = 1e-10,
+              maxiter: "int" = 100) -> "(k, converged)":
+        """
+        求解 (I - gh * J) k = b。没有迁移时直接求解各城市的 4x4 方程组，否则以 BiCGSTAB 迭代求解，
+        预条件为去掉城市间耦合后的分块对角矩阵 (分块 Jacobi)。
+        返回解与是否收敛；分块奇异 (无法构造预条件) 时返回 (None, False)，由调用者缩小步长 gh 重试
+        """
+        try:
+            inverse = np.linalg.inv(np.eye(self.x.shape[-1]) - gh * self.block)
+        except np.linalg.LinAlgError:
+            return None, False
+
+        def precondition(v):
+            return np.einsum('...ij,...j->...i', inverse, v)
+
+        if not self.migration and not self.linear:
+            k = precondition(b)
+            return k, bool(np.all(np.isfinite(k)))
+        return _bicgstab(lambda v: v - gh * self(v), b, precondition, tol, maxiter)
+
+
+def _bicgstab(A, b: "np.ndarray", M, tol: "float", maxiter: "int") -> "(x, converged)":
+    """
+    右预条件的 BiCGSTAB，A(v) 与 M(v) 为矩阵与预条件的作用，批量状态的各场景合为一个方程组求解。
+    返回近似解与残差是否降到 tol * |b| 以下；达到 maxiter 或迭代中断 (rho = 0 或 omega = 0) 时为未收敛
+    """
+    x = M(b)
+    r = b - A(x)
+    r0 = r.copy()
+    bound = tol * max(np.linalg.norm(b), np.finfo(float).tiny)
+    rho = alpha = omega = 1.
+    v = p = np.zeros_like(b)
+    for _ in range(maxiter):
+        if np.linalg.norm(r) <= bound:
+            return x, True
+        rho_new = np.vdot(r0, r)
+        if rho_new == 0:
+            break
+        p = r + (rho_new / rho) * (alpha / omega) * (p - omega * v)
+        p_hat = M(p)
+        v = A(p_hat)
+        alpha = rho_new / np.vdot(r0, v)
+        s = r - alpha * v
+        x = x + alpha * p_hat
+        if np.linalg.norm(s) <= bound:
+            return x, True
+        s_hat = M(s)
+        As = A(s_hat)
+        omega = np.vdot(As, s) / np.vdot(As, As)
+        x = x + omega * s_hat
+        r = s - omega * As
+        rho = rho_new
+        if omega == 0:
+            break
+    return x, bool(np.linalg.norm(r) <= bound)
+
+
+_ROS2_GAMMA = 1. + 1. / np.sqrt(2.)
+_ROS2_NEGATIVE = 1e-6  # 子步使某个变量低于 -_ROS2_NEGATIVE * (该城市各变量绝对值之和) 时拒绝
+_ROS2_MIN_STEP = 2. ** -30  # 子步长与 step 之比的下限
+
+
+def _ros2_step(derivative, jacobian: "_Jacobian", x: "np.ndarray", f0: "np.ndarray", t: "float", h: "float",
+               flat: "tuple", profile) -> "np.ndarray or None":
+    """
+    从 (t, x) 以步长 h 走一个 ROS2 步，f0 = f(t, x)。分块奇异、线性求解未收敛、结果非有限或出现负值时返回 None
+    """
+    gh = _ROS2_GAMMA * h
+    profile.mark()
+    k1, ok = jacobian.solve(f0.reshape(flat), gh)
+    profile.lap('linear solve')
+    if not ok:
+        return None
+    k1 = k1.reshape(x.shape)
+    f1 = derivative(x + h * k1, t + h)
+    profile.mark()
+    k2, ok = jacobian.solve((f1 - 2 * k1).reshape(flat), gh)
+    profile.lap('linear solve')
+    if not ok:
+        return None
+    x_new = x + h * (1.5 * k1 + 0.5 * k2.reshape(x.shape))
+    old, new = x.reshape(flat), x_new.reshape(flat)
+    floor = np.minimum(old, 0.) - _ROS2_NEGATIVE * np.abs(old).sum(axis=-1, keepdims=True)
+    if not np.all(np.isfinite(new)) or np.any(new < floor):
+        return None
+    return x_new
+
+
+def ROS2(country: "Country", initials: "np.ndarray, shape=(H, W, 4)", time_span: "list[float, float]",
+         step: "float" = 0.1, sampling: "int" = 1,
+         backend: "'vector' or 'fft'" = "vector", sink: "Sink" = None,
+         reducers: "list(reducers.Reducer)" = (), checkpoints: "list[float]" = (), on_checkpoint=None,
+         resume: "Checkpoint" = None, profile: "profiling.Profile" = None, workers: "int" = 1) -> "(time, track)":
+    """
+    二阶 L 稳定的 Rosenbrock 方法 ROS2 (Verwer et al., 1999)，用于刚性问题 (zipf迁移系数大、城市间距离小或 r 大)：
+        (I - g h J) k1 = f(t, x)
+        (I - g h J) k2 = f(t + h, x + h k1) - 2 k1
+        x_new = x + 3/2 h k1 + 1/2 h k2,    g = 1 + 1/sqrt(2)
+    J 为每步在当前状态处的稀疏 Jacobian (见_Jacobian)，只有城市内的 4x4 分块与沿交通图的迁移算子，
+    线性方程组由分块 Jacobi 预条件的 BiCGSTAB 求解。每步计算两次导数与两次线性求解，开销约为 RK4 的一到数倍，
+    但步长不受迁移与感染速率的稳定性限制，刚性问题可以使用远大于 RK4 的步长。
+    线性化只在 x 处成立，感染快速增长时大步长可能产生负值或不可逆的分块：此时拒绝该步，在 [t, t + step] 内
+    以减半的子步长重试，接受后子步长逐次加倍直到恢复 step；子步长低于 step * 2^-30 仍失败时抛出 RuntimeError。
+    步长较大时精度为二阶方法的精度，需要准确的结果时应减小 step 或使用 RK45。
+    参数与返回值同 RK4，backend 只能为 vector 或 fft；自定义的转移函数不进入 Jacobian，仍然显式处理
+    """
+    if backend not in ("vector", "fft"):
+        raise ValueError("method 'ROS2' requires backend 'vector' or 'fft'")
+    steps = int((time_span[1] - time_span[0]) / step) + 1
+    n_sample = (steps - 1) // sampling + 1
+    ts = time_span[0] + step * np.arange(steps)  # 计算时间序列
+    time = time_span[0] + step * sampling * np.arange(n_sample)  # 采样时间序列
+    profile = DISABLED if profile is None else profile
+    vector = _backend(country, backend, workers)
+    derivative = profile.derivative(vector)
+    x, reduce = _start(country, initials, time_span, step, sampling, 'ROS2', derivative, reducers, resume, profile)
+    ckpt = _Checkpoints(checkpoints, on_checkpoint, 'ROS2', time_span, step, sampling, initials, reduce, resume)
+    start = 0 if resume is None else resume.index
+    k0 = 0 if resume is None else resume.sample  # 已写入的采样数
+    sink = profile.sink(ArraySink() if sink is None else sink)
+    sink.open(time[k0:], initials.shape, _batched(country, initials))
+    flat = (*initials.shape[:initials.ndim - len(country.shape) - len(country.stateShape)], country.size, -1)
+    h = step  # 子步长
+
+    for idx in range(start, steps):
+        if idx in ckpt.indices:
+            ckpt.emit(ts[idx], x, step, idx, -(-idx // sampling))
+        if idx % sampling == 0:
+            sink.write(idx // sampling - k0, x)
+        if idx + 1 == steps:
+            break
+
+        t, t_next = ts[idx], ts[idx + 1]
+        while t < t_next:
+            h = min(h, t_next - t)
+            f0 = derivative(x, t)
+            profile.mark()
+            jacobian = vector.jacobian(x, t)
+            profile.lap('linear solve')
+            x_new = _ros2_step(derivative, jacobian, x, f0, t, h, flat, profile)
+            while x_new is None:
+                profile.step(t, accepted=False)
+                h /= 2
+                if h < step * _ROS2_MIN_STEP:
+                    raise RuntimeError(f"ROS2 failed at t = {t}: step size underflow")
+                x_new = _ros2_step(derivative, jacobian, x, f0, t, h, flat, profile)
+            t_new = t + h if t_next - (t + h) > 1e-12 * max(1., abs(t_next)) else t_next
+            profile.step(t_new)
+            reduce.step(t, x, t_new, x_new, f0)
+            t, x = t_new, x_new
+            h = min(2 * h, step)
 
-    return time, track
+    return time[k0:], sink.close(n_sample - k0)
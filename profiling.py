@@ -0,0 +1,214 @@
+# -*- encoding:utf-8 -*-
+"""
+演化过程的性能统计。SimCountry.evolute(..., profile=True) 开启统计，结果为 SimCountry.stats (Profile)：
+    rhs: 导数计算次数
+    accepted, rejected: 接受与拒绝的步数 (Euler/RK4 没有被拒绝的步)
+    phases: 各阶段的累计时间 (秒)，见下表
+    samples, bytes: 写入接收器 (见sinks.py) 的采样数与字节数，SimCountry.save 写入的字节数也计入 bytes
+    wall: 演化的总耗时
+progress 回调每隔 interval 秒收到一次 Progress(t, fraction, elapsed, eta, profile)，用于显示进度与预计剩余时间。
+
+导数计算内部的阶段：
+    parameters: 声明式参数 (schedules.py) 的向量化求值
+    seir: SEIR方程本项的数组运算
+    aggregation: python 后端逐城市对输入输出边的流量求和
+    migration: zipf迁移 (权重矩阵或FFT卷积) 与线性迁移
+    const transfer: 恒定的城市间输入输出
+    tiles: 多线程分块计算 (numerical.TiledDerivative) 中各块的SEIR方程本项、迁移与恒定输入输出
+    parameter callables, transfer callables, disturbance callables: 逐城市、逐条边调用的自定义函数
+积分器中的阶段：
+    reducers: 在线统计量 (reducers.py) 的更新
+    event callables: RK45 的事件函数
+    linear solve: ROS2 的 Jacobian 与线性方程组求解
+    sink: 写入接收器，即采样复制到轨迹或写入磁盘
+    save: SimCountry.save
+名称以 callables 结尾的阶段为用户函数，其余为向量化计算，分别由 Profile.callables 与 Profile.vectorized 汇总。
+
+关闭统计时 (默认) 数值算法使用空操作的 DISABLED，每次导数计算只多出几次空函数调用。
+---------------------------------------------------------------
+Example:
+
+    def show(p):
+        print(f"t={p.t:.1f} {p.fraction:.0%} eta {p.eta:.0f}s")
+
+    china.evolute(initials, [0., 360.], profile=True, progress=show)
+    print(china.stats)
+"""
+import time
+from collections import namedtuple
+
+
+class _Disabled(object):
+    """
+    关闭统计时的空操作，数值算法无需判断是否开启统计
+    """
+    def derivative(self, derivative):
+        return derivative
+
+    def sink(self, sink):
+        return sink
+
+    def mark(self):
+        pass
+
+    def lap(self, name: "str"):
+        pass
+
+    def step(self, t: "float", accepted: "bool" = True):
+        pass
+
+
+DISABLED = _Disabled()
+
+_VECTORIZED = ('parameters', 'seir', 'aggregation', 'migration', 'const transfer', 'tiles', 'linear solve')
+
+Progress = namedtuple('Progress', ['t', 'fraction', 'elapsed', 'eta', 'profile'])
+
+
+class Profile(_Disabled):
+    """
+    progress -> callable(Progress), 进度回调，None 时不回调
+    interval -> float, 两次进度回调之间的最短间隔 (秒)，演化结束时总会回调一次
+    """
+    def __init__(self, progress=None, interval: "float" = 1.):
+        self.progress = progress
+        self.interval = interval
+        self.rhs = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.samples = 0
+        self.bytes = 0
+        self.wall = 0.
+        self.phases = {}
+        self._last = time.perf_counter()
+
+    def derivative(self, derivative):
+        """
+        统计导数计算次数，并使导数后端记录其内部各阶段的时间
+        """
+        derivative.clock = self
+        return _Counted(derivative, self)
+
+    def sink(self, sink: "sinks.Sink") -> "sinks.Sink":
+        return _TimedSink(sink, self)
+
+    def mark(self):
+        """
+        开始计时，之后的 lap 记录自此以来的时间
+        """
+        self._last = time.perf_counter()
+
+    def lap(self, name: "str"):
+        """
+        将自上次 mark 或 lap 以来的时间记入阶段 name
+        """
+        now = time.perf_counter()
+        self.phases[name] = self.phases.get(name, 0.) + now - self._last
+        self._last = now
+
+    def add(self, name: "str", seconds: "float"):
+        self.phases[name] = self.phases.get(name, 0.) + seconds
+
+    def start(self, t0: "float", t1: "float"):
+        """
+        演化 [t0, t1] 开始
+        """
+        self.t0, self.t1 = t0, t1
+        self._begin = self._next = time.perf_counter()
+        self._base = self.wall
+
+    def step(self, t, accepted=True):
+        """
+        完成一个时间步，t 为该步的终点，被拒绝的步 accepted=False
+        """
+        if accepted:
+            self.accepted += 1
+        else:
+            self.rejected += 1
+        if self.progress is not None:
+            now = time.perf_counter()
+            if now >= self._next:
+                self._next = now + self.interval
+                self._report(t, now)
+
+    def finish(self, t: "float"):
+        now = time.perf_counter()
+        self.wall = self._base + now - self._begin
+        if self.progress is not None:
+            self._report(t, now)
+
+    def _report(self, t, now):
+        elapsed = now - self._begin
+        span = self.t1 - self.t0
+        fraction = min(max((t - self.t0) / span, 0.), 1.) if span > 0 else 1.
+        eta = elapsed * (1 - fraction) / fraction if fraction > 0 else float('inf')
+        self.progress(Progress(t, fraction, elapsed, eta, self))
+
+    @property
+    def callables(self) -> "float":
+        """
+        用户函数的累计时间
+        """
+        return sum(v for k, v in self.phases.items() if k.endswith('callables'))
+
+    @property
+    def vectorized(self) -> "float":
+        """
+        导数计算与线性求解中向量化部分的累计时间
+        """
+        return sum(self.phases.get(k, 0.) for k in _VECTORIZED)
+
+    def summary(self) -> "dict":
+        return {'rhs': self.rhs, 'accepted': self.accepted, 'rejected': self.rejected, 'samples': self.samples,
+                'bytes': self.bytes, 'wall': self.wall, 'callables': self.callables, 'vectorized': self.vectorized,
+                'phases': dict(self.phases)}
+
+    def __str__(self):
+        lines = [f"wall {self.wall:.3f} s, rhs {self.rhs}, steps {self.accepted} accepted / {self.rejected} rejected, "
+                 f"{self.samples} samples, {self.bytes / 2 ** 20:.2f} MiB written"]
+        for name, seconds in sorted(self.phases.items(), key=lambda item: -item[1]):
+            share = seconds / self.wall if self.wall > 0 else 0.
+            lines.append(f"    {name:<22} {seconds:10.4f} s {share:7.1%}")
+        lines.append(f"    {'(callables)':<22} {self.callables:10.4f} s")
+        lines.append(f"    {'(vectorized)':<22} {self.vectorized:10.4f} s")
+        return '\n'.join(lines)
+
+
+class _Counted(object):
+    """
+    统计导数计算次数，每次计算前开始计时
+    """
+    def __init__(self, derivative, profile: "Profile"):
+        self.derivative = derivative
+        self.profile = profile
+        self.infection = derivative.infection
+
+    def __call__(self, status, t):
+        self.profile.rhs += 1
+        self.profile.mark()
+        return self.derivative(status, t)
+
+
+class _TimedSink(object):
+    """
+    统计写入接收器的时间、采样数与字节数
+    """
+    def __init__(self, sink: "sinks.Sink", profile: "Profile"):
+        self.sink = sink
+        self.profile = profile
+
+    def open(self, time, shape, batched=False):
+        self.sink.open(time, shape, batched)
+
+    def write(self, k, x):
+        start = time.perf_counter()
+        self.sink.write(k, x)
+        self.profile.add('sink', time.perf_counter() - start)
+        self.profile.samples += 1
+        self.profile.bytes += x.nbytes
+
+    def close(self, n):
+        start = time.perf_counter()
+        track = self.sink.close(n)
+        self.profile.add('sink', time.perf_counter() - start)
+        return track
@@ -0,0 +1,230 @@
+# -*- encoding:utf-8 -*-
+"""
+积分过程中在线更新的统计量。数值算法 (numerical.py) 每完成一个时间步就更新一次各统计量，
+统计量只保存与城市数成正比的状态，配合 sinks.NullSink 即可在不保存轨迹的情况下得到 vision.report 所需的结果。
+PeakReducer: 某一人群 (默认 I) 的峰值及其时刻
+CrossingReducer: 某一人群 (默认 S) 首次降至初值一定比例的时刻，可在步内插值
+CumulativeReducer: 累计感染人数，即 S -> E 的感染速率对时间的积分
+自定义统计量继承 Reducer 并实现 start, update 和 result。
+
+统计量的输入状态 x 的形状为 (..., n, 4)，n 为城市数 (城市矩阵按行优先展平)，批量模拟时前面有场景维度 B。
+仓室模型 (见compartments.py) 的 x 为对分层与各组仓室求和的 S, E, I, R，感染速率为所有接触传染的流量之和。
+结果为 名称 -> np.ndarray, shape=(..., 1 + n)，第 0 列为全国，其余各列依次为各城市。
+"""
+import numpy as np
+
+
+class Reducer(object):
+    """
+    统计量基类
+    start(t, x, infection): 积分开始时调用，infection(x, t) -> np.ndarray, shape=(..., n), 各城市 S -> E 的感染速率，
+        由积分所用的导数后端给出，对已保存的轨迹统计时为 None。仓室模型中 x 须为交给统计量的状态本身
+        (start/update 的 x 或 interp(t) 的返回值)，其他数组没有对应的完整状态，抛出 ValueError
+    update(t, x, interp): 完成一个时间步时调用，interp 为该步 [interp.t0, interp.t1] 内的插值，
+        interp(t) 为 t 时刻的状态，interp.component(t, k) 为各城市第 k 个变量，t 可以是能广播到 shape=(..., n) 的数组。
+        RK45 使用稠密输出插值，Euler/RK4 使用以步起点导数修正的二次插值，已保存的轨迹使用线性插值 (见StepOutput)
+    result() -> dict, 名称 -> np.ndarray, shape=(..., 1 + n)
+    bind(infection): 从检查点恢复后代替 start 调用，统计量随检查点以 pickle 保存，不应保存 infection 等外部对象
+    -----------------------------------------------
+    Example:
+
+        class TotalMax(Reducer):  # 各城市总人口的最大值
+            def start(self, t, x, infection):
+                self.value = columns(x.sum(axis=-1))
+
+            def update(self, t, x, interp):
+                self.value = np.maximum(self.value, columns(x.sum(axis=-1)))
+
+            def result(self):
+                return {'N_max': self.value}
+    """
+    def start(self, t: "float", x: "np.ndarray, shape=(..., n, 4)", infection=None):
+        pass
+
+    def update(self, t: "float", x: "np.ndarray, shape=(..., n, 4)", interp: "StepOutput"):
+        pass
+
+    def bind(self, infection):
+        """
+        从检查点 (见checkpoints.py) 恢复后调用，代替 start
+        """
+        pass
+
+    def result(self) -> "dict":
+        return {}
+
+
+class StepOutput(object):
+    """
+    一个时间步 [t0, t1] 内的插值。f0 为 t0 时刻的导数，给出时为过两端点且在 t0 处导数为 f0 的二次插值，否则为线性插值
+    """
+    def __init__(self, t0: "float", x0: "np.ndarray", t1: "float", x1: "np.ndarray", f0: "np.ndarray" = None):
+        self.t0 = t0
+        self.t1 = t1
+        self.x0 = x0
+        self.x1 = x1
+        self.f0 = f0
+
+    def _at(self, t, x0, x1, f0):
+        h = self.t1 - self.t0
+        if f0 is None:
+            return x0 + (t - self.t0) / h * (x1 - x0)
+        tau = t - self.t0
+        return x0 + tau * f0 + (tau / h) ** 2 * (x1 - x0 - h * f0)
+
+    def __call__(self, t: "float") -> "np.ndarray":
+        return self._at(t, self.x0, self.x1, self.f0)
+
+    def component(self, t: "np.ndarray", k: "int") -> "np.ndarray":
+        return self._at(t, self.x0[..., k], self.x1[..., k], None if self.f0 is None else self.f0[..., k])
+
+
+def columns(values: "np.ndarray, shape=(..., n)") -> "np.ndarray, shape=(..., 1 + n)":
+    """
+    在各城市的值之前加上全国的总和
+    """
+    return np.concatenate([values.sum(axis=-1, keepdims=True), values], axis=-1)
+
+
+class PeakReducer(Reducer):
+    """
+    全国与各城市第 compartment 个人群的峰值，结果为 {name + '_time': 峰值时刻, name: 峰值}
+    """
+    def __init__(self, compartment: "int" = 2, name: "str" = "I_max"):
+        self.compartment = compartment
+        self.name = name
+
+    def start(self, t, x, infection=None):
+        self.value = columns(x[..., self.compartment])
+        self.time = np.full(self.value.shape, t, dtype=float)
+
+    def update(self, t, x, interp):
+        value = columns(x[..., self.compartment])
+        better = value > self.value
+        self.value = np.where(better, value, self.value)
+        self.time = np.where(better, t, self.time)
+
+    def result(self):
+        return {self.name + '_time': self.time, self.name: self.value}
+
+
+class CrossingReducer(Reducer):
+    """
+    全国与各城市第 compartment 个人群首次降至初值的 fraction 倍的时刻，结果为 {name + '_time': 时刻}
+    interpolate -> bool, False 时为降至该比例之前的最后一个时刻 (与原 vision.report 一致)，从未降至该比例时为最后时刻；
+        True 时在发生穿越的时间步内以二分法求插值的零点，得到比采样间隔和步长更精细的时刻，从未降至该比例时为 nan
+    """
+    def __init__(self, compartment: "int" = 0, fraction: "float" = 0.5, name: "str" = "S_50",
+                 interpolate: "bool" = False):
+        self.compartment = compartment
+        self.fraction = fraction
+        self.name = name
+        self.interpolate = interpolate
+
+    def start(self, t, x, infection=None):
+        value = columns(x[..., self.compartment])
+        self.threshold = self.fraction * value
+        self.crossed = value <= self.threshold
+        self.time = np.full(value.shape, t, dtype=float)
+
+    def _values(self, interp, t):
+        k = self.compartment
+        return np.concatenate([interp.component(t[..., :1], k).sum(axis=-1, keepdims=True),
+                               interp.component(t[..., 1:], k)], axis=-1)
+
+    def _locate(self, interp):
+        lo = np.full(self.time.shape, float(interp.t0))
+        hi = np.full(self.time.shape, float(interp.t1))
+        for _ in range(40):
+            mid = (lo + hi) / 2
+            above = self._values(interp, mid) > self.threshold
+            lo = np.where(above, mid, lo)
+            hi = np.where(above, hi, mid)
+        return hi
+
+    def update(self, t, x, interp):
+        new = ~self.crossed & (columns(x[..., self.compartment]) <= self.threshold)
+        if self.interpolate and new.any():
+            self.time = np.where(new, self._locate(interp), self.time)
+        self.crossed |= new
+        self.time = np.where(self.crossed, self.time, t)
+
+    def result(self):
+        if self.interpolate:
+            return {self.name + '_time': np.where(self.crossed, self.time, np.nan)}
+        return {self.name + '_time': self.time}
+
+
+class CumulativeReducer(Reducer):
+    """
+    全国与各城市的累计感染人数 (S -> E)，单位同 initials (万人)。每步以 Simpson 公式积分，步中点的状态由插值给出。
+    感染速率由积分所用的导数后端计算，因此只能在积分过程中使用，不能用于已保存的轨迹
+    """
+    def __init__(self, name: "str" = "infections"):
+        self.name = name
+
+    def start(self, t, x, infection=None):
+        if infection is None:
+            raise ValueError("CumulativeReducer must be updated by an integrator")
+        self.infection = infection
+        self.t = t
+        self.rate = infection(x, t)
+        self.total = np.zeros(self.rate.shape)
+
+    def bind(self, infection):
+        self.infection = infection
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('infection', None)  # 导数后端不随检查点保存
+        return state
+
+    def update(self, t, x, interp):
+        mid = (self.t + t) / 2
+        rate = self.infection(x, t)
+        self.total += (t - self.t) / 6 * (self.rate + 4 * self.infection(interp(mid), mid) + rate)
+        self.t = t
+        self.rate = rate
+
+    def result(self):
+        return {self.name: columns(self.total)}
+
+
+def report_reducers(interpolate: "bool" = False) -> "list(Reducer)":
+    """
+    vision.report 所需的统计量：I_max_time, I_max 和 S_50_time
+    """
+    return [PeakReducer(2, 'I_max'), CrossingReducer(0, 0.5, 'S_50', interpolate)]
+
+
+def summarize(reducers: "list(Reducer)") -> "dict":
+    """
+    合并各统计量的结果
+    """
+    summary = {}
+    for reducer in reducers:
+        summary.update(reducer.result())
+    return summary
+
+
+def reduce_track(time: "np.ndarray, shape=(N,)", track: "np.ndarray", reducers: "list(Reducer)",
+                 batched: "bool" = False, view=None) -> "dict":
+    """
+    对已保存的轨迹 (N, H, W, 4) 或批量轨迹 (B, N, H, W, 4) 逐个采样更新 reducers，采样之间线性插值，返回 summarize 的结果
+    view: 仓室模型的轨迹 (N, H, W, A, C) 各采样到 S, E, I, R 的映射 (见compartments.CompartmentModel.seir)
+    """
+    def sample(k):
+        x = np.asarray(track[:, k] if batched else track[k], dtype=float)
+        x = x if view is None else view(x)
+        return x.reshape(x.shape[0], -1, 4) if batched else x.reshape(-1, 4)
+
+    x = sample(0)
+    for reducer in reducers:
+        reducer.start(time[0], x)
+    for k in range(1, len(time)):
+        x_new = sample(k)
+        interp = StepOutput(time[k - 1], x, time[k], x_new)
+        for reducer in reducers:
+            reducer.update(time[k], x_new, interp)
+        x = x_new
+    return summarize(reducers)
@@ -0,0 +1,155 @@
+# -*- encoding:utf-8 -*-
+"""
+声明式的参数函数与转移函数。
+defaults.py 中的闭包只能逐城市、逐条边调用，此处的对象同样可以按原有签名调用 (可直接赋给 City.r 或 Traffic.transfer)，
+同时以 at(t) 给出 t 时刻的取值。numerical.VectorDerivative 对所有城市或所有边上相同的对象只求值一次，
+因而封城等随时间变化的策略也能完全向量化计算。
+
+参数 (用于 City().r/beta/h/theta/gamma):
+    Constant: 常数
+    Piecewise: 随时间分段变化的阶梯函数
+转移函数 (用于 Traffic().transfer):
+    ZipfTransfer: zipf人口迁移，可附加随时间变化的倍率 gate
+    ConstTransfer: 恒定迁移，可附加随时间变化的倍率 gate
+    LinearTransfer: 按边权重 (如 OD 矩阵的人均出行率) 的线性迁移，可附加随时间变化的倍率 gate
+
+不同城市使用不同的参数对象即可实现逐城市的设定，见 kernel.Country.set_parameter。
+
+批量模拟 (initials.shape=(B, H, W, 4)) 时，参数值与时间点可以是 shape=(B,) 的数组，每个场景取其中一个值，
+例如 Piecewise([[5., 10., 15., 10000.]], [20., 3.]) 为 4 个场景分别在第 5, 10, 15, 10000 天封城。
+数组形式的参数只能用于 vector 和 fft 后端。
+"""
+from abc import ABC, abstractmethod
+import numpy as np
+
+
+class Schedule(ABC):
+    """
+    随时间变化的参数，子类须实现 at(t)，未实现的子类不能实例化
+    """
+    kind = 'schedule'
+
+    @abstractmethod
+    def at(self, t: "float") -> "float":
+        pass
+
+    def __call__(self, status: "np.ndarray, shape=(4,)", t: "float") -> "float":
+        return self.at(t)
+
+
+class Constant(Schedule):
+    """
+    常数参数，批量模拟时 value 可以是 shape=(B,) 的数组
+    -----------------------------------
+    Example:
+
+        city.r = Constant(20.)
+        city.r = Constant([20., 10., 5.])  # 3 个场景
+    """
+    kind = 'const'
+
+    def __init__(self, value: "float or np.ndarray, shape=(B,)"):
+        self.value = value if np.ndim(value) == 0 else np.asarray(value, dtype=float)
+        self.args = (self.value,)
+
+    def at(self, t):
+        return self.value
+
+
+class Piecewise(Schedule):
+    """
+    阶梯函数，times[k - 1] <= t < times[k] 时取值 values[k]，len(values) == len(times) + 1
+    批量模拟时 times 可以是 shape=(K, B) 的数组，values 可以是 shape=(K + 1, B) 的数组
+    -----------------------------------
+    Example:
+
+        city.r = Piecewise([10.], [20., 3.])  # 第10天封城，r 由 20 降至 3
+        city.r = Piecewise([[5., 10.]], [20., 3.])  # 2 个场景，分别在第 5 和 10 天封城
+    """
+    kind = 'piecewise'
+
+    def __init__(self, times: "list[float]", values: "list[float]"):
+        self.times = np.asarray(times, dtype=float)
+        self.values = np.asarray(values, dtype=float)
+        if self.values.shape[0] != self.times.shape[0] + 1:
+            raise ValueError("Piecewise needs one more value than times")
+        self.args = (self.times, self.values)
+
+    def at(self, t):
+        idx = (t >= self.times).sum(axis=0)
+        if self.values.ndim == 1:
+            return self.values[idx]
+        idx = np.broadcast_to(idx, self.values.shape[1:])
+        return np.take_along_axis(self.values, idx[None], axis=0)[0]
+
+
+def _multiplier(gate, t):
+    return 1. if gate is None else gate.at(t)
+
+
+class ZipfTransfer(object):
+    """
+    zipf人口迁移函数，与 defaults.zipf_transfer 相同，迁移量再乘以倍率 gate.at(t)
+    gate -> Schedule, 可选，随时间变化的倍率，None 表示恒为 1
+    -----------------------------------
+    Example:
+
+        transfer = ZipfTransfer(gate=Piecewise([10.], [1., 0.]))  # 第10天起城市间不再有人口迁移
+    """
+    kind = 'zipf'
+
+    def __init__(self, K: "float" = 0.04, alpha: "float" = 2., gate: "Schedule" = None):
+        self.args = (K, alpha)
+        self.gate = gate
+
+    def __call__(self, start_status: "np.ndarray, shape=(4,)", end_status: "np.ndarray, shape=(4,)",
+                 t: "float", distance: "float") -> "np.ndarray, shape=(4,)":
+        K, alpha = self.args
+        Ns = start_status.sum()
+        Ne = end_status.sum()
+        Nt = K * Ns * Ne / distance ** alpha
+        flux = Nt / Ns * start_status
+        return flux if self.gate is None else flux * self.gate.at(t)
+
+    def multiplier(self, t: "float") -> "float":
+        return _multiplier(self.gate, t)
+
+
+class ConstTransfer(object):
+    """
+    恒定迁移函数，与 defaults.const_transfer 相同，迁移量再乘以倍率 gate.at(t)
+    """
+    kind = 'const'
+
+    def __init__(self, S: "float" = 0., E: "float" = 0., I: "float" = 0., R: "float" = 0., gate: "Schedule" = None):
+        self.args = (S, E, I, R)
+        self.gate = gate
+
+    def __call__(self, start_status: "np.ndarray, shape=(4,)", end_status: "np.ndarray, shape=(4,)",
+                 t: "float", distance: "float") -> "np.ndarray, shape=(4,)":
+        flux = np.array(self.args)
+        return flux if self.gate is None else flux * self.gate.at(t)
+
+    def multiplier(self, t: "float") -> "float":
+        return _multiplier(self.gate, t)
+
+
+class LinearTransfer(object):
+    """
+    线性迁移函数：边 a -> b 的迁移量为 rate * weight_e * X_a，weight_e 为边的权重 (kernel.Country.edgeWeight)，
+    由 OD 矩阵构造的网络 (见network.py) 中为人均出行率，即每天的出行人数除以出发城市的人口，与到达城市的人口无关；
+    迁移量再乘以倍率 gate.at(t)。逐条边调用时由调用者传入 weight
+    """
+    kind = 'linear'
+
+    def __init__(self, rate: "float" = 1., gate: "Schedule" = None):
+        self.args = (rate,)
+        self.gate = gate
+
+    def __call__(self, start_status: "np.ndarray, shape=(4,)", end_status: "np.ndarray, shape=(4,)",
+                 t: "float", distance: "float", weight: "float" = 1.) -> "np.ndarray, shape=(4,)":
+        flux = self.args[0] * weight * start_status
+        return flux if self.gate is None else flux * self.gate.at(t)
+
+    def multiplier(self, t: "float") -> "float":
+        return _multiplier(self.gate, t)
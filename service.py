@@ -0,0 +1,470 @@
+# -*- encoding:utf-8 -*-
+"""
+本地模拟服务。常驻的 asyncio 前端监听本机 TCP 端口，以 JSON lines 协议 (每行一个 JSON 对象) 接收场景，
+交给固定数量的 worker 进程演化，并把进度、采样状态与结果逐行推送给客户端。与逐个运行脚本相比省去了每次的
+导入与建图：worker 进程在启动时导入一次 (只导入 sweep 及其依赖，不导入 vision、matplotlib 与 pandas)，
+并按图的参数 (GRAPH) 保留最近使用的至多 graphs 个国家，同一张图的后续场景直接复用。
+
+场景的描述与 sweep.py 相同：config 为扫描配置 (见sweep.DEFAULTS)，scenario 为参数网格中的一项
+(lock_time, r_lock, K, alpha, seed_city, days，缺省时取 sweep.scenarios 的默认值)，结果为 sweep 结果表的一行。
+
+调度：请求按 (优先级, 到达顺序) 排队，单个场景 (run) 的默认优先级为 0，扫描 (sweep) 的各场景为 1 并按估计耗时从长到短排列，
+交互式的小场景不会排在大批扫描之后。空闲的 worker 优先领取已建好所需图的场景。演化配置、场景与推送选项完全相同的
+请求在排队或运行期间只演化一次，后来者收到已推送过的事件后继续接收同一场景的事件；客户端全部断开的排队场景不再演化。
+worker 进程崩溃时对应场景的状态为 crashed，随即启动新的 worker。
+
+请求 (客户端 -> 服务)：
+    {"op": "run", "id": ..., "config": {...}, "scenario": {...}, "stream": 0, "cities": false, "progress": 0.5,
+     "priority": 0}
+        stream: 每 stream 个时间步推送一次状态，0 时不推送；cities: 推送各城市的状态 (n, 4)，否则为全国的 [S, E, I, R]
+        progress: 进度推送的最短间隔 (秒)，null 时不推送。推送状态或进度时不使用结果缓存 (config 中的 cache)
+    {"op": "sweep", "id": ..., "config": {... "grid": {...}}, ...}
+        config 中参数网格的所有场景，其余选项同 run，默认 priority 为 1
+    {"op": "status", "id": ...}
+事件 (服务 -> 客户端，均带请求的 id，sweep 的场景事件另带场景编号 index)：
+    accepted {job, shared, queued}: 已排队，shared 为 true 时与进行中的相同请求合并
+    started {worker}, progress {t, fraction, elapsed, eta}, sample {t, state}
+    result {row}: sweep 结果表的一行 (见sweep.COLUMNS)，status 为 ok、error 或 crashed
+    done {ok, failed}: sweep 的所有场景完成
+    status {workers, queued, running}
+    error {error}: 请求无效
+---------------------------------------------------------------
+Example:
+
+    python service.py --workers 4 --warm sweep.json
+
+    for event in call({'op': 'run', 'config': {'shape': [5, 5]}, 'scenario': {'lock_time': 10}, 'stream': 100}):
+        print(event)
+
+    在其他程序中使用 Service 时，启动服务的代码须放在 if __name__ == '__main__' 之下 (worker 进程以 spawn 方式启动)
+"""
+import argparse
+import asyncio
+import hashlib
+import heapq
+import itertools
+import json
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from sweep import DEFAULTS, load_config, scenarios, cost, run_scenario, _row
+from simulation import SimCountry
+from reducers import Reducer
+from profiling import Profile
+from cache import Cache
+
+HOST = '127.0.0.1'
+PORT = 8765
+
+GRAPH = ('shape', 'min_distance', 'cutoff', 'k_nearest', 'tolerance', 'edges')  # 决定国家的图结构的配置项
+
+
+def graph_key(config: "dict") -> "str":
+    return json.dumps([config[key] for key in GRAPH])
+
+
+class _StreamReducer(Reducer):
+    """
+    每 stride 个时间步把全国 (cities 为 True 时为各城市) 的状态交给 emit(t, state)，不产生统计量
+    """
+    def __init__(self, emit, stride: "int", cities: "bool" = False):
+        self.emit = emit
+        self.stride = stride
+        self.cities = cities
+
+    def start(self, t, x, infection=None):
+        self.count = 0
+        self._send(t, x)
+
+    def update(self, t, x, interp):
+        self.count += 1
+        if self.count % self.stride == 0:
+            self._send(t, x)
+
+    def _send(self, t, x):
+        self.emit(float(t), (x if self.cities else x.sum(axis=-2)).tolist())
+
+
+def _country(countries: "OrderedDict", config: "dict", graphs: "int") -> "SimCountry":
+    """
+    按图的参数取出 (或新建) 国家，至多保留最近使用的 graphs 个
+    """
+    key = graph_key(config)
+    if key in countries:
+        countries.move_to_end(key)
+    else:
+        countries[key] = SimCountry(tuple(config['shape']), config['min_distance'], config['cutoff'],
+                                    config['k_nearest'], config['tolerance'], config['edges'])
+        while len(countries) > graphs:
+            countries.popitem(last=False)
+    return countries[key]
+
+
+def _worker_main(index, inbox, outbox, graphs):
+    """
+    worker 进程：依次取出 (job, config, scenario, options) 并演化，job 为 None 时只建图 (预热)，取出 None 时退出。
+    发送给前端的消息为 (index, job, event, fields)，每个任务结束时发送 idle 及已建好的图
+    """
+    countries = OrderedDict()
+    caches = {}
+    while True:
+        task = inbox.get()
+        if task is None:
+            return
+        job, config, scenario, options = task
+        start = time.perf_counter()
+        try:
+            country = _country(countries, config, graphs)
+            if job is not None:
+                def emit(event, **fields):
+                    outbox.put((index, job, event, fields))
+
+                reducers = []
+                profile = False
+                if options['stream']:
+                    reducers.append(_StreamReducer(lambda t, state: emit('sample', t=t, state=state),
+                                                   options['stream'], options['cities']))
+                if options['progress'] is not None:
+                    profile = Profile(lambda p: emit('progress', t=p.t, fraction=p.fraction, elapsed=p.elapsed,
+                                                     eta=p.eta), options['progress'])
+                cache = None
+                if config['cache'] and not reducers and not profile:
+                    cache = caches.setdefault(config['cache'], Cache(config['cache']))
+                if config['save_tracks']:
+                    os.makedirs(os.path.join(config['output'], 'tracks'), exist_ok=True)
+                emit('result', row=run_scenario(country, scenario, config, cache, reducers, profile))
+        except Exception as e:
+            if job is not None:
+                last = traceback.format_exception_only(type(e), e)[-1].strip()
+                outbox.put((index, job, 'result', {'row': _row(scenario, 'error', time.perf_counter() - start,
+                                                                last)}))
+        outbox.put((index, None, 'idle', {'graphs': list(countries)}))
+
+
+class _Worker(object):
+    """
+    前端记录的 worker 进程：job 为正在演化的场景，graphs 为已建好的图
+    """
+    def __init__(self, index: "int", context, outbox, graphs: "int"):
+        self.index = index
+        self.inbox = context.Queue()
+        self.process = context.Process(target=_worker_main, args=(index, self.inbox, outbox, graphs), daemon=True)
+        self.process.start()
+        self.job = None
+        self.graphs = set()
+
+
+class _Sweep(object):
+    """
+    一次 sweep 请求的完成情况
+    """
+    def __init__(self, total: "int"):
+        self.total = total
+        self.ok = 0
+        self.failed = 0
+
+
+class _Subscriber(object):
+    """
+    接收一个场景事件的客户端请求：index 为 sweep 中的场景编号，sweep 为该请求的完成情况 (run 时为 None)
+    """
+    def __init__(self, client, request, index: "int" = None, sweep: "_Sweep" = None):
+        self.client = client
+        self.request = request
+        self.index = index
+        self.sweep = sweep
+
+    def send(self, event: "str", fields: "dict"):
+        message = {'id': self.request, 'event': event}
+        if self.sweep is not None:
+            message['index'] = self.index
+        if event == 'result':
+            fields = {**fields, 'row': {**fields['row'], 'index': self.index}}
+        self.client.send({**message, **fields})
+        if event == 'result' and self.sweep is not None:
+            self.sweep.ok += fields['row']['status'] == 'ok'
+            self.sweep.failed += fields['row']['status'] != 'ok'
+            if self.sweep.ok + self.sweep.failed == self.sweep.total:
+                self.client.send({'id': self.request, 'event': 'done', 'ok': self.sweep.ok,
+                                  'failed': self.sweep.failed})
+
+
+class _Job(object):
+    """
+    一个排队或运行中的场景，history 为已推送的事件，供后加入的相同请求补发，priority 为合并的各请求中最高的优先级
+    """
+    def __init__(self, key: "str", config: "dict", scenario: "Scenario", options: "dict", priority: "float"):
+        self.key = key
+        self.priority = priority
+        self.config = config
+        self.scenario = scenario
+        self.options = options
+        self.graph = graph_key(config)
+        self.subscribers = []
+        self.history = []
+        self.worker = None
+
+    def publish(self, event: "str", fields: "dict"):
+        if event != 'result':
+            self.history.append((event, fields))
+        for subscriber in self.subscribers:
+            subscriber.send(event, fields)
+
+
+class _Client(object):
+    """
+    一个客户端连接，send 将消息写为一行 JSON
+    """
+    def __init__(self, writer: "asyncio.StreamWriter"):
+        self.writer = writer
+
+    def send(self, message: "dict"):
+        if not self.writer.is_closing():
+            self.writer.write(json.dumps(message).encode() + b'\n')
+
+
+class Service(object):
+    """
+    workers -> int, worker 进程数，默认为 CPU 核数
+    graphs -> int, 每个 worker 保留的国家数
+    warm -> list(dict), 启动时各 worker 预先建好的图 (扫描配置，只用到 GRAPH 中的配置项)
+    progress -> float, 请求未给出 progress 时进度推送的最短间隔 (秒)
+    -----------------------------------
+    Example:
+
+        async def main():
+            service = Service(workers=2, warm=[{'shape': [5, 5]}])
+            server = await service.start()
+            async with server:
+                await server.serve_forever()
+    """
+    def __init__(self, workers: "int" = None, graphs: "int" = 4, warm: "list(dict)" = (), progress: "float" = 0.5):
+        self.size = workers or os.cpu_count()
+        self.graphs = graphs
+        self.warm = [{**DEFAULTS, **config} for config in warm]
+        self.progress = progress
+        self.jobs = {}  # 排队或运行中的场景，key -> _Job
+        self.queue = []  # (优先级, 序号, _Job)
+        self.counter = itertools.count()
+        self.workers = []
+
+    async def start(self, host: "str" = HOST, port: "int" = PORT) -> "asyncio.Server":
+        self.loop = asyncio.get_running_loop()
+        self.context = multiprocessing.get_context('spawn')
+        self.outbox = self.context.Queue()
+        self.workers = [self._spawn(index) for index in range(self.size)]
+        self.listener = threading.Thread(target=self._listen, daemon=True)
+        self.listener.start()
+        self.watcher = asyncio.ensure_future(self._watch())
+        self.server = await asyncio.start_server(self._handle, host, port)
+        return self.server
+
+    def _spawn(self, index: "int") -> "_Worker":
+        worker = _Worker(index, self.context, self.outbox, self.graphs)
+        for config in self.warm:
+            worker.inbox.put((None, config, None, None))
+        return worker
+
+    def close(self):
+        self.server.close()
+        self.watcher.cancel()
+        for worker in self.workers:
+            worker.inbox.put(None)
+        for worker in self.workers:
+            worker.process.join(5.)
+            if worker.process.is_alive():
+                worker.process.terminate()
+        self.outbox.put(None)
+        self.listener.join()
+
+    def _listen(self):
+        """
+        后台线程：把 worker 的消息转交给事件循环
+        """
+        while True:
+            message = self.outbox.get()
+            if message is None:
+                return
+            self.loop.call_soon_threadsafe(self._receive, *message)
+
+    def _receive(self, index, key, event, fields):
+        worker = self.workers[index]
+        if event == 'idle':
+            worker.graphs = set(fields['graphs'])
+            self._dispatch()
+            return
+        job = self.jobs.get(key)
+        if job is None:
+            return
+        if event == 'result':
+            del self.jobs[key]
+            worker.job = None
+        job.publish(event, fields)
+
+    async def _watch(self, interval: "float" = 0.5):
+        """
+        定期检查 worker 进程，崩溃时其场景的结果为 crashed，并启动新的 worker
+        """
+        while True:
+            await asyncio.sleep(interval)
+            for index, worker in enumerate(self.workers):
+                if worker.process.is_alive():
+                    continue
+                job = worker.job
+                self.workers[index] = self._spawn(index)
+                if job is not None:
+                    del self.jobs[job.key]
+                    error = f"worker process exited with code {worker.process.exitcode}"
+                    job.publish('result', {'row': _row(job.scenario, 'crashed', error=error)})
+            self._dispatch()
+
+    def _dispatch(self):
+        """
+        按优先级把排队的场景交给空闲的 worker，优先选择已建好所需图的 worker
+        """
+        while self.queue:
+            idle = [worker for worker in self.workers if worker.job is None and worker.process.is_alive()]
+            if not idle:
+                return
+            priority, _, job = heapq.heappop(self.queue)
+            if job.worker is not None or priority != job.priority:  # 提高优先级后留下的旧条目
+                continue
+            if not job.subscribers:  # 请求的客户端均已断开
+                del self.jobs[job.key]
+                continue
+            worker = max(idle, key=lambda w: (job.graph in w.graphs, -len(w.graphs)))
+            worker.job = job
+            worker.graphs.add(job.graph)
+            job.worker = worker.index
+            worker.inbox.put((job.key, job.config, job.scenario, job.options))
+            job.publish('started', {'worker': worker.index})
+
+    def _queued(self) -> "int":
+        return sum(job.worker is None for job in self.jobs.values())
+
+    def _options(self, request: "dict") -> "dict":
+        progress = request.get('progress', self.progress)
+        return {'stream': int(request.get('stream', 0)), 'cities': bool(request.get('cities', False)),
+                'progress': None if progress is None else float(progress)}
+
+    def _submit(self, subscriber: "_Subscriber", config: "dict", scenario: "Scenario", options: "dict",
+                priority: "float"):
+        """
+        排队一个场景，相同的场景正在排队或运行时合并
+        """
+        key = hashlib.sha1(json.dumps([config, scenario[1:], options], sort_keys=True).encode()).hexdigest()
+        job = self.jobs.get(key)
+        shared = job is not None
+        if not shared:
+            job = self.jobs[key] = _Job(key, config, scenario, options, priority)
+            heapq.heappush(self.queue, (priority, next(self.counter), job))
+        elif priority < job.priority and job.worker is None:  # 排队中的场景取合并的请求中最高的优先级
+            job.priority = priority
+            heapq.heappush(self.queue, (priority, next(self.counter), job))
+        job.subscribers.append(subscriber)
+        subscriber.send('accepted', {'job': key, 'shared': shared, 'queued': self._queued()})
+        for event, fields in job.history:
+            subscriber.send(event, fields)
+
+    def _request(self, client: "_Client", request: "dict"):
+        op = request.get('op', 'run')
+        if op == 'status':
+            client.send({'id': request.get('id'), 'event': 'status', 'queued': self._queued(),
+                         'running': sum(worker.job is not None for worker in self.workers),
+                         'workers': [{'busy': worker.job is not None, 'graphs': len(worker.graphs)}
+                                     for worker in self.workers]})
+            return
+        if op not in ('run', 'sweep'):
+            raise ValueError(f"unknown op {op!r}, expected 'run', 'sweep' or 'status'")
+        config = {**DEFAULTS, **request.get('config', {})}
+        unknown = set(config) - set(DEFAULTS)
+        if unknown:
+            raise ValueError(f"unknown config keys {sorted(unknown)}")
+        options = self._options(request)
+        if op == 'run':
+            scenario = request.get('scenario', {})
+            config['grid'] = {name: [value] for name, value in scenario.items()}
+            todo = scenarios(config)
+            sweep = None
+            priority = float(request.get('priority', 0))
+        else:
+            todo = sorted(scenarios(config), key=lambda s: (-cost(s, config), s.index))
+            sweep = _Sweep(len(todo))
+            priority = float(request.get('priority', 1))
+        del config['grid']
+        for scenario in todo:
+            self._submit(_Subscriber(client, request.get('id'), scenario.index, sweep), config, scenario, options,
+                         priority)
+        self._dispatch()
+
+    async def _handle(self, reader: "asyncio.StreamReader", writer: "asyncio.StreamWriter"):
+        client = _Client(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                request = {}
+                try:
+                    request = json.loads(line)
+                    self._request(client, request)
+                except (ValueError, KeyError, TypeError) as e:
+                    client.send({'id': request.get('id') if isinstance(request, dict) else None, 'event': 'error',
+                                 'error': str(e)})
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            for job in self.jobs.values():
+                job.subscribers = [s for s in job.subscribers if s.client is not client]
+            writer.close()
+
+
+def call(request: "dict", host: "str" = HOST, port: "int" = PORT, timeout: "float" = None):
+    """
+    向服务发送一个请求，逐个返回事件 (dict)，run 收到 result、sweep 收到 done、status 收到 status 或出错时结束
+    """
+    op = request.get('op', 'run')
+    final = {'run': 'result', 'sweep': 'done', 'status': 'status'}.get(op)
+    with socket.create_connection((host, port), timeout) as sock, sock.makefile('rwb') as f:
+        f.write(json.dumps(request).encode() + b'\n')
+        f.flush()
+        for line in f:
+            event = json.loads(line)
+            yield event
+            if event['event'] in (final, 'error'):
+                return
+
+
+def main(argv=None) -> "int":
+    parser = argparse.ArgumentParser(description="GraphSEIR simulation service")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--workers', type=int, default=None, help="worker processes, defaults to the CPU count")
+    parser.add_argument('--graphs', type=int, default=4, help="countries kept by each worker")
+    parser.add_argument('--warm', nargs='*', default=[], help="sweep configurations whose graphs are built at start")
+    args = parser.parse_args(argv)
+
+    async def serve():
+        service = Service(args.workers, args.graphs, [load_config(filename) for filename in args.warm])
+        server = await service.start(args.host, args.port)
+        print(f"[service] {service.size} worker(s) listening on {args.host}:{args.port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            service.close()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -2,9 +2,16 @@
 """
 定义SimCountry, kernel.Country仅用于描述图结构，SimCountry增加了演化方法和演化轨迹。
 """
+import os
+import time
 import numpy as np
 from kernel import Country
-from numerical import Euler, RK4
+from numerical import Euler, RK4, RK45, ROS2
+from sinks import open_track, write_track, CompactSink
+from reducers import summarize
+from checkpoints import Checkpoint
+from profiling import Profile
+from stochastic import tau_leap
 
 
 class SimCountry(Country):
@@ -13,40 +20,164 @@ class SimCountry(Country):
 
     methods:
         self.evolute(self, initials: "np.ndarray, shape=(H, W, 4)", time_span: "list[float, float]",
-                     step: "float" = 0.1, sampling: "int" = 1, method: "'RK4' or 'Euler'" = "RK4")
+                     step: "float" = 0.1, sampling: "int" = 1, method: "'RK4', 'RK45', 'ROS2' or 'Euler'" = "RK4",
+                     backend: "'vector', 'fft' or 'python'" = "vector", rtol: "float" = 1e-6, atol: "float" = 1e-9,
+                     events: "list(events.Event)" = (), sink: "sinks.Sink" = None,
+                     reducers: "list(reducers.Reducer)" = (), checkpoints: "list[float]" = (),
+                     checkpoint_dir: "str" = None, resume: "Checkpoint or str" = None,
+                     profile: "bool or profiling.Profile" = False, progress=None, cache: "cache.Cache" = None,
+                     workers: "int" = 1)
             initials: 初始状态。前两个维度为城市矩阵的形状，即 country.shape == initials.shape[:2]，第三个维度为4，
-                即 initials[a][b] = [S, E, I, R] 为 City_ab 的初始SEIR状态
+                即 initials[a][b] = [S, E, I, R] 为 City_ab 的初始SEIR状态。
+                initials.shape=(B, H, W, 4) 时 B 个场景在一次积分中同时演化，各场景的参数由数组形式的
+                schedules.Constant/Piecewise 给出，self.track.shape=(B, N, H, W, 4)
+                网络国家 (见network.py) 的状态为 shape=(n, 4) 或 (B, n, 4)，轨迹相应为 (N, n, 4) 或 (B, N, n, 4)
             time_span: 演化时间范围
             step: 演化时间步长
             sampling: 采样间隔，即每sampling个step记录一次系统状态。
-            method: RK4 or Euler
-        self.save(self, filename)
+            method: RK4, RK45, ROS2 or Euler，RK45 为自适应步长方法，此时 step 仅决定采样时刻与初始步长；
+                ROS2 为使用稀疏 Jacobian 的隐式 Rosenbrock 方法，迁移系数大或感染速率高的刚性问题可以使用大步长，
+                backend 只能为 vector 或 fft
+            backend: 导数计算后端，vector 为向量化计算 (默认)，python 为逐城市、逐条边计算，两者结果一致；
+                fft 为格点国家的FFT卷积计算，Country(..., edges=False) 构造的国家只能使用 fft
+            rtol, atol: RK45 的相对误差与绝对误差容限
+            events: RK45 的事件函数列表 (见events.py)，各事件发生的时刻记录在 self.events 中，终止事件发生后停止演化
+            sink: 轨迹接收器 (见sinks.py)，默认在内存中保存轨迹；MemmapSink/ChunkedSink 边演化边写入磁盘，
+                此时 self.track 为磁盘上轨迹的延迟读取对象；CallbackSink/NullSink 不保存轨迹，self.track 为 None
+            reducers: 在线统计量 (见reducers.py)，每个时间步更新一次，结果记录在 self.summary 中，可直接用于 vision.report
+            checkpoints: 生成检查点的时刻 (见checkpoints.py)，检查点依次记录在 self.checkpoints 中，
+                checkpoint_dir 不为 None 时同时保存为 checkpoint_dir/checkpoint_{t}.pkl
+            resume: 检查点或其文件名，从该检查点继续演化，其余参数须与生成检查点时一致，reducers 由检查点恢复；
+                self.time 与 self.track 只包含检查点之后的部分。对同一检查点修改参数后多次继续演化即为分叉，
+                共享前缀的多个场景见 checkpoints.run_tree
+            profile: 性能统计 (见profiling.py)，True 或 Profile 对象时记录导数计算次数、步数、各阶段的时间与写入的字节数，
+                结果为 self.stats；False 时 self.stats 为 None，几乎没有额外开销
+            progress: 进度回调 progress(profiling.Progress)，约每秒一次，给出演化进度与预计剩余时间，给出时总会开启统计
+            cache: 结果缓存 (见cache.py)，以模型与演化配置的指纹为键，命中时直接读取 self.time, self.track, self.summary
+                与 self.events，不再演化 (reducers 不被更新)。使用 sink, checkpoints, resume 或性能统计时不使用缓存
+            workers: 导数计算的线程数，大于 1 时按城市块多线程计算 (见numerical.TiledDerivative)，只适用于 vector 后端，
+                适合城市数很多的国家；结果与单线程一致，不影响缓存的指纹
+        self.stochastic(self, initials, time_span, replicas=100, step=0.1, sampling=1, seed=0, **kwargs)
+            tau-leaping 随机模拟 (见stochastic.py)，同时模拟 replicas 个独立副本，结果为 self.ensemble (StochasticResult)，
+                包含各城市的分位数、全国人数的逐副本轨迹与各副本疫情消亡的时刻；self.track 为副本间的均值，可直接绘图，
+                self.summary 与 self.events 清空 (vision.report 由均值轨迹统计)。
+                kwargs 为 stochastic.tau_leap 的其余参数 (first, block, levels, unit, sink)
+        self.save(self, filename, compact=False, **options)
             仅保存模型的演化轨迹，不保存图信息
             filename: path, 不需要后缀，默认以numpy提供的.npz文件格式保存模型的演化轨迹
+            compact: True 或 filename 以 .trk 结尾时保存为分块压缩的 .trk 文件 (见sinks.CompactSink)，
+                文件中另记录国家的形状与演化设定；options 为 CompactSink 的参数，如 dtype='float32'、tolerance=1e-6
         self.load(self, filename)
-            加载已保存的演化轨迹
+            加载已保存的演化轨迹。.npz 文件全部读入；MemmapSink 的 .npy 文件以内存映射方式打开，
+            ChunkedSink 的目录与 .trk 文件只在读取时解压对应的数据块
     ----------------------------------------------------------------------------
     Example:
         请见test.py
     """
-    def __init__(self, shape: "tuple(int, int)", min_distance: "float"):
-        super().__init__(shape, min_distance)
+    def __init__(self, shape: "tuple(int, int)", min_distance: "float", cutoff: "float" = None,
+                 k_nearest: "int" = None, tolerance: "float" = None, edges: "bool" = True):
+        super().__init__(shape, min_distance, cutoff, k_nearest, tolerance, edges)
 
     def evolute(self, initials: "np.ndarray, shape=(H, W, 4)", time_span: "list[float, float]",
-                step: "float" = 0.1, sampling: "int" = 1, method: "'RK4' or 'Euler'" = "RK4"):
+                step: "float" = 0.1, sampling: "int" = 1, method: "'RK4', 'RK45', 'ROS2' or 'Euler'" = "RK4",
+                backend: "'vector', 'fft' or 'python'" = "vector", rtol: "float" = 1e-6, atol: "float" = 1e-9,
+                events: "list(events.Event)" = (), sink: "sinks.Sink" = None,
+                reducers: "list(reducers.Reducer)" = (), checkpoints: "list[float]" = (),
+                checkpoint_dir: "str" = None, resume: "Checkpoint or str" = None,
+                profile: "bool or profiling.Profile" = False, progress=None, cache: "cache.Cache" = None,
+                workers: "int" = 1):
+        self.runConfig = {'time_span': [float(t) for t in time_span], 'step': float(step), 'sampling': int(sampling),
+                          'method': method, 'backend': backend, 'rtol': float(rtol), 'atol': float(atol)}
+        if isinstance(sink, CompactSink) and sink.meta is None:
+            sink.meta = self._metadata()
+        key = None
+        if cache is not None and sink is None and not checkpoints and resume is None and not (profile or progress):
+            key = cache.key(self, initials, time_span, step=step, sampling=sampling, method=method, backend=backend,
+                            rtol=rtol, atol=atol, events=list(events), reducers=list(reducers))
+            hit = None if key is None else cache.get(key)
+            if hit is not None:
+                self.time, self.track, self.summary, self.events = hit
+                self.checkpoints = []
+                self.stats = None
+                return
+        if isinstance(resume, str):
+            resume = Checkpoint.load(resume)
+        if resume is not None:
+            reducers = resume.restore_reducers()
+        if checkpoint_dir is not None and not os.path.exists(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+        self.checkpoints = []
+
+        def on_checkpoint(checkpoint):
+            self.checkpoints.append(checkpoint)
+            if checkpoint_dir is not None:
+                checkpoint.save(os.path.join(checkpoint_dir, f"checkpoint_{checkpoint.t:g}.pkl"))
+
+        if profile is True or (progress is not None and not profile):
+            profile = Profile()
+        if progress is not None:
+            profile.progress = progress
+        self.stats = profile or None
+        if self.stats is not None:
+            self.stats.start(time_span[0] if resume is None else resume.t, time_span[1])
+
+        self.events = {}
+        kwargs = dict(sink=sink, reducers=reducers, checkpoints=checkpoints, on_checkpoint=on_checkpoint, resume=resume,
+                      profile=self.stats, workers=workers)
         if method == "RK4":
-            self.time, self.track = RK4(self, initials, time_span, step, sampling)
+            self.time, self.track = RK4(self, initials, time_span, step, sampling, backend, **kwargs)
+        elif method == "RK45":
+            self.time, self.track, self.events = RK45(self, initials, time_span, step, sampling, backend,
+                                                      rtol, atol, events, **kwargs)
+        elif method == "ROS2":
+            self.time, self.track = ROS2(self, initials, time_span, step, sampling, backend, **kwargs)
         elif method == "Euler":
-            self.time, self.track = Euler(self, initials, time_span, step, sampling)
+            self.time, self.track = Euler(self, initials, time_span, step, sampling, backend, **kwargs)
         else:
-            raise KeyError("method must be one of 'RK4' and 'Euler'")
+            raise KeyError("method must be one of 'RK4', 'RK45', 'ROS2' and 'Euler'")
+        self.summary = summarize(reducers)
+        if self.stats is not None:
+            self.stats.finish(self.time[-1] if len(self.time) else time_span[1])
+        if key is not None:
+            cache.put(key, self.time, self.track, self.summary, self.events)
 
-    def save(self, filename):
-        try:
-            np.savez(filename, time=self.time, track=self.track)
-        except AttributeError:
-            raise RuntimeError("Simulation must run before saving the results")
+    def stochastic(self, initials: "np.ndarray, shape=(H, W, 4)", time_span: "list[float, float]",
+                   replicas: "int" = 100, step: "float" = 0.1, sampling: "int" = 1, seed: "int" = 0, **kwargs):
+        self.ensemble = tau_leap(self, initials, time_span, replicas, step, sampling, seed, **kwargs)
+        self.time, self.track = self.ensemble.time, self.ensemble.mean
+        # 上一次确定性演化的统计量、事件与检查点不属于本次模拟，vision.report 由均值轨迹重新统计
+        self.summary, self.events, self.checkpoints, self.stats = {}, {}, [], None
+
+    def _metadata(self) -> "dict":
+        """
+        压缩轨迹文件 (sinks.CompactSink) 中记录的国家与演化设定
+        """
+        country = {'shape': list(self.shape), 'min_distance': float(self.minDistance)}
+        if len(self.shape) == 1:
+            country['names'] = [str(name) for name in self.names]
+        if self.model is not None:
+            country['compartments'] = list(self.model.compartments)
+            country['strata'] = list(self.model.strata)
+        return {'country': country, 'config': getattr(self, 'runConfig', {})}
+
+    def save(self, filename, compact: "bool" = False, **options):
+        if getattr(self, 'track', None) is None:
+            raise RuntimeError("Simulation must run with a recording sink before saving the results")
+        start = time.perf_counter()
+        if compact or filename.endswith('.trk'):
+            if getattr(self, 'time', None) is None:
+                raise RuntimeError("Simulation must run before saving the results")
+            batched = len(self.track.shape) == len(self.shape) + len(self.stateShape) + 2
+            path = write_track(filename, self.time, self.track, batched, meta=self._metadata(), **options).filename
+        else:
+            try:
+                np.savez(filename, time=self.time, track=self.track)
+            except AttributeError:
+                raise RuntimeError("Simulation must run before saving the results")
+            path = filename if filename.endswith('.npz') else filename + '.npz'
+        if getattr(self, 'stats', None) is not None:
+            self.stats.add('save', time.perf_counter() - start)
+            self.stats.bytes += os.path.getsize(path)
 
     def load(self, filename):
-        npzfile = np.load(filename)
-        self.time, self.track = npzfile['time'], npzfile['track']
+        self.time, self.track = open_track(filename)
@@ -0,0 +1,556 @@
+# -*- encoding:utf-8 -*-
+"""
+演化轨迹的接收器。数值算法 (numerical.py) 每产生一个采样就交给接收器，而不是预先在内存中分配整个轨迹：
+ArraySink: 内存中的数组，即原有的行为 (默认)
+MemmapSink: 逐个采样写入磁盘上的 .npy 文件 (内存映射)，轨迹大小不受内存限制
+ChunkedSink: 按 (时间段, 城市块) 分块压缩存储的目录，可只读取部分城市或部分时间段
+CompactSink: 按 (时间段, 城市块, 人群) 分块压缩的单个文件，可选 float32 或误差有界的量化存储，文件中记录元数据
+CallbackSink: 将每个采样交给用户函数或生成器，不保存轨迹
+NullSink: 丢弃所有采样，只需要在线统计量 (见reducers.py) 时使用
+
+接收器接口：
+    open(time, shape, batched): 积分开始前调用，time 为采样时间序列，shape 为单个采样的形状，
+        batched 为 True 时 shape=(B, H, W, 4)，轨迹的形状为 (B, N, H, W, 4)，否则为 (N, H, W, 4)
+    write(k, x): 写入第 k 个采样
+    close(n): 积分结束，n 为实际的采样数 (终止事件可能使 n < len(time))，返回轨迹 (数组、类数组对象或 None)
+
+磁盘上的轨迹可由 SimCountry.load 或 open_track 延迟打开，只在读取时访问对应的数据。
+"""
+import collections
+import itertools
+import json
+import os
+import struct
+import zlib
+from abc import ABC, abstractmethod
+import numpy as np
+
+
+class Sink(ABC):
+    """
+    接收器基类，子类须实现 write，未实现的子类不能实例化
+    """
+    def open(self, time: "np.ndarray, shape=(N,)", shape: "tuple", batched: "bool" = False):
+        self.time = time
+        self.shape = tuple(shape)
+        self.batched = batched
+
+    @abstractmethod
+    def write(self, k: "int", x: "np.ndarray"):
+        pass
+
+    def close(self, n: "int"):
+        return None
+
+    def _track_shape(self, n):
+        if self.batched:
+            return (self.shape[0], n, *self.shape[1:])
+        return (n, *self.shape)
+
+
+class ArraySink(Sink):
+    """
+    内存中的数组
+    """
+    def open(self, time, shape, batched=False):
+        super().open(time, shape, batched)
+        self.track = np.zeros(self._track_shape(len(time)))
+        self.samples = np.moveaxis(self.track, 1, 0) if batched else self.track
+
+    def write(self, k, x):
+        self.samples[k] = x
+
+    def close(self, n):
+        return self.track[:, :n] if self.batched else self.track[:n]
+
+
+class MemmapSink(Sink):
+    """
+    逐个采样写入 filename (.npy)，采样时间写入 filename 去掉后缀加 .time.npy
+    -----------------------------------
+    Example:
+
+        china.evolute(initials, time_span, sink=MemmapSink('results/big.npy'))
+        china.load('results/big.npy')  # 以内存映射方式打开，不读入全部数据
+    """
+    def __init__(self, filename: "str"):
+        self.filename = filename if filename.endswith('.npy') else filename + '.npy'
+
+    def open(self, time, shape, batched=False):
+        super().open(time, shape, batched)
+        self.track = np.lib.format.open_memmap(self.filename, mode='w+', dtype=float,
+                                               shape=self._track_shape(len(time)))
+        self.samples = np.moveaxis(self.track, 1, 0) if batched else self.track
+
+    def write(self, k, x):
+        self.samples[k] = x
+
+    def close(self, n):
+        self.track.flush()
+        del self.samples, self.track
+        if n < len(self.time):
+            # 提前终止时截断文件，不把轨迹读入内存
+            if self.batched:
+                _truncate_batched(self.filename, n)
+            else:
+                _truncate_npy(self.filename, n)
+        np.save(_time_file(self.filename), self.time[:n])
+        return np.load(self.filename, mmap_mode='r')
+
+
+def _truncate_npy(filename: "str", n: "int"):
+    """
+    只保留 .npy 文件中沿第一维的前 n 行：原地改写文件头中的形状 (用空格补齐到原长度)，再截断数据
+    """
+    fmt = np.lib.format
+    with open(filename, 'r+b') as f:
+        version = fmt.read_magic(f)
+        start = f.tell() + (2 if version == (1, 0) else 4)  # 文件头长度字段之后
+        read = fmt.read_array_header_1_0 if version == (1, 0) else fmt.read_array_header_2_0
+        shape, fortran, dtype = read(f)
+        offset = f.tell()
+        header = repr({'descr': fmt.dtype_to_descr(dtype), 'fortran_order': fortran, 'shape': (n,) + shape[1:]})
+        f.seek(start)
+        f.write(header.ljust(offset - start - 1).encode('latin1') + b'\n')
+    os.truncate(filename, offset + n * int(np.prod(shape[1:], dtype=np.int64)) * dtype.itemsize)
+
+
+def _truncate_batched(filename: "str", n: "int", chunk_bytes: "int" = 2 ** 26):
+    """
+    批量轨迹 (B, N, ...) 只保留前 n 个采样：逐块复制到新文件后替换原文件，每次只读入约 chunk_bytes 字节
+    """
+    full = np.load(filename, mmap_mode='r')
+    tmp = filename[:-len('.npy')] + '.tmp.npy'
+    part = np.lib.format.open_memmap(tmp, mode='w+', dtype=full.dtype, shape=(full.shape[0], n) + full.shape[2:])
+    rows = max(1, chunk_bytes // max(full[0, 0].nbytes, 1))
+    for b in range(full.shape[0]):
+        for k in range(0, n, rows):
+            part[b, k:k + rows] = full[b, k:min(k + rows, n)]
+    part.flush()
+    del full, part
+    os.replace(tmp, filename)
+
+
+def _time_file(filename):
+    return filename[:-len('.npy')] + '.time.npy'
+
+
+class ChunkedSink(Sink):
+    """
+    分块压缩存储，directory 中包含：
+        meta.json: 轨迹形状、分块大小、是否批量
+        time.npy: 采样时间序列
+        t{i}_{c}.npz: 第 i 个时间段、第 c 个城市块的数据，城市块为城市矩阵按 city_chunk 划分的子矩阵
+    chunk_time -> int, 每个时间段的采样数，写入时只在内存中缓存一个时间段
+    city_chunk -> tuple(int, ...), 城市块的大小，默认不划分
+    """
+    def __init__(self, directory: "str", chunk_time: "int" = 256, city_chunk: "tuple" = None):
+        self.directory = directory
+        self.chunkTime = chunk_time
+        self.cityChunk = city_chunk
+
+    def open(self, time, shape, batched=False):
+        super().open(time, shape, batched)
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        cities = self.shape[1:-1] if batched else self.shape[:-1]
+        self.cityChunk = tuple(self.cityChunk) if self.cityChunk is not None else tuple(cities)
+        self.buffer = np.zeros((self.chunkTime, *self.shape))
+        self.start = 0
+        self.n = 0
+
+    def write(self, k, x):
+        if k - self.start >= self.chunkTime:
+            self._flush()
+            self.start = k
+        self.buffer[k - self.start] = x
+        self.n = k + 1
+
+    def _flush(self):
+        count = self.n - self.start
+        if count <= 0:
+            return
+        data = self.buffer[:count]
+        if self.batched:
+            data = np.moveaxis(data, 1, 0)
+        for c, index in enumerate(_city_blocks(self._cities(), self.cityChunk)):
+            block = data[(slice(None), slice(None)) + index] if self.batched else data[(slice(None),) + index]
+            np.savez_compressed(os.path.join(self.directory, f't{self.start // self.chunkTime}_{c}.npz'), data=block)
+
+    def _cities(self):
+        return self.shape[1:-1] if self.batched else self.shape[:-1]
+
+    def close(self, n):
+        self.n = min(self.n, n)
+        self._flush()
+        np.save(os.path.join(self.directory, 'time.npy'), self.time[:n])
+        meta = {'shape': list(self._track_shape(n)), 'chunk_time': self.chunkTime,
+                'city_chunk': list(self.cityChunk), 'batched': self.batched}
+        with open(os.path.join(self.directory, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        del self.buffer
+        return ChunkedTrack(self.directory)
+
+
+def _city_blocks(cities, chunk):
+    """
+    城市矩阵按 chunk 划分的各个子矩阵的索引，按行优先顺序
+    """
+    ranges = [[slice(s, min(s + c, n)) for s in range(0, n, c)] for n, c in zip(cities, chunk)]
+    grids = np.meshgrid(*[np.arange(len(r)) for r in ranges], indexing='ij')
+    return [tuple(ranges[d][g.flat[k]] for d, g in enumerate(grids)) for k in range(grids[0].size)]
+
+
+def _normalize_key(key, shape: "tuple") -> "(list(np.ndarray), list(int))":
+    """
+    将索引规范化为每个维度的整数数组，并给出需要去掉的维度 (整数索引)
+    """
+    if not isinstance(key, tuple):
+        key = (key,)
+    if any(k is Ellipsis for k in key):
+        e = key.index(Ellipsis)
+        key = key[:e] + (slice(None),) * (len(shape) - len(key) + 1) + key[e + 1:]
+    key = key + (slice(None),) * (len(shape) - len(key))
+    index, squeeze = [], []
+    for d, k in enumerate(key):
+        idx = np.arange(shape[d])[k]
+        if np.ndim(idx) == 0:
+            squeeze.append(d)
+        index.append(np.atleast_1d(idx))
+    return index, squeeze
+
+
+class ChunkedTrack(object):
+    """
+    ChunkedSink 写入的轨迹，读取时只解压与索引相交的数据块。
+    支持对每个维度使用整数、切片或整数数组索引，例如 track[:, 2, 3, :] 只读取包含 City_23 的数据块
+    """
+    def __init__(self, directory: "str"):
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json')) as f:
+            meta = json.load(f)
+        self.shape = tuple(meta['shape'])
+        self.ndim = len(self.shape)
+        self.dtype = np.dtype(float)
+        self.chunkTime = meta['chunk_time']
+        self.cityChunk = tuple(meta['city_chunk'])
+        self.batched = meta['batched']
+        self.time = np.load(os.path.join(directory, 'time.npy'))
+        self._cache = {}
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[...]
+        return data if dtype is None else data.astype(dtype)
+
+    def _chunk(self, i, c):
+        key = (i, c)
+        if key not in self._cache:
+            if len(self._cache) > 64:
+                self._cache.clear()
+            with np.load(os.path.join(self.directory, f't{i}_{c}.npz')) as f:
+                self._cache[key] = f['data']
+        return self._cache[key]
+
+    def __getitem__(self, key):
+        index, squeeze = _normalize_key(key, self.shape)
+        time_axis = 1 if self.batched else 0
+        city_axes = list(range(time_axis + 1, self.ndim - 1))
+        out = np.empty([len(i) for i in index])
+        blocks = _city_blocks(self.shape[time_axis + 1:-1], self.cityChunk)
+        for i in np.unique(index[time_axis] // self.chunkTime):
+            t_sel = np.nonzero(index[time_axis] // self.chunkTime == i)[0]
+            for c, block in enumerate(blocks):
+                sels, locals_ = [], []
+                for axis, sl in zip(city_axes, block):
+                    sel = np.nonzero((index[axis] >= sl.start) & (index[axis] < sl.stop))[0]
+                    sels.append(sel)
+                    locals_.append(index[axis][sel] - sl.start)
+                if any(sel.size == 0 for sel in sels):
+                    continue
+                data = self._chunk(i, c)
+                src = [index[time_axis][t_sel] - i * self.chunkTime] + locals_ + [index[-1]]
+                dst = [t_sel] + sels + [np.arange(len(index[-1]))]
+                if self.batched:
+                    src = [index[0]] + src
+                    dst = [np.arange(len(index[0]))] + dst
+                out[np.ix_(*dst)] = data[np.ix_(*src)]
+        return out.squeeze(axis=tuple(squeeze)) if squeeze else out
+
+
+_MAGIC = b'SEIRTRK1'
+_FOOTER = struct.Struct('<QQ8s')  # 块索引的位置、元数据的长度、魔数
+
+
+def _default_chunks(cities: "tuple") -> "tuple":
+    """
+    城市维的默认分块：每块约 1024 个城市 (格点国家为 32 × 32)
+    """
+    side = int(round(1024 ** (1 / len(cities)))) if cities else 1
+    return tuple(min(n, side) for n in cities)
+
+
+def _shuffle(a: "np.ndarray") -> "bytes":
+    """
+    按字节位置重排：各数的第 0 个字节在前，其次为第 1 个字节……平滑数据的高位字节几乎相同，更易压缩
+    """
+    return np.ascontiguousarray(a).view(np.uint8).reshape(-1, a.itemsize).T.tobytes()
+
+
+def _unshuffle(buf: "bytes", dtype: "str", shape: "tuple") -> "np.ndarray":
+    dtype = np.dtype(dtype)
+    return np.frombuffer(buf, np.uint8).reshape(dtype.itemsize, -1).T.copy().view(dtype).reshape(shape)
+
+
+def _encode(block: "np.ndarray", dtype: "str", tolerance: "float", time_axis: "int",
+            level: "int") -> "(bytes, int, float)":
+    """
+    压缩一个数据块，返回 (数据, 量化值的字节数 (0 表示浮点数), 量化的起点)
+    """
+    if tolerance is not None and block.size and np.all(np.isfinite(block)):
+        lo = float(block.min())
+        if (float(block.max()) - lo) / (2 * tolerance) < 2 ** 52:
+            q = np.rint((block - lo) / (2 * tolerance)).astype(np.int64)
+            d = np.diff(q, axis=time_axis, prepend=0)
+            z = ((d << 1) ^ (d >> 63)).astype(np.uint64)  # zigzag：绝对值小的差分对应小的无符号整数
+            top = int(z.max()) if z.size else 0
+            width = next(w for w in (1, 2, 4, 8) if top < 2 ** (8 * w))
+            return zlib.compress(_shuffle(z.astype(f'<u{width}')), level), width, lo
+    return zlib.compress(_shuffle(block.astype(dtype)), level), 0, 0.
+
+
+def _decode(payload: "bytes", width: "int", lo: "float", shape: "tuple", dtype: "str", tolerance: "float",
+            time_axis: "int") -> "np.ndarray":
+    buf = zlib.decompress(payload)
+    if width == 0:
+        return _unshuffle(buf, dtype, shape).astype(float)
+    z = _unshuffle(buf, f'<u{width}', shape).astype(np.uint64)
+    d = (z >> np.uint64(1)).astype(np.int64) ^ -(z & np.uint64(1)).astype(np.int64)
+    return lo + np.cumsum(d, axis=time_axis) * (2 * tolerance)
+
+
+class CompactSink(Sink):
+    """
+    单个文件 (.trk) 中按 (时间段, 城市块, 人群) 分块、逐块压缩的轨迹，由 CompactTrack 延迟读取。文件结构：
+        b'SEIRTRK1' | 数据块 | 块索引 (偏移、长度、编码) 与采样时间 | 元数据 (JSON) | 块索引的位置与元数据的长度 | b'SEIRTRK1'
+    元数据记录轨迹形状、分块大小、存储方式与 meta (SimCountry 写入国家的形状与演化设定)，位于文件末尾，因此可以边演化边写入。
+    数据块的存储方式：
+        dtype='float64': 无损
+        dtype='float32': 相对误差约 6e-8
+        tolerance 不为 None: 以 2 * tolerance 为步长量化，绝对误差不超过 tolerance (万人)，量化值沿时间差分后
+            以能容纳的最小整数类型保存，平滑的轨迹通常每个值只需 1 ~ 2 字节；含 nan/inf 的块以 float64 保存
+    数据块按字节位置重排后以 zlib 压缩，level 为压缩级别。
+    chunk_time -> int, 每个时间段的采样数，写入时只在内存中缓存一个时间段
+    city_chunk -> tuple(int, ...), 城市块的大小，默认每块约 1024 个城市
+    compartment_chunk -> int, 每块包含的人群数，默认为 1，只读取 I 时不解压其他人群
+    meta -> dict, 写入元数据的其他信息 (可序列化为 JSON)
+    -----------------------------------
+    Example:
+
+        china.evolute(initials, time_span, sink=CompactSink('results/big.trk', tolerance=1e-6))
+        china.load('results/big.trk')
+        china.track[:, 2, 2, 2]  # 只解压包含 City_22 的 I 的数据块
+    """
+    def __init__(self, filename: "str", chunk_time: "int" = 64, city_chunk: "tuple" = None,
+                 compartment_chunk: "int" = 1, dtype: "'float64' or 'float32'" = 'float64', tolerance: "float" = None,
+                 level: "int" = 6, meta: "dict" = None):
+        self.filename = filename if filename.endswith('.trk') else filename + '.trk'
+        self.chunkTime = chunk_time
+        self.cityChunk = city_chunk
+        self.compartmentChunk = compartment_chunk
+        self.dtype = '<f8' if tolerance is not None else np.dtype(dtype).newbyteorder('<').str
+        self.tolerance = tolerance
+        self.level = level
+        self.meta = meta
+
+    def open(self, time, shape, batched=False):
+        super().open(time, shape, batched)
+        cities = self.shape[1:-1] if batched else self.shape[:-1]
+        city = tuple(self.cityChunk) if self.cityChunk is not None else _default_chunks(cities)
+        self.chunks = ((1,) if batched else ()) + (self.chunkTime,) + city + (self.compartmentChunk,)
+        self.buffer = np.zeros((self.chunkTime, *self.shape))
+        self.start = 0
+        self.n = 0
+        self.entries = {}  # 块坐标 -> (偏移, 长度, 量化值的字节数, 量化的起点)
+        self.file = open(self.filename, 'wb')
+        self.file.write(_MAGIC)
+
+    def write(self, k, x):
+        if k - self.start >= self.chunkTime:
+            self._flush()
+            self.start = k
+        self.buffer[k - self.start] = x
+        self.n = k + 1
+
+    def _flush(self):
+        count = self.n - self.start
+        if count <= 0:
+            return
+        data = self.buffer[:count]
+        time_axis = int(self.batched)
+        if self.batched:
+            data = np.moveaxis(data, 1, 0)
+        ranges = [range(-(-n // c)) for n, c in zip(data.shape, self.chunks)]
+        ranges[time_axis] = range(1)
+        for coord in itertools.product(*ranges):
+            index = tuple(slice(k * c, (k + 1) * c) for k, c in zip(coord, self.chunks))
+            payload, width, lo = _encode(data[index], self.dtype, self.tolerance, time_axis, self.level)
+            coord = coord[:time_axis] + (self.start // self.chunkTime,) + coord[time_axis + 1:]
+            self.entries[coord] = (self.file.tell(), len(payload), width, lo)
+            self.file.write(payload)
+
+    def close(self, n):
+        self.n = min(self.n, n)
+        self._flush()
+        shape = self._track_shape(n)
+        grid = tuple(-(-s // c) for s, c in zip(shape, self.chunks))
+        index = np.zeros(int(np.prod(grid)), dtype=[('offset', '<u8'), ('length', '<u8'), ('width', 'u1'),
+                                                    ('lo', '<f8')])
+        for coord, entry in self.entries.items():
+            if all(k < g for k, g in zip(coord, grid)):
+                index[np.ravel_multi_index(coord, grid)] = entry
+        header = json.dumps({'version': 1, 'shape': list(shape), 'chunks': list(self.chunks),
+                             'batched': self.batched, 'dtype': self.dtype, 'tolerance': self.tolerance,
+                             'codec': 'zlib', 'meta': self.meta or {}}).encode()
+        position = self.file.tell()
+        self.file.write(index.tobytes())
+        self.file.write(np.asarray(self.time[:n], dtype='<f8').tobytes())
+        self.file.write(header)
+        self.file.write(_FOOTER.pack(position, len(header), _MAGIC))
+        self.file.close()
+        del self.buffer, self.entries
+        return CompactTrack(self.filename)
+
+
+class CompactTrack(object):
+    """
+    CompactSink 写入的轨迹，读取时只解压与索引相交的数据块，最近解压的数据块缓存在内存中 (至多 cache_bytes 字节)。
+    支持对每个维度使用整数、切片或整数数组索引，例如 track[:, 2, 3, 2] 只解压包含 City_23 的 I 的数据块
+    meta -> dict, 写入时的元数据，SimCountry 写入的文件包含 country (国家的形状等) 与 config (演化设定)
+    time -> np.ndarray, 采样时间
+    """
+    def __init__(self, filename: "str", cache_bytes: "int" = 2 ** 28):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            f.seek(-_FOOTER.size, os.SEEK_END)
+            position, length, magic = _FOOTER.unpack(f.read(_FOOTER.size))
+            if magic != _MAGIC:
+                raise ValueError(f"{filename} is not a compact trajectory file")
+            f.seek(-_FOOTER.size - length, os.SEEK_END)
+            header = json.loads(f.read(length))
+            self.shape = tuple(header['shape'])
+            self.chunks = tuple(header['chunks'])
+            self.grid = tuple(-(-s // c) for s, c in zip(self.shape, self.chunks))
+            f.seek(position)
+            dtype = np.dtype([('offset', '<u8'), ('length', '<u8'), ('width', 'u1'), ('lo', '<f8')])
+            count = int(np.prod(self.grid))
+            self.index = np.frombuffer(f.read(dtype.itemsize * count), dtype=dtype)
+            self.batched = header['batched']
+            self.time = np.frombuffer(f.read(8 * self.shape[int(self.batched)]), dtype='<f8').astype(float)
+        self.ndim = len(self.shape)
+        self.dtype = np.dtype(float)
+        self.storage = header['dtype']
+        self.tolerance = header['tolerance']
+        self.meta = header['meta']
+        self.cacheBytes = cache_bytes
+        self._cache = collections.OrderedDict()
+        self._cached = 0
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[...]
+        return data if dtype is None else data.astype(dtype)
+
+    def _chunk(self, f, coord: "tuple") -> "np.ndarray":
+        if coord in self._cache:
+            self._cache.move_to_end(coord)
+            return self._cache[coord]
+        offset, length, width, lo = self.index[np.ravel_multi_index(coord, self.grid)].tolist()
+        f.seek(offset)
+        shape = tuple(min(c, s - k * c) for k, c, s in zip(coord, self.chunks, self.shape))
+        data = _decode(f.read(length), width, lo, shape, self.storage, self.tolerance, int(self.batched))
+        self._cache[coord] = data
+        self._cached += data.nbytes
+        while self._cached > self.cacheBytes and len(self._cache) > 1:
+            self._cached -= self._cache.popitem(last=False)[1].nbytes
+        return data
+
+    def __getitem__(self, key):
+        index, squeeze = _normalize_key(key, self.shape)
+        ids = [idx // c for idx, c in zip(index, self.chunks)]
+        out = np.empty([len(i) for i in index])
+        with open(self.filename, 'rb') as f:
+            for coord in itertools.product(*[np.unique(i).tolist() for i in ids]):
+                dst = [np.nonzero(i == k)[0] for i, k in zip(ids, coord)]
+                src = [idx[sel] - k * c for idx, sel, k, c in zip(index, dst, coord, self.chunks)]
+                out[np.ix_(*dst)] = self._chunk(f, coord)[np.ix_(*src)]
+        return out.squeeze(axis=tuple(squeeze)) if squeeze else out
+
+
+def write_track(filename: "str", time: "np.ndarray, shape=(N,)", track, batched: "bool" = False,
+                **options) -> "CompactTrack":
+    """
+    将已有的轨迹 (数组或类数组对象) 写入 CompactSink 的文件，options 为 CompactSink 的其余参数
+    """
+    sink = CompactSink(filename, **options)
+    sink.open(time, (track.shape[0], *track.shape[2:]) if batched else track.shape[1:], batched)
+    for k in range(len(time)):
+        sink.write(k, np.asarray(track[:, k] if batched else track[k], dtype=float))
+    return sink.close(len(time))
+
+
+class CallbackSink(Sink):
+    """
+    将每个采样交给 callback(t, x) 或生成器 (以 send((t, x)) 传入)，不保存轨迹，close 返回 None
+    -----------------------------------
+    Example:
+
+        def printer():
+            while True:
+                t, x = yield
+                print(t, x[..., 2].sum())
+
+        china.evolute(initials, time_span, sink=CallbackSink(printer()))
+    """
+    def __init__(self, callback):
+        self.callback = callback
+
+    def open(self, time, shape, batched=False):
+        super().open(time, shape, batched)
+        if hasattr(self.callback, 'send'):
+            next(self.callback)
+
+    def write(self, k, x):
+        if hasattr(self.callback, 'send'):
+            self.callback.send((self.time[k], x.copy()))
+        else:
+            self.callback(self.time[k], x.copy())
+
+
+class NullSink(Sink):
+    """
+    丢弃所有采样，close 返回 None
+    """
+    def write(self, k, x):
+        pass
+
+
+def open_track(filename: "str") -> "(time, track)":
+    """
+    延迟打开磁盘上的轨迹：.npz (SimCountry.save 的默认格式，全部读入)、.npy (MemmapSink，内存映射)、
+    目录 (ChunkedSink，按需解压) 或 .trk (CompactSink 与 SimCountry.save(..., compact=True)，按需解压)
+    """
+    if os.path.isdir(filename):
+        track = ChunkedTrack(filename)
+        return track.time, track
+    if filename.endswith('.trk'):
+        track = CompactTrack(filename)
+        return track.time, track
+    if filename.endswith('.npy'):
+        return np.load(_time_file(filename)), np.load(filename, mmap_mode='r')
+    npzfile = np.load(filename)
+    return npzfile['time'], npzfile['track']
@@ -0,0 +1,256 @@
+# -*- encoding:utf-8 -*-
+"""
+随机模拟。确定性的微分方程无法描述疫情早期的随机性 (如 working.py 中 1e-4 万人，即一个人的初始感染)：
+疫情可能在扩散之前自行消亡，爆发的时间也有很大的方差。此处以 tau-leaping 方法同时模拟大量独立的副本，
+状态为整数人数 shape=(replicas, n, 4) (n 为城市数)，每个时间步 tau 内：
+    S -> E: Binomial(S, 1 - exp(-tau * r * (beta * I + h * E) / N))
+    E -> I: Binomial(E, 1 - exp(-tau * theta))
+    I -> R: Binomial(I, 1 - exp(-tau * gamma))
+    城市间迁移: 每条边、每个人群的迁移人数为 Poisson(tau * 期望迁移量)，出城人数不超过该城市现有人数
+    扰动项 nu: Poisson(tau * |nu|)
+参数与转移函数与确定性模拟相同 (City, Traffic 与 schedules.py)，期望值与 VectorDerivative 一致。
+每步的泊松随机数个数与 副本数 × 边数 成正比，大国家请使用截断的稀疏图 (kernel.Country 的 cutoff 或 k_nearest)。
+
+随机数：副本按 block 个一组，第 k 组使用以 (seed, k) 为密钥的 Philox 计数器随机数流，因此某个副本的轨迹只取决于
+seed、block 与其编号，与同一次运行中的副本总数无关。多进程时按 block 的整数倍划分副本 (first 参数)，
+各进程的副本与单进程运行时完全相同。
+
+结果不保存每个副本的轨迹，每个采样时刻只保存各城市各人群在副本间的分位数与均值，以及全国人数的逐副本轨迹。
+"""
+import numpy as np
+from numerical import VectorDerivative
+from sinks import Sink, ArraySink
+
+
+class StochasticResult(object):
+    """
+    time -> np.ndarray, shape=(N,), 采样时间
+    levels -> np.ndarray, shape=(Q,), 分位数的水平
+    quantiles -> shape=(N, Q, H, W, 4), 各城市各人群在副本间的分位数 (万人)，类型由 sink 决定
+    mean -> np.ndarray, shape=(N, H, W, 4), 副本间的均值 (万人)
+    national -> np.ndarray(int64), shape=(R, N, 4), 各副本全国的 S, E, I, R 人数
+    extinction -> np.ndarray, shape=(R,), 各副本 E 与 I 全部归零 (疫情消亡) 的时刻，未消亡为 inf
+    replicas -> np.ndarray, shape=(R,), 副本编号
+    """
+    def __init__(self, time, levels, quantiles, mean, national, extinction, replicas):
+        self.time = time
+        self.levels = levels
+        self.quantiles = quantiles
+        self.mean = mean
+        self.national = national
+        self.extinction = extinction
+        self.replicas = replicas
+
+    def extinct(self) -> "np.ndarray, shape=(N,)":
+        """
+        各采样时刻疫情已消亡的副本比例
+        """
+        return (self.extinction[:, None] <= self.time[None, :]).mean(axis=0)
+
+    def quantile(self, level: "float") -> "np.ndarray, shape=(N, H, W, 4)":
+        k = int(np.argmin(np.abs(self.levels - level)))
+        if not np.isclose(self.levels[k], level):
+            raise KeyError(f"quantile {level} was not recorded, levels are {self.levels.tolist()}")
+        return self.quantiles[:, k]
+
+
+class _Streams(object):
+    """
+    按副本分组的 Philox 随机数流，每组 block 个副本，组号为全局编号
+    """
+    def __init__(self, seed: "int", first: "int", replicas: "int", block: "int"):
+        if first % block:
+            raise ValueError("first replica must be a multiple of block")
+        self.block = block
+        groups = -(-replicas // block)
+        self.generators = [np.random.Generator(np.random.Philox(key=((first // block + k) << 64) + seed))
+                           for k in range(groups)]
+
+    def _draw(self, name, *arrays):
+        out = []
+        for k, gen in enumerate(self.generators):
+            part = slice(k * self.block, (k + 1) * self.block)
+            out.append(getattr(gen, name)(*[a[part] for a in arrays]))
+        return np.concatenate(out)
+
+    def binomial(self, n: "np.ndarray", p: "np.ndarray") -> "np.ndarray":
+        return self._draw('binomial', n, np.broadcast_to(p, n.shape))
+
+    def poisson(self, lam: "np.ndarray") -> "np.ndarray":
+        """
+        只对 lam > 0 的位置抽样：lam 为 0 时泊松抽样不消耗随机数，结果与逐个抽样相同
+        """
+        out = np.zeros(lam.shape, dtype=np.int64)
+        for k, gen in enumerate(self.generators):
+            part = slice(k * self.block, (k + 1) * self.block)
+            sub = lam[part]
+            mask = sub > 0
+            out[part][mask] = gen.poisson(sub[mask])
+        return out
+
+
+class _Traffic(object):
+    """
+    按转移函数分组的边：zipf、线性与恒定迁移逐组向量化计算，自定义函数逐条边、逐副本调用
+    """
+    def __init__(self, country: "Country"):
+        if not country.hasEdges:
+            raise ValueError("stochastic simulation requires a country with explicit edges")
+        self.zipf = []
+        self.linear = []
+        self.const = []
+        self.calls = []
+        for k, transfer in enumerate(country.transfers):
+            edges = np.nonzero(country.edgeTransfer == k)[0]
+            if edges.size == 0:
+                continue
+            start, end, distance = country.edgeStart[edges], country.edgeEnd[edges], country.edgeDistance[edges]
+            kind = getattr(transfer, 'kind', None)
+            if kind == 'zipf':
+                K, alpha = transfer.args
+                self.zipf.append((transfer, start, end, K / distance ** alpha))
+            elif kind == 'linear':
+                rate, = transfer.args
+                self.linear.append((transfer, start, end, rate * country.edgeWeight[edges]))
+            elif kind == 'const':
+                self.const.append((transfer, start, end, np.array(transfer.args, dtype=float)))
+            else:
+                self.calls.append((transfer, start, end, distance))
+
+    def flows(self, x: "np.ndarray, shape=(R, n, 4)", t: "float") -> "[(start, end, rate)]":
+        """
+        各组边的期望迁移速率 (万人/天)，rate.shape=(R, E, 4)，负值表示反向迁移
+        """
+        N = x.sum(axis=-1)
+        out = []
+        for transfer, start, end, weight in self.zipf:
+            g = _gate(transfer, t)
+            if g != 0:
+                out.append((start, end, g * weight[:, None] * x[:, start] * N[:, end, None]))
+        for transfer, start, end, weight in self.linear:
+            g = _gate(transfer, t)
+            if g != 0:
+                out.append((start, end, g * weight[:, None] * x[:, start]))
+        for transfer, start, end, args in self.const:
+            g = _gate(transfer, t)
+            if g != 0:
+                out.append((start, end, np.broadcast_to(g * args, (x.shape[0], start.size, 4))))
+        for transfer, start, end, distance in self.calls:
+            rate = np.array([[transfer(xr[a], xr[b], t, d) for a, b, d in zip(start, end, distance)] for xr in x])
+            out.append((start, end, rate))
+        return out
+
+
+def _gate(transfer, t):
+    g = transfer.multiplier(t) if hasattr(transfer, 'multiplier') else 1.
+    if np.ndim(g):
+        raise ValueError("stochastic simulation does not support batched schedules")
+    return g
+
+
+def _migrate(counts: "np.ndarray", flows: "list", tau: "float", unit: "float", streams: "_Streams"):
+    """
+    按各条边的泊松迁移人数更新 counts，某城市某人群的出城总数超过现有人数时按比例缩减。
+    只对期望迁移量不为 0 的 (副本, 边, 人群) 抽样，只对迁移人数不为 0 的项计数
+    """
+    if not flows:
+        return
+    start = np.concatenate([s for s, e, rate in flows])
+    end = np.concatenate([e for s, e, rate in flows])
+    rate = np.concatenate([rate for s, e, rate in flows], axis=1)  # shape=(R, E, 4)
+    moved = streams.poisson(np.abs(rate) * (tau * unit))
+    r, e, c = np.nonzero(moved)
+    moved = moved[r, e, c].astype(float)
+    reverse = rate[r, e, c] < 0  # 负的速率为反向迁移
+    a = np.where(reverse, end[e], start[e])
+    b = np.where(reverse, start[e], end[e])
+
+    # 以 (副本, 城市, 人群) 展平后的下标计数，比 np.add.at 快得多
+    n = counts.shape[1]
+    source = (r * n + a) * 4 + c
+    target = (r * n + b) * 4 + c
+    out = np.bincount(source, moved, minlength=counts.size).reshape(counts.shape)
+    over = out > counts
+    if over.any():
+        scale = np.where(over, counts / np.maximum(out, 1), 1.)
+        moved = np.floor(moved * scale.ravel()[source])
+        out = np.bincount(source, moved, minlength=counts.size).reshape(counts.shape)
+    counts -= out.astype(np.int64)
+    counts += np.bincount(target, moved, minlength=counts.size).reshape(counts.shape).astype(np.int64)
+
+
+def tau_leap(country: "Country", initials: "np.ndarray, shape=(H, W, 4)", time_span: "list[float, float]",
+             replicas: "int" = 100, step: "float" = 0.1, sampling: "int" = 1, seed: "int" = 0, first: "int" = 0,
+             block: "int" = 64, levels: "list[float]" = (0.05, 0.25, 0.5, 0.75, 0.95), unit: "float" = 1e4,
+             sink: "Sink" = None) -> "StochasticResult":
+    """
+    tau-leaping 随机模拟。
+    initials: 初始状态 (万人)，乘以 unit 后取整为人数，所有副本相同
+    time_span, step, sampling: 同 numerical.RK4，step 即 tau
+    replicas: 副本数
+    seed, first, block: 副本 first, first + 1, ... 的随机数流 (见模块说明)，first 须为 block 的整数倍
+    levels: 记录的分位数水平
+    unit: 状态的单位对应的人数，默认 1 万人
+    sink: 分位数的接收器 (见sinks.py)，每个采样写入 shape=(Q, H, W, 4) 的分位数，默认为内存中的数组
+
+    Return:
+        StochasticResult
+    """
+    if country.model is not None:
+        raise ValueError("stochastic simulation only supports the extended SEIR model")
+    if initials.ndim != len(country.shape) + 1:
+        raise ValueError("stochastic simulation runs replicas of a single scenario, initials must be (H, W, 4)")
+    derivative = VectorDerivative(country)
+    for table in derivative.parameters.values():
+        if any(np.ndim(param.at(time_span[0])) for param in table.table):
+            raise ValueError("stochastic simulation does not support batched schedules")
+    traffic = _Traffic(country)
+    streams = _Streams(seed, first, replicas, block)
+    total = len(streams.generators) * block  # 最后一组不满 block 个副本时补足，保证随机数流与副本总数无关
+
+    steps = int((time_span[1] - time_span[0]) / step) + 1
+    n_sample = (steps - 1) // sampling + 1
+    ts = time_span[0] + step * np.arange(steps)
+    time = time_span[0] + step * sampling * np.arange(n_sample)
+    levels = np.asarray(levels, dtype=float)
+    sink = ArraySink() if sink is None else sink
+    sink.open(time, (levels.size, *initials.shape), False)
+    mean = np.zeros((n_sample, *initials.shape))
+    national = np.zeros((replicas, n_sample, 4), dtype=np.int64)
+    extinction = np.full(total, np.inf)
+
+    counts = np.repeat(np.rint(initials.reshape(1, -1, 4) * unit).astype(np.int64), total, axis=0)
+    for idx in range(steps):
+        alive = counts[..., 1:3].sum(axis=(1, 2)) > 0
+        extinction[~alive & np.isinf(extinction)] = ts[idx]
+        if idx % sampling == 0:
+            k = idx // sampling
+            x = counts[:replicas] / unit
+            sink.write(k, np.quantile(x, levels, axis=0).reshape(levels.size, *initials.shape))
+            mean[k] = x.mean(axis=0).reshape(initials.shape)
+            national[:, k] = counts[:replicas].sum(axis=1)
+        if idx + 1 == steps:
+            break
+
+        t = ts[idx]
+        x = counts / unit
+        S, E, I = counts[..., 0], counts[..., 1], counts[..., 2]
+        N = counts.sum(axis=-1)
+        p = derivative.parameters
+        force = p['r'](x, t) * (p['beta'](x, t) * I + p['h'](x, t) * E) / np.maximum(N, 1)
+        se = streams.binomial(S, -np.expm1(-step * force))
+        ei = streams.binomial(E, -np.expm1(-step * p['theta'](x, t)))
+        ir = streams.binomial(I, -np.expm1(-step * p['gamma'](x, t)))
+        counts[..., 0] -= se
+        counts[..., 1] += se - ei
+        counts[..., 2] += ei - ir
+        counts[..., 3] += ir
+
+        _migrate(counts, traffic.flows(counts / unit, t), step, unit, streams)
+        for city, nu in derivative.disturbances:
+            rate = np.broadcast_to(nu(t), (total, 4))
+            counts[:, city] += np.sign(rate).astype(np.int64) * streams.poisson(np.abs(rate) * step * unit)
+        np.maximum(counts, 0, out=counts)
+
+    return StochasticResult(time, levels, sink.close(n_sample), mean, national, extinction[:replicas],
+                            first + np.arange(replicas))
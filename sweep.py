@@ -0,0 +1,349 @@
+# -*- encoding:utf-8 -*-
+"""
+由配置文件描述的场景扫描。配置文件 (JSON) 给出国家、演化设定与参数网格，网格的笛卡尔积中每一项为一个场景：
+    lock_time: 封城时间，封城后 r 降至 r_lock，zipf 迁移停止；默认 [10000.]，即不封城
+    r_lock: 封城后的 r，默认 [SEIRDefaultParameter.r]
+    K, alpha: zipf 迁移的参数，默认为 defaults.zipf_transfer 的默认值
+    seed_city: 初始潜伏者所在城市 [i, j]，默认为中心城市
+    days: 演化天数，默认为 time_span 的长度
+其余配置项见 DEFAULTS。
+
+调度：父进程只建一次图，图的数组 (见kernel.Country.graph) 复制到一块共享内存，进程池的各 worker 启动时映射这块内存
+并以 Country.from_graph 构造国家，不重新建图也不复制数组。场景按估计耗时从长到短逐个提交，空闲的 worker 随即取走下一个，
+长场景不会拖在最后。worker 中的异常不会丢失，对应场景的状态为 error。worker 进程崩溃时重建进程池，崩溃时在运行的场景
+逐个单独重新运行一次，再次崩溃的场景 (即导致崩溃的场景) 状态为 crashed，其余场景不受影响。
+
+结果：每完成一个场景即向 output/results.csv 追加一行 (场景参数、状态、耗时、错误信息与全国的统计量)，
+全部完成后整理为列式的 output/results.npz。--resume 时跳过 results.csv 中已成功的场景 (按编号，网格须不变)。
+save_tracks 为 true 时各场景的轨迹另存为 output/tracks/sim_{index}.npz (给出 compact_tracks 时为压缩的 .trk)；
+cache 给出目录时使用结果缓存 (见cache.py)，重复运行只计算新增的场景。
+---------------------------------------------------------------
+Example:
+
+    python sweep.py sweep.json --workers 32
+    python sweep.py sweep.json --resume
+
+    columns = run_sweep(load_config('sweep.json'))
+    print(columns['index'][columns['status'] == 'ok'])
+"""
+import argparse
+import csv
+import itertools
+import json
+import os
+import time
+import traceback
+from collections import namedtuple, deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+import numpy as np
+from simulation import SimCountry
+from defaults import SEIRDefaultParameter, zipf_transfer
+from schedules import Piecewise
+from reducers import report_reducers, CumulativeReducer
+from sinks import NullSink
+from cache import Cache
+
+DEFAULTS = {
+    'shape': [5, 5],  # 格点形状
+    'min_distance': 100.,  # 最小城市间距 (km)
+    'cutoff': None, 'k_nearest': None, 'tolerance': None, 'edges': True,  # 建图的截断条件，见kernel.Country
+    'time_span': [0., 360.],
+    'step': 0.1, 'sampling': 1, 'method': 'RK4', 'backend': 'vector',
+    'population': 1000.,  # 各城市的初始人口 (万人)
+    'seed_size': 1e-4,  # 初始潜伏者 (万人)
+    'grid': {},
+    'output': 'results/sweep',
+    'save_tracks': False,
+    'compact_tracks': None,  # CompactSink 的参数 (如 {"tolerance": 1e-6})，给出时轨迹保存为压缩的 .trk 文件
+    'cache': None,
+}
+
+GRID = ('lock_time', 'r_lock', 'K', 'alpha', 'seed_city', 'days')
+
+COLUMNS = ('index',) + GRID[:4] + ('seed_i', 'seed_j', 'days', 'status', 'seconds', 'error',
+                                   'I_max', 'I_max_time', 'S_50_time', 'infections')
+
+Scenario = namedtuple('Scenario', ('index',) + GRID)
+
+
+def load_config(filename: "str") -> "dict":
+    with open(filename, encoding='utf-8') as f:
+        config = json.load(f)
+    unknown = set(config) - set(DEFAULTS)
+    if unknown:
+        raise ValueError(f"unknown config keys {sorted(unknown)}")
+    return {**DEFAULTS, **config}
+
+
+def scenarios(config: "dict") -> "list(Scenario)":
+    """
+    参数网格的笛卡尔积，按网格中的顺序编号
+    """
+    grid = config['grid']
+    unknown = set(grid) - set(GRID)
+    if unknown:
+        raise ValueError(f"unknown grid parameters {sorted(unknown)}, expected some of {GRID}")
+    H, W = config['shape']
+    defaults = {'lock_time': [10000.], 'r_lock': [SEIRDefaultParameter.r], 'K': [zipf_transfer().args[0]],
+                'alpha': [zipf_transfer().args[1]], 'seed_city': [[H // 2, W // 2]],
+                'days': [config['time_span'][1] - config['time_span'][0]]}
+    axes = [grid.get(name, defaults[name]) for name in GRID]
+    axes = [[tuple(int(k) for k in v) if name == 'seed_city' else float(v) for v in axis]
+            for name, axis in zip(GRID, axes)]
+    return [Scenario(index, *values) for index, values in enumerate(itertools.product(*axes))]
+
+
+def cost(scenario: "Scenario", config: "dict") -> "float":
+    """
+    场景的估计耗时 (相对值)，与时间步数成正比
+    """
+    return scenario.days / config['step']
+
+
+class SharedGraph(object):
+    """
+    复制到一块共享内存中的图结构数组 (见kernel.Country.graph)
+    name -> str, 共享内存的名称
+    layout -> dict, 数组名 -> (偏移, dtype, shape)
+    """
+    def __init__(self, graph: "dict"):
+        self.layout = {}
+        size = 0
+        for key, array in graph.items():
+            self.layout[key] = (size, array.dtype.str, array.shape)
+            size += -(-array.nbytes // 64) * 64
+        self.memory = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self.name = self.memory.name
+        for key, array in attach(self.memory, self.layout).items():
+            array.flags.writeable = True
+            array[...] = graph[key]
+            array.flags.writeable = False
+
+    def close(self):
+        self.memory.close()
+        self.memory.unlink()
+
+
+def attach(memory: "shared_memory.SharedMemory", layout: "dict") -> "dict":
+    """
+    共享内存中各数组的只读视图
+    """
+    graph = {}
+    for key, (offset, dtype, shape) in layout.items():
+        array = np.ndarray(shape, dtype=dtype, buffer=memory.buf, offset=offset)
+        array.flags.writeable = False
+        graph[key] = array
+    return graph
+
+
+_worker = {}  # 各 worker 进程中的国家、共享内存与配置
+
+
+def _init_worker(name, layout, config, has_edges, discarded_flux):
+    memory = shared_memory.SharedMemory(name=name)
+    _worker['memory'] = memory  # 保持映射
+    _worker['country'] = SimCountry.from_graph(config['shape'], config['min_distance'], attach(memory, layout),
+                                               has_edges, discarded_flux)
+    _worker['config'] = config
+    _worker['cache'] = Cache(config['cache']) if config['cache'] else None
+
+
+def _row(scenario: "Scenario", status: "str", seconds: "float" = 0., error: "str" = '', summary=None) -> "dict":
+    row = {'index': scenario.index, 'lock_time': scenario.lock_time, 'r_lock': scenario.r_lock, 'K': scenario.K,
+           'alpha': scenario.alpha, 'seed_i': scenario.seed_city[0], 'seed_j': scenario.seed_city[1],
+           'days': scenario.days, 'status': status, 'seconds': seconds, 'error': error}
+    for key in COLUMNS[COLUMNS.index('I_max'):]:
+        row[key] = float(np.asarray(summary[key])[0]) if summary is not None else np.nan
+    return row
+
+
+def run_scenario(country: "SimCountry", scenario: "Scenario", config: "dict", cache: "Cache" = None,
+                 reducers: "list(Reducer)" = (), profile: "Profile" = False) -> "dict":
+    """
+    演化一个场景，返回结果表的一行
+    reducers: 附加的统计量，与报告所需的统计量一起更新；profile: 传给 evolute 的性能统计 (如带进度回调的 Profile)
+    """
+    country.set_parameter('r', Piecewise([scenario.lock_time], [SEIRDefaultParameter.r, scenario.r_lock]))
+    country.set_transfer(zipf_transfer(scenario.K, scenario.alpha, gate=Piecewise([scenario.lock_time], [1., 0.])))
+    initials = np.zeros((*country.shape, 4))
+    initials[..., 0] = config['population']
+    initials[tuple(scenario.seed_city) + (1,)] = config['seed_size']
+    t0 = config['time_span'][0]
+    keep = config['save_tracks'] or cache is not None
+    start = time.perf_counter()
+    country.evolute(initials, [t0, t0 + scenario.days], config['step'], config['sampling'], config['method'],
+                    config['backend'], sink=None if keep else NullSink(),
+                    reducers=report_reducers() + [CumulativeReducer()] + list(reducers), profile=profile, cache=cache)
+    if config['save_tracks']:
+        options = config['compact_tracks']
+        country.save(os.path.join(config['output'], 'tracks', f"sim_{scenario.index}"), options is not None,
+                     **(options or {}))
+    return _row(scenario, 'ok', time.perf_counter() - start, summary=country.summary)
+
+
+def _run(scenario):
+    start = time.perf_counter()
+    try:
+        return run_scenario(_worker['country'], scenario, _worker['config'], _worker['cache'])
+    except Exception as e:
+        last = traceback.format_exception_only(type(e), e)[-1].strip()
+        return _row(scenario, 'error', time.perf_counter() - start, last)
+
+
+def _finished(filename: "str") -> "set":
+    """
+    results.csv 中已成功的场景编号
+    """
+    if not os.path.exists(filename):
+        return set()
+    with open(filename, newline='') as f:
+        return {int(row['index']) for row in csv.DictReader(f) if row['status'] == 'ok'}
+
+
+def _show(done, total, failed, elapsed):
+    eta = elapsed * (total - done) / done if done else float('inf')
+    print(f"[sweep] {done}/{total} done, {failed} failed, {elapsed:.0f}s elapsed, eta {eta:.0f}s")
+
+
+def run_sweep(config: "dict", workers: "int" = None, resume: "bool" = False, progress=_show,
+              interval: "float" = 1.) -> "dict":
+    """
+    运行配置中的所有场景
+    workers: 进程数，默认为 CPU 核数
+    resume: 跳过 results.csv 中已成功的场景，其余场景的结果追加到文件末尾
+    progress: 进度回调 progress(done, total, failed, elapsed)，至多每 interval 秒一次，结束时总会调用一次
+
+    Return:
+        dict, 列名 -> np.ndarray，即 results.npz 的内容，按场景编号排列
+    """
+    config = {**DEFAULTS, **config}
+    output = config['output']
+    os.makedirs(os.path.join(output, 'tracks') if config['save_tracks'] else output, exist_ok=True)
+    table = os.path.join(output, 'results.csv')
+    skip = _finished(table) if resume else set()
+    todo = sorted((s for s in scenarios(config) if s.index not in skip), key=lambda s: (-cost(s, config), s.index))
+    workers = workers or os.cpu_count()
+
+    country = SimCountry(tuple(config['shape']), config['min_distance'], config['cutoff'], config['k_nearest'],
+                         config['tolerance'], config['edges'])
+    graph = SharedGraph(country.graph())
+    initargs = (graph.name, graph.layout, config, country.hasEdges, country.discardedFlux)
+    del country
+    append = resume and os.path.exists(table)
+    start = last = time.perf_counter()
+    done = failed = 0
+    pool = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=initargs)
+    try:
+        with open(table, 'a' if append else 'w', newline='') as f:
+            writer = csv.DictWriter(f, COLUMNS)
+            if not append:
+                writer.writeheader()
+            queue = iter(todo)
+            pending = {}  # future -> (场景, 是否单独运行)
+            suspects = deque()  # 进程池崩溃时在运行的场景，逐个单独重新运行一次以找出导致崩溃的场景
+
+            def record(row):
+                nonlocal done, failed, last
+                writer.writerow(row)
+                f.flush()
+                done += 1
+                failed += row['status'] != 'ok'
+                now = time.perf_counter()
+                if progress is not None and now - last >= interval:
+                    last = now
+                    progress(done, len(todo), failed, now - start)
+
+            def restart():
+                """
+                进程池崩溃后，已完成的场景照常记录，其余在运行的场景成为嫌疑场景，并以新的进程池继续
+                """
+                nonlocal pool
+                for future, (scenario, alone) in pending.items():
+                    try:
+                        record(future.result(timeout=0))
+                    except Exception:
+                        suspects.append(scenario)
+                pending.clear()
+                pool.shutdown(wait=True)
+                pool = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=initargs)
+
+            def fill():
+                while True:
+                    if suspects:  # 嫌疑场景单独运行，此时不提交其他场景
+                        if pending:
+                            return
+                        scenario, alone = suspects.popleft(), True
+                    elif len(pending) < 2 * workers:  # 每个 worker 至多一个排队的场景，空闲时立即取走
+                        scenario, alone = next(queue, None), False
+                        if scenario is None:
+                            return
+                    else:
+                        return
+                    try:
+                        pending[pool.submit(_run, scenario)] = (scenario, alone)
+                    except BrokenProcessPool:
+                        suspects.appendleft(scenario)
+                        restart()
+
+            fill()
+            while pending:
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                broken = False
+                for future in finished:
+                    scenario, alone = pending.pop(future)
+                    try:
+                        record(future.result())
+                    except BrokenProcessPool as e:
+                        broken = True
+                        if alone:  # 单独运行时再次崩溃，即为导致崩溃的场景
+                            record(_row(scenario, 'crashed', error=str(e)))
+                        else:
+                            suspects.append(scenario)
+                if broken:
+                    restart()
+                fill()
+    finally:
+        pool.shutdown(wait=True)
+        graph.close()
+    if progress is not None:
+        progress(done, len(todo), failed, time.perf_counter() - start)
+    return consolidate(output)
+
+
+def consolidate(output: "str") -> "dict":
+    """
+    将 results.csv 整理为列式的 results.npz，同一场景有多行时 (如 --resume 重新运行失败的场景) 取最后一行
+    """
+    with open(os.path.join(output, 'results.csv'), newline='') as f:
+        rows = {int(row['index']): row for row in csv.DictReader(f)}
+    rows = [rows[k] for k in sorted(rows)]
+    columns = {}
+    for key in COLUMNS:
+        values = [row[key] for row in rows]
+        if key in ('status', 'error'):
+            columns[key] = np.array(values, dtype=str)
+        elif key in ('index', 'seed_i', 'seed_j'):
+            columns[key] = np.array(values, dtype=np.int64)
+        else:
+            columns[key] = np.array([float(v) if v != '' else np.nan for v in values])
+    np.savez(os.path.join(output, 'results.npz'), **columns)
+    return columns
+
+
+def main(argv=None) -> "int":
+    parser = argparse.ArgumentParser(description="GraphSEIR scenario sweep")
+    parser.add_argument('config', help="JSON sweep configuration")
+    parser.add_argument('--workers', type=int, default=None, help="worker processes, defaults to the CPU count")
+    parser.add_argument('--resume', action='store_true', help="skip scenarios already finished in results.csv")
+    args = parser.parse_args(argv)
+    config = load_config(args.config)
+    columns = run_sweep(config, args.workers, args.resume)
+    bad = int((columns['status'] != 'ok').sum())
+    print(f"{columns['index'].size - bad} scenario(s) ok, {bad} failed, results in {config['output']}")
+    return 1 if bad else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -2,54 +2,227 @@
 """
 模拟结果的可视化
 plot_country: 绘制国家总SEIR-时间演化曲线
-plot_all: 绘制各城市SEIR-时间演化曲线
-animate: 制作国家演化视频
+plot_all: 绘制各城市SEIR-时间演化曲线，多进程并行，进程间共享轨迹而不复制
+animate: 制作国家演化动画 (FuncAnimation，用于交互显示)
+save_animation: 逐帧以 blit 方式绘制并直接写入编码器，大格点国家可使用降采样的栅格模式
 report: 生成csv格式的报告表，包含国家和各城市演化过程中的感染最大值及时刻、健康人数降至50%时刻信息
+render: 以上全部输出，输入轨迹未变化的图表不重新绘制
+
+网络国家 (kernel.Country.from_network) 的城市按坐标绘制，栅格模式按坐标分格取平均，报告以城市名称为行名。
+
+生成文件的目录中记录了各文件输入数据的哈希 (.vision_cache.json)，cache=True 时哈希相同且文件存在则跳过绘制。
 """
+import hashlib
+import json
+import os
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import numpy as np
 import pandas as pd
-import os
+import matplotlib
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from simulation import SimCountry
+from reducers import reduce_track, report_reducers
+from sinks import ChunkedTrack, CompactTrack
 
+_CACHE_FILE = '.vision_cache.json'
 
-def _plot(ax, time: "np.ndarray, shape=(N,)", itrack: "np.ndarray, shape=(N, 4)"):
-    ax.plot(time, itrack[:, 0], lw=0.6, label='S')
-    ax.plot(time, itrack[:, 1], lw=0.6, label='E')
-    ax.plot(time, itrack[:, 2], lw=0.6, label='I')
-    ax.plot(time, itrack[:, 3], lw=0.6, label='R')
+
+def _plot(ax, time: "np.ndarray, shape=(N,)", itrack: "np.ndarray, shape=(N, 4)", labels='SEIR') -> "list(Line2D)":
+    lines = [ax.plot(time, itrack[:, k], lw=0.6, label=label)[0] for k, label in enumerate(labels)]
     ax.legend()
     ax.set_xlabel("time / day")
     ax.set_ylabel("population / $10^{4}$")
+    return lines
+
+
+def _digest(*arrays, **params) -> "str":
+    """
+    输入数据与绘图参数的哈希
+    """
+    h = hashlib.sha1()
+    for a in arrays:
+        h.update(np.ascontiguousarray(a).tobytes())
+    h.update(json.dumps(params, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+class _Cache(object):
+    """
+    目录中已生成文件的输入哈希
+    """
+    def __init__(self, directory: "str", enabled: "bool" = True):
+        self.directory = directory
+        self.path = os.path.join(directory, _CACHE_FILE)
+        self.entries = {}
+        if enabled and os.path.exists(self.path):
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        self.enabled = enabled
+
+    def fresh(self, name: "str", digest: "str") -> "bool":
+        return self.enabled and self.entries.get(name) == digest and os.path.exists(os.path.join(self.directory, name))
+
+    def update(self, entries: "dict"):
+        self.entries.update(entries)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp, self.path)
+
+
+def _national(country: "SimCountry") -> "np.ndarray, shape=(N, 4)":
+    """
+    全国的SEIR轨迹，对所有城市维求和 (格点国家两维，网络国家一维)；仓室模型为各仓室对分层之和, shape=(N, C)
+    """
+    total = np.asarray(country.track[:], dtype=float).sum(axis=tuple(range(1, len(country.shape) + 1)))
+    return total if country.model is None else total.sum(axis=1)
+
+
+def _labels(country: "SimCountry") -> "list(str)":
+    return list('SEIR') if country.model is None else list(country.model.compartments)
+
+
+def _infected(country: "SimCountry", idx) -> "np.ndarray":
+    """
+    采样 idx 时各城市的 I，仓室模型为 I 组仓室对分层之和 (见compartments.CompartmentModel.seir)
+    """
+    if country.model is None:
+        return np.asarray(country.track[idx, ..., 2], dtype=float)
+    return country.model.seir(np.asarray(country.track[idx], dtype=float))[..., 2]
+
+
+def _layout(country: "SimCountry") -> "(np.ndarray, np.ndarray)":
+    """
+    各城市在图中的位置：格点国家为格点坐标，网络国家为城市坐标 (km)
+    """
+    if len(country.shape) == 1:
+        return country.coordinates[:, 0], country.coordinates[:, 1]
+    I, J = np.mgrid[:country.shape[0], :country.shape[1]]
+    return I.flatten(), J.flatten()
 
 
 def plot_country(country: "SimCountry") -> "fig, ax":
     fig, ax = plt.subplots(dpi=170)
-    _plot(ax, country.time, country.track.sum(axis=(1, 2)))
+    _plot(ax, country.time, _national(country), _labels(country))
     return fig, ax
 
 
-def plot_all(country: "SimCountry", directory):
+def _city_name(idx: "tuple") -> "str":
+    return 'city' + ''.join(map(str, idx))
+
+
+def _render_cities(time, track, directory, cities, known, labels='SEIR') -> "dict":
+    """
+    绘制 cities 中各城市的曲线，known 为缓存中的哈希，返回 文件名 -> 哈希。
+    每个进程只创建一个图，逐城市更新曲线数据后保存；仓室模型的轨迹按仓室绘制，对分层求和
+    """
+    fig = Figure(dpi=170)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    lines = _plot(ax, time, np.zeros((len(time), len(labels))), labels)
+    digests = {}
+    for idx in cities:
+        idx = tuple(int(i) for i in idx)
+        name = _city_name(idx) + '.svg'
+        itrack = np.asarray(track[(slice(None),) + idx + (slice(None),) * (len(track.shape) - len(idx) - 1)],
+                            dtype=float)
+        itrack = itrack if itrack.ndim == 2 else itrack.sum(axis=1)
+        digests[name] = digest = _digest(time, itrack)
+        if known.get(name) == digest and os.path.exists(os.path.join(directory, name)):
+            continue
+        for k, line in enumerate(lines):
+            line.set_ydata(itrack[:, k])
+        ax.relim()
+        ax.autoscale_view()
+        fig.savefig(os.path.join(directory, name))
+    return digests
+
+
+def _share(track) -> "(spec, release)":
+    """
+    供子进程读取轨迹的描述：磁盘上的轨迹 (MemmapSink/ChunkedSink/CompactSink) 由子进程直接打开，
+    内存中的轨迹复制一次到共享内存，子进程以零拷贝的方式访问
+    """
+    if isinstance(track, ChunkedTrack):
+        return ('chunked', track.directory), lambda: None
+    if isinstance(track, CompactTrack):
+        return ('compact', track.filename), lambda: None
+    if isinstance(track, np.memmap) and track.filename is not None and track.filename.endswith('.npy'):
+        if np.load(track.filename, mmap_mode='r').shape == track.shape:
+            return ('npy', track.filename), lambda: None
+    track = np.asarray(track, dtype=float)
+    shm = shared_memory.SharedMemory(create=True, size=max(track.nbytes, 1))
+    np.ndarray(track.shape, dtype=float, buffer=shm.buf)[...] = track
+
+    def release():
+        shm.close()
+        shm.unlink()
+    return ('shm', shm.name, track.shape), release
+
+
+_WORKER = {}
+
+
+def _attach(spec):
+    """
+    子进程初始化：按 _share 的描述打开轨迹
+    """
+    matplotlib.use('Agg')
+    if spec[0] == 'chunked':
+        _WORKER['track'] = ChunkedTrack(spec[1])
+    elif spec[0] == 'compact':
+        _WORKER['track'] = CompactTrack(spec[1])
+    elif spec[0] == 'npy':
+        _WORKER['track'] = np.load(spec[1], mmap_mode='r')
+    else:
+        shm = shared_memory.SharedMemory(name=spec[1])  # 子进程与主进程共用 resource_tracker，由主进程释放
+        _WORKER['shm'] = shm
+        _WORKER['track'] = np.ndarray(spec[2], dtype=float, buffer=shm.buf)
+
+
+def _render_task(time, directory, cities, known, labels):
+    return _render_cities(time, _WORKER['track'], directory, cities, known, labels)
+
+
+def plot_all(country: "SimCountry", directory, processes: "int" = None, cache: "bool" = True):
+    """
+    各城市的SEIR-时间演化曲线 (仓室模型为各仓室)，保存为 directory/city{i}{j}.svg (网络国家为 city{k}.svg)
+    processes: 进程数，默认为CPU核数，1 表示在当前进程中绘制
+    cache: 城市轨迹的哈希与上次绘制时相同且文件存在时跳过
+    """
     if not os.path.exists(directory):
         os.makedirs(directory)
+    cache = _Cache(directory, cache)
+    known = cache.entries if cache.enabled else {}
+    cities = list(np.ndindex(*country.shape))
+    labels = _labels(country)
+    processes = os.cpu_count() if processes is None else processes
+    chunks = [c for c in np.array_split(np.array(cities), min(len(cities), processes * 4)) if len(c)]
+    if processes <= 1 or len(chunks) < 2:
+        cache.update(_render_cities(country.time, country.track, directory, cities, known, labels))
+        return
 
-    fig, ax = plt.subplots(dpi=170)
-    _plot(ax, country.time, country.track[:, 0, 0, :])
-    for i in range(country.shape[0]):
-        for j in range(country.shape[1]):
-            ax.clear()
-            _plot(ax, country.time, country.track[:, i, j, :])
-            fig.savefig(f"{directory}/city{i}{j}.svg")
+    spec, release = _share(country.track)
+    try:
+        with ProcessPoolExecutor(processes, initializer=_attach, initargs=(spec,)) as pool:
+            futures = [pool.submit(_render_task, country.time, directory, chunk, known, labels) for chunk in chunks]
+            for future in futures:
+                cache.update(future.result())
+    finally:
+        release()
 
 
 def animate(country: "SimCountry", interval=20, gap=10):
-    r, c = country.shape
-    I, J = np.mgrid[:r, :c]
-    sizes = country.track[:, :, :, 2].reshape(country.track.shape[0], -1) / 490 * 5120
+    X, Y = _layout(country)
+    sizes = _infected(country, slice(None)).reshape(country.track.shape[0], -1) / 490 * 5120
 
     fig, ax = plt.subplots(figsize=(5, 5))
-    pc = ax.scatter(I.flatten(), J.flatten(), c='red', s=sizes[0], alpha=0.5)
+    pc = ax.scatter(X, Y, c='red', s=sizes[0], alpha=0.5)
     title = ax.set_title(rf"t = ${country.time[0]:.2f}$ days")
 
     def Animate(i):
@@ -64,30 +237,218 @@ def animate(country: "SimCountry", interval=20, gap=10):
     return ani
 
 
-def report(country: "SimCountry", filename):
-    index = ['country'] + [f'city_{i}{j}' for j in range(country.shape[1]) for i in range(country.shape[0])]
-    df = pd.DataFrame(index=index, columns=['I_max_time', 'I_max', 'S_50_time'])
-
-    # 处理全国的情况
-    I = country.track[:, :, :, 2].sum(axis=(1, 2))
-    Im_arg = I.argmax()
-    Im_t = country.time[Im_arg]
-    Im = I[Im_arg]
-    S = country.track[:, :, :, 0].sum(axis=(1, 2))
-    S_frac = S / S[0]
-    S50_t = country.time[(S_frac > 0.5).sum() - 1]
-    df.loc['country', :] = [Im_t, Im, S50_t]
-
-    # 处理各城市
-    I = country.track[:, :, :, 2].reshape(country.time.size, -1)
-    Im_arg = I.argmax(axis=0)
-    Im_t = country.time[Im_arg]
-    Im = I[Im_arg, np.arange(I.shape[1])]
-    S = country.track[:, :, :, 0].reshape(country.time.size, -1)
-    S_frac = S / S[0, :].reshape(1, S.shape[1])
-    S50_t = country.time[(S_frac > 0.5).sum(axis=0) - 1]
-    df.iloc[1:, 0] = Im_t
-    df.iloc[1:, 1] = Im
-    df.iloc[1:, 2] = S50_t
+def _downsample(field: "np.ndarray, shape=(H, W)", factor: "int") -> "np.ndarray":
+    """
+    factor × factor 的城市块取平均，边缘不足的块只对已有城市取平均
+    """
+    if factor <= 1:
+        return field
+    H, W = field.shape
+    padded = np.full((-(-H // factor) * factor, -(-W // factor) * factor), np.nan)
+    padded[:H, :W] = field
+    blocks = padded.reshape(padded.shape[0] // factor, factor, padded.shape[1] // factor, factor)
+    return np.nanmean(blocks, axis=(1, 3))
+
+
+class _Raster(object):
+    """
+    栅格模式的图像：格点国家按 factor × factor 的城市块取平均 (_downsample)；
+    网络国家按坐标分入至多 max_cells × max_cells 个边长为 factor (km) 的格子，对格子中的城市取平均，没有城市的格子为空白
+    """
+    def __init__(self, country: "SimCountry", max_cells: "int"):
+        if len(country.shape) == 2:
+            H, W = country.shape
+            self.factor = -(-max(H, W) // max_cells)
+            self.extent = (-0.5, H - 0.5, -0.5, W - 0.5)
+            self.cell = None
+            return
+        xy = country.coordinates
+        lo = xy.min(axis=0)
+        self.factor = max(float((xy.max(axis=0) - lo).max()) / max_cells, 1e-9)
+        ij = np.minimum(((xy - lo) / self.factor).astype(int), max_cells - 1)
+        self.shape = tuple(int(m) + 1 for m in ij.max(axis=0))
+        self.cell = np.ravel_multi_index(tuple(ij.T), self.shape)
+        self.count = np.bincount(self.cell, minlength=int(np.prod(self.shape))).astype(float)
+        self.extent = (lo[0], lo[0] + self.shape[0] * self.factor, lo[1], lo[1] + self.shape[1] * self.factor)
+
+    def __call__(self, field: "np.ndarray, shape=(H, W) or (n,)") -> "np.ndarray, shape=(w, h)":
+        """
+        imshow 的图像 (已转置)
+        """
+        if self.cell is None:
+            return _downsample(field, self.factor).T
+        total = np.bincount(self.cell, field, minlength=self.count.size)
+        image = np.divide(total, self.count, out=np.full(self.count.size, np.nan), where=self.count > 0)
+        return image.reshape(self.shape).T
+
+
+class _FrameStream(object):
+    """
+    将 RGBA 帧逐帧写入编码器，不在内存中保存全部帧：.gif 由 Pillow 逐帧量化编码后追加到文件 (每帧使用局部调色板)，
+    其余格式通过管道交给 ffmpeg
+    """
+    def __init__(self, filename: "str", size: "tuple(int, int)", fps: "float"):
+        self.filename = filename
+        self.fps = fps
+        self.gif = filename.lower().endswith('.gif')
+        if self.gif:
+            self.file = open(filename, 'wb')
+            self.count = 0
+            return
+        w, h = size
+        command = [matplotlib.rcParams['animation.ffmpeg_path'], '-y', '-loglevel', 'error',
+                   '-f', 'rawvideo', '-pix_fmt', 'rgba', '-s', f'{w}x{h}', '-r', str(fps), '-i', '-',
+                   '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-pix_fmt', 'yuv420p', filename]
+        try:
+            self.proc = subprocess.Popen(command, stdin=subprocess.PIPE)
+        except FileNotFoundError:
+            raise RuntimeError("ffmpeg is required to encode videos, save as .gif instead")
+
+    def write(self, frame: "np.ndarray, shape=(h, w, 4)"):
+        if self.gif:
+            from PIL import Image, GifImagePlugin
+            image = Image.fromarray(frame[..., :3].copy()).quantize()
+            shown = np.asarray(image.convert('RGB'))
+            offset = (0, 0)
+            if self.count == 0:
+                header, _ = GifImagePlugin.getheader(image, info={'loop': 0})
+                self.file.write(b''.join(header))
+            else:
+                # 只编码与上一帧不同的矩形区域，其余像素保留上一帧
+                changed = np.any(shown != self.previous, axis=-1)
+                rows, cols = np.nonzero(changed.any(axis=1))[0], np.nonzero(changed.any(axis=0))[0]
+                top, left = (int(rows[0]), int(cols[0])) if rows.size else (0, 0)
+                bottom, right = (int(rows[-1]) + 1, int(cols[-1]) + 1) if rows.size else (1, 1)
+                offset = (left, top)
+                image = image.crop((left, top, right, bottom))
+            chunks = GifImagePlugin.getdata(image, offset, duration=int(1000 / self.fps), include_color_table=True)
+            self.file.write(b''.join(chunks))
+            self.previous = shown
+            self.count += 1
+        else:
+            self.proc.stdin.write(frame.tobytes())
 
+    def close(self):
+        if self.gif:
+            self.file.write(b';')  # GIF 结束标记
+            self.file.close()
+            if self.count == 0:
+                raise ValueError(f"no frames to encode in {self.filename}")
+            return
+        self.proc.stdin.close()
+        if self.proc.wait() != 0:
+            raise RuntimeError(f"ffmpeg failed to encode {self.filename}")
+
+
+def save_animation(country: "SimCountry", filename, gap: "int" = 10, fps: "float" = 50,
+                   raster: "bool" = None, max_cells: "int" = 128, dpi: "int" = 100, cache: "bool" = True) -> "bool":
+    """
+    国家演化动画，每 gap 个采样一帧。背景只绘制一次，每帧只重绘变化的图元 (blit)，帧直接写入编码器。
+    第一遍读取各帧计算哈希与色标上限，需要重新绘制时第二遍逐帧读取、绘制并写入，内存中只保留一帧
+    raster: True 时以图像显示各城市的 I，城市数超过 max_cells × max_cells 时按块取平均降采样；
+        False 时为每个城市一个圆 (同 animate)；默认在城市数超过 2500 时使用栅格模式。
+        网络国家的栅格按坐标分格 (见 _Raster)
+    cache: 轨迹与参数的哈希与上次相同且文件存在时跳过
+    Return:
+        bool, 是否重新绘制
+    """
+    raster = country.size > 2500 if raster is None else raster
+    frames = range(0, country.time.shape[0] - gap + 1, gap) if country.time.shape[0] >= gap else range(0)
+    grid = _Raster(country, max_cells) if raster else None
+    factor = grid.factor if raster else 1
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    name = os.path.basename(filename)
+    store = _Cache(directory, cache)
+    h = hashlib.sha1()
+    vmax = 1e-12  # 栅格模式的色标上限
+    for idx in frames:
+        field = np.ascontiguousarray(_infected(country, idx))
+        h.update(field.tobytes())
+        vmax = max(vmax, field.max())
+    digest = _digest(country.time, h.hexdigest().encode(), gap=gap, fps=fps, raster=raster, factor=factor, dpi=dpi)
+    if store.fresh(name, digest):
+        return False
+
+    fig = Figure(figsize=(5, 5), dpi=dpi)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    if raster:
+        first = grid(_infected(country, 0))
+        artist = ax.imshow(first, origin='lower', cmap='Reds', vmin=0., vmax=vmax, animated=True, extent=grid.extent)
+    else:
+        X, Y = _layout(country)
+        artist = ax.scatter(X, Y, c='red', s=_infected(country, 0).flatten() / 490 * 5120,
+                            alpha=0.5, animated=True)
+        if len(country.shape) == 2:
+            ax.set_xlim(-1, country.shape[0])
+            ax.set_ylim(-1, country.shape[1])
+    title = ax.set_title(rf"t = ${country.time[0]:.2f}$ days", animated=True)
+    canvas.draw()
+    background = canvas.copy_from_bbox(fig.bbox)
+
+    stream = _FrameStream(filename, canvas.get_width_height(), fps)
+    for idx in frames:
+        canvas.restore_region(background)
+        field = _infected(country, idx)
+        if raster:
+            artist.set_data(grid(field))
+        else:
+            artist.set_sizes(field.flatten() / 490 * 5120)
+        title.set_text(rf"t = ${country.time[idx]:.2f}$ days")
+        ax.draw_artist(artist)
+        ax.draw_artist(title)
+        stream.write(np.asarray(canvas.buffer_rgba()))
+    stream.close()
+    store.update({name: digest})
+    return True
+
+
+def report(country: "SimCountry", filename, summary: "dict" = None, scenario: "int" = None) -> "pd.DataFrame":
+    """
+    全国与各城市的 I_max_time, I_max, S_50_time 等统计量，保存为 csv 文件
+    summary: reducers.summarize 的结果，默认为 country.summary (演化时传入 reducers 即可，不需要保存轨迹)，
+        两者都没有时由 country.track 计算
+    scenario: 批量模拟时报告的场景编号
+    """
+    if summary is None:
+        summary = getattr(country, 'summary', None)
+    if not summary:
+        batched = len(country.track.shape) == len(country.shape) + len(country.stateShape) + 2
+        view = None if country.model is None else country.model.seir
+        summary = reduce_track(country.time, country.track, report_reducers(), batched, view)
+    if scenario is not None:
+        summary = {name: value[scenario] for name, value in summary.items()}
+    elif any(np.ndim(value) > 1 for value in summary.values()):
+        raise ValueError("report of a batched simulation needs a scenario index")
+
+    if len(country.shape) == 1:
+        index = ['country'] + list(country.names)
+    else:
+        index = ['country'] + ['city_' + ''.join(map(str, idx)) for idx in np.ndindex(*country.shape)]
+    df = pd.DataFrame(summary, index=index)
     df.to_csv(filename)
+    return df
+
+
+def render(country: "SimCountry", directory, processes: "int" = None, cache: "bool" = True,
+           animation_file: "str" = "animation.mp4", **kwargs):
+    """
+    模拟结果的全部输出：directory 下的 country.svg、各城市曲线、国家演化动画 (animation_file 为 None 时不生成)
+    与 report.csv。cache=True 时输入未变化的图表不重新绘制，kwargs 为 save_animation 的其余参数
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    store = _Cache(directory, cache)
+    total = _national(country)
+    digest = _digest(country.time, total)
+    if not store.fresh('country.svg', digest):
+        fig = Figure(dpi=170)
+        FigureCanvasAgg(fig)
+        _plot(fig.add_subplot(), country.time, total, _labels(country))
+        fig.savefig(os.path.join(directory, 'country.svg'))
+        store.update({'country.svg': digest})
+    plot_all(country, directory, processes, cache)
+    if animation_file is not None:
+        save_animation(country, os.path.join(directory, animation_file), cache=cache, **kwargs)
+    report(country, os.path.join(directory, 'report.csv'))
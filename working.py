@@ -3,10 +3,13 @@
 # 模拟参数请见simulation.md 或 研究报告 supplement/复杂SEIR模型及其在分析新冠疫情封城政策中的应用.pdf
 import numpy as np
 import os
-from multiprocessing import Pool
 from simulation import SimCountry
 from defaults import SEIRDefaultParameter, zipf_transfer, MIN_DISTANCE
-from vision import plot_all, plot_country, animate, report
+from schedules import Piecewise
+from checkpoints import Branch, run_tree
+from cache import Cache
+from sweep import load_config, run_sweep
+from vision import plot_all, plot_country, animate, report, render
 import matplotlib.pyplot as plt
 
 lock_times = [5., 10., 15., 10000.]  # 最后一次不封锁
@@ -16,23 +19,17 @@ R_LOCK = 3.
 def lockdown_parameter(p1, p2, time):
     """
     分段函数，封锁时间之前，参数为p1, 封锁之后为p2
+    time 为封城时间列表时，每个封城时间对应批量模拟中的一个场景
     """
-    def parameter(status: "np.ndarray, shape=(4,)", t: "float") -> "float":
-        return p2 if t >= time else p1
-
-    return parameter
+    return Piecewise([time], [p1, p2])
 
 
 def lockdown_transfer(time):
     """
     分段函数，封锁之前为zipf函数，封锁之后SEIR传输为0
+    time 为封城时间列表时，每个封城时间对应批量模拟中的一个场景
     """
-    def transfer(start_status: "np.ndarray, shape=(4,)", end_status: "np.ndarray, shape=(4,)",
-                 t: "float", distance: "float") -> "np.ndarray, shape=(4,)":
-        zipf = zipf_transfer()
-        return zipf(start_status, end_status, t, distance) if t < time else np.zeros_like(start_status)
-
-    return transfer
+    return zipf_transfer(gate=Piecewise([time], [1., 0.]))
 
 
 def step(idx, lock_time):
@@ -49,14 +46,11 @@ def step(idx, lock_time):
     if not os.path.exists("results"):
         os.mkdir("results")
     print("model initializing...")
-    for i in range(china.shape[0]):
-        for j in range(china.shape[1]):
-            china.cities[i][j].r = lockdown_parameter(SEIRDefaultParameter.r, R_LOCK, lock_time)
-    for traffic in china.traffic:
-        traffic.transfer = lockdown_transfer(lock_time)
+    china.set_parameter('r', lockdown_parameter(SEIRDefaultParameter.r, R_LOCK, lock_time))
+    china.set_transfer(lockdown_transfer(lock_time))
     print("done")
     print("Simulating...")
-    china.evolute(initials, time_span)
+    china.evolute(initials, time_span, cache=Cache('results/cache'))
     print("Simulation done, plotting...")
     china.save(f'results/sim_{idx}')
     # china.load(f'results/sim_{idx}.npz')
@@ -81,21 +75,18 @@ def single_thread():
     initials[2, 2, 1] = 1e-4
     time_span = [0., 360.]
 
-    for idx, lock_time in zip(range(len(lock_times)), lock_times):single_thread
+    for idx, lock_time in zip(range(len(lock_times)), lock_times):
         print(f"----------------- lock_time = {lock_time} --------------------")
         if not os.path.exists(f"reports/sim_{idx}"):
             os.makedirs(f"reports/sim_{idx}")
         if not os.path.exists("results"):
             os.mkdir("results")
         print("model initializing...")
-        for i in range(china.shape[0]):
-            for j in range(china.shape[1]):
-                china.cities[i][j].r = lockdown_parameter(SEIRDefaultParameter.r, R_LOCK, lock_time)
-        for traffic in china.traffic:
-            traffic.transfer = lockdown_transfer(lock_time)
+        china.set_parameter('r', lockdown_parameter(SEIRDefaultParameter.r, R_LOCK, lock_time))
+        china.set_transfer(lockdown_transfer(lock_time))
         print("done")
         print("Simulating...")
-        china.evolute(initials, time_span)
+        china.evolute(initials, time_span, cache=Cache('results/cache'))
         print("Simulation done, plotting...")
         china.save(f'results/sim_{idx}')
         # china.load(f'results/sim_{idx}.npz')
@@ -112,10 +103,74 @@ def single_thread():
         plt.close(fig)
 
 
-if __name__ == '__main__':
-    pool = Pool()
-    for idx, lock_time in zip(range(len(lock_times)), lock_times):
-        pool.apply_async(step, args=(idx, lock_time))
+def batched():
+    # 所有封城时机在一次积分中同时模拟，共享同一个图
+    china = SimCountry((5, 5), MIN_DISTANCE)
+    initials = np.zeros((len(lock_times), 5, 5, 4))
+    initials[:, :, :, 0] = 1000.
+    initials[:, 2, 2, 1] = 1e-4
+    time_span = [0., 360.]
+
+    if not os.path.exists("results"):
+        os.mkdir("results")
+    print("model initializing...")
+    china.set_parameter('r', lockdown_parameter(SEIRDefaultParameter.r, R_LOCK, lock_times))
+    china.set_transfer(lockdown_transfer(lock_times))
+    print("Simulating...")
+    china.evolute(initials, time_span)
+    tracks = china.track
+    for idx in range(len(lock_times)):
+        china.track = tracks[idx]
+        china.save(f'results/sim_{idx}')
+    print("Simulation done")
+
+
+def policy(lock_time):
+    # 封城时间为 lock_time 的场景设定，用于场景树
+    def setup(country):
+        country.set_parameter('r', lockdown_parameter(SEIRDefaultParameter.r, R_LOCK, lock_time))
+        country.set_transfer(lockdown_transfer(lock_time))
+    return setup
+
 
-    pool.close()
-    pool.join()
+def tree():
+    # 场景树：不封锁的场景在每个封城时间分叉出一个封城场景，各场景共享的前缀只演化一次
+    china = SimCountry((5, 5), MIN_DISTANCE)
+    initials = np.zeros((5, 5, 4))
+    initials[:, :, 0] = 1000.
+    initials[2, 2, 1] = 1e-4
+    time_span = [0., 360.]
+
+    if not os.path.exists("results"):
+        os.mkdir("results")
+    never = len(lock_times) - 1
+    root = Branch(policy(lock_times[never]), name=never)
+    for idx in reversed(range(never)):
+        root = Branch(policy(lock_times[never]), until=lock_times[idx],
+                      children=[Branch(policy(lock_times[idx]), name=idx), root])
+    print("Simulating...")
+    results = run_tree(china, initials, time_span, root)
+    for idx, (time, track, summary) in results.items():
+        china.time, china.track = time, track
+        china.save(f'results/sim_{idx}')
+    print("Simulation done")
+
+
+def sweep():
+    # 由 sweep.json 描述的参数网格，多进程共享同一个图，结果汇总在 results/sweep/results.csv 与 results.npz
+    columns = run_sweep(load_config('sweep.json'))
+    print(f"{(columns['status'] == 'ok').sum()} / {columns['index'].size} scenarios done")
+
+
+def plot(idx):
+    # 绘制已保存的模拟结果，各城市曲线由 render 多进程绘制，未变化的结果不重新绘制
+    china = SimCountry((5, 5), MIN_DISTANCE)
+    china.load(f'results/sim_{idx}.npz')
+    render(china, f"reports/sim_{idx}")
+    print(f"sim_{idx} plotting done")
+
+
+if __name__ == '__main__':
+    tree()
+    for idx in range(len(lock_times)):
+        plot(idx)